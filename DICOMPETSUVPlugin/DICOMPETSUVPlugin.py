@@ -11,18 +11,39 @@ else:
 
 import DICOMLib
 
+import copy
+import hashlib
+import json
+import logging
 import math as math
+import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 #
 # This is the plugin to handle PET SUV volumes
 # from DICOM files into MRML nodes.  It follows the DICOM module's
 # plugin architecture.
 #
+# Concurrency: slicer.dicomDatabase is one database connection that is only
+# used from the main thread, so examine() and load() must be called on the
+# main thread. A batch ingest service that examines series in parallel uses a
+# process pool, each process with its own database. Worker threads of the
+# plugins (header, slice and frame readers, prefetching) only read files and
+# never query the database. State derived from a series is carried on its
+# loadables.
+#
+
 
 class DICOMPETSUVPluginClass(DICOMPlugin):
   """ PET specific interpretation code
   """
 
+  # SUV parametric maps written by the SUV Factor Calculator CLI or by
+  # DICOMRWVMPluginClass.exportParametricMap keep the PT modality of their
+  # series but are not PET series to be quantified
+  parametricMapSOPClassUID = '1.2.840.10008.5.1.4.1.1.30'
+
   def __init__(self):
     super(DICOMPETSUVPluginClass,self).__init__()
 
@@ -38,18 +59,21 @@ class DICOMPETSUVPluginClass(DICOMPlugin):
     self.tags['relatedSeriesSequence'] = "0008,1250"
 
     self.tags['radioPharmaconStartTime'] = "0018,1072"
+    self.tags['radionuclideTotalDose'] = "0018,1074"
     self.tags['decayCorrection'] = "0054,1102"
     self.tags['decayFactor'] = "0054,1321"
     self.tags['frameRefTime'] = "0054,1300"
     self.tags['radionuclideHalfLife'] = "0018,1075"
     self.tags['contentTime'] = "0008,0033"
     self.tags['seriesTime'] = "0008,0031"
+    self.tags['acquisitionTime'] = "0008,0032"
 
 
     self.tags['seriesDescription'] = "0008,103e"
     self.tags['seriesModality'] = "0008,0060"
     self.tags['seriesInstanceUID'] = "0020,000E"
     self.tags['sopInstanceUID'] = "0008,0018"
+    self.tags['sopClassUID'] = "0008,0016"
     self.tags['seriesInstanceUID'] = "0020,000e"
 
     self.tags['studyInstanceUID'] = "0020,000D"
@@ -62,6 +86,10 @@ class DICOMPETSUVPluginClass(DICOMPlugin):
     self.tags['spacing'] = "0028,0030"
     self.tags['position'] = "0020,0032"
     self.tags['orientation'] = "0020,0037"
+    self.tags['frameOfReferenceUID'] = "0020,0052"
+    self.tags['numberOfFrames'] = "0028,0008"
+    self.tags['units'] = "0054,1001"
+    self.tags['correctedImage'] = "0028,0051"
     self.tags['pixelData'] = "7fe0,0010"
 
     self.tags['referencedImageRWVMappingSeq'] = "0008,1140"
@@ -77,6 +105,8 @@ class DICOMPETSUVPluginClass(DICOMPlugin):
 
     self.scalarVolumePlugin = slicer.modules.dicomPlugins['DICOMScalarVolumePlugin']()
     self.rwvPlugin = slicer.modules.dicomPlugins['DICOMRWVMPlugin']()
+    # RWVM files generated for placeholder loadables, by PET SeriesInstanceUID
+    self.resolvedRWVMFiles = {}
 
 
   def __getDirectoryOfImageSeries(self, sopInstanceUID):
@@ -86,7 +116,7 @@ class DICOMPETSUVPluginClass(DICOMPlugin):
 
   def __getSeriesInformation(self,seriesFiles,dicomTag):
     if seriesFiles:
-      return  slicer.dicomDatabase.fileValue(seriesFiles[0],dicomTag)
+      return slicer.dicomDatabase.fileValue(seriesFiles[0],dicomTag)
 
 
   def examine(self,fileLists):
@@ -95,57 +125,378 @@ class DICOMPETSUVPluginClass(DICOMPlugin):
     fileLists parameter.
     """
     loadables = []
+    petSeries = []
 
     # get from cache or create new loadables
     for fileList in fileLists:
       cachedLoadables = self.getCachedLoadables(fileList)
       if cachedLoadables:
         loadables += cachedLoadables
-      else:
-        if slicer.dicomDatabase.fileValue(fileList[0],self.tags['seriesModality']) == "PT":
-          # check if PET series already has Real World Value Mapping
-          hasRWVM = False
-          if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
-            ptFile = pydicom.dcmread(fileList[0])
-          else:
-            ptFile = dicom.read_file(fileList[0])
-          self.multiframe = len(ptFile.pixel_array.shape) # This takes the value from the third <parameters> group from the xml and the second element
-          assert self.multiframe == 2 or self.multiframe == 3
-          studyUID = slicer.dicomDatabase.fileValue(fileList[0],self.tags['studyInstanceUID'])
-          for series in slicer.dicomDatabase.seriesForStudy(studyUID):
-            if ptFile.SeriesInstanceUID != series:
-              for seriesFile in slicer.dicomDatabase.filesForSeries(series):
-                if slicer.dicomDatabase.fileValue(seriesFile,self.tags['seriesModality']) == "RWV":
-                  if ptFile.SeriesInstanceUID == self.getReferencedSeriesInstanceUID(seriesFile):
-                    hasRWVM = True
-                    loadablesForFiles = self.rwvPlugin.getLoadablePetSeriesFromRWVMFile(seriesFile)
-                    for loadable in loadablesForFiles:
-                      loadable.confidence = 1.0
-                      self.abbreviateLoadableName(loadable)
-                    loadables += loadablesForFiles
-                    self.cacheLoadables(fileList,loadablesForFiles)
-          if not hasRWVM:
-            # Call SUV Factor Calculator to create RWVM files for this PET series
-            rwvmFile = self.generateRWVMforFileList(fileList)
-            loadablesForFiles = self.rwvPlugin.getLoadablePetSeriesFromRWVMFile(rwvmFile)
-            for loadable in loadablesForFiles:
-              loadable.confidence = 0.95
-              self.abbreviateLoadableName(loadable)
-            self.cacheLoadables(fileList,loadablesForFiles)
-            # there may be multiple loadables per one RWV series, add it only
-            #  once. Note we only add RWV to the DB if we create a new RWV
-            #  instance.
-            loadablesForFiles[0].derivedItems = [rwvmFile]
-            loadables += loadablesForFiles
+        petSeries.append((fileList, cachedLoadables))
+      elif (self.__getSeriesInformation(fileList,self.tags['seriesModality']) == "PT" and
+            self.__getSeriesInformation(fileList,self.tags['sopClassUID']) != self.parametricMapSOPClassUID):
+        loadablesForFiles = self.examineSeries(fileList)
+        self.cacheLoadables(fileList,loadablesForFiles)
+        loadables += loadablesForFiles
+        petSeries.append((fileList, loadablesForFiles))
+
+    if len(petSeries) > 1 and self.combineBedPositionsEnabled():
+      loadables += self.examineBedPositions(petSeries)
+
+    return loadables
+
+
+  def examineSeries(self, fileList):
+    """Return the loadables of one PET series"""
+    loadables = []
+    # check if PET series already has Real World Value Mapping
+    hasRWVM = False
+    seriesInstanceUID = self.__getSeriesInformation(fileList,self.tags['seriesInstanceUID'])
+    studyUID = self.__getSeriesInformation(fileList,self.tags['studyInstanceUID'])
+    for series in slicer.dicomDatabase.seriesForStudy(studyUID):
+      if seriesInstanceUID != series:
+        for seriesFile in slicer.dicomDatabase.filesForSeries(series):
+          if slicer.dicomDatabase.fileValue(seriesFile,self.tags['seriesModality']) == "RWV":
+            if seriesInstanceUID == self.getReferencedSeriesInstanceUID(seriesFile):
+              hasRWVM = True
+              loadablesForFiles = self.rwvPlugin.getLoadablePetSeriesFromRWVMFile(seriesFile)
+              for loadable in loadablesForFiles:
+                loadable.confidence = 1.0
+                self.abbreviateLoadableName(loadable)
+              loadables += loadablesForFiles
+    if not hasRWVM and self.deferredGenerationEnabled():
+      # the RWVM is generated when one of the loadables is loaded
+      loadables += self.createDeferredLoadables(fileList)
+    elif not hasRWVM:
+      # Call SUV Factor Calculator to create RWVM files for this PET series
+      rwvmFile = self.generateRWVMforFileList(fileList)
+      loadablesForFiles = self.rwvPlugin.getLoadablePetSeriesFromRWVMFile(rwvmFile)
+      for loadable in loadablesForFiles:
+        loadable.confidence = 0.95
+        self.abbreviateLoadableName(loadable)
+      # there may be multiple loadables per one RWV series, add it only
+      #  once. Note we only add RWV to the DB if we create a new RWV
+      #  instance.
+      loadablesForFiles[0].derivedItems = [rwvmFile]
+      loadables += loadablesForFiles
+
+    # dimension of the pixel array of a file: 2 (one slice) or 3 (multiframe)
+    multiframe = self.seriesDimension(fileList)
+    for loadable in loadables:
+      loadable.multiframe = multiframe
+
+    if multiframe == 2 and self.previewEnabled():
+      # offer a preview of the SUVbw volume
+      previewedLoadables = [loadable for loadable in loadables if '(SUVbw)' in loadable.name] or loadables[:1]
+      loadables += [self.createPreviewLoadable(loadable) for loadable in previewedLoadables]
+
+    return loadables
+
+
+  def combineBedPositionsEnabled(self):
+    """Return True if examine offers a whole body loadable for PET series that
+    are bed positions of one acquisition (DICOM/PETSUV/CombineBedPositions
+    setting, disabled by default)."""
+    return slicer.util.settingsValue('DICOM/PETSUV/CombineBedPositions', False, converter=slicer.util.toBool)
+
+
+  def examineBedPositions(self, petSeries):
+    """Return whole body loadables for the single slice PET series of
+    petSeries, a list of (fileList, loadables), that share study, frame of
+    reference, slice geometry and SUV inputs, were acquired at different
+    times and follow each other without gap along the slice normal (see
+    planBedPositions). One loadable per SUV variant that all bed
+    positions offer, loaded by DICOMRWVMPluginClass.loadPetBedPositions."""
+    groups = {}
+    for fileList, seriesLoadables in petSeries:
+      if not seriesLoadables or getattr(seriesLoadables[0], 'multiframe', 2) != 2:
+        continue
+      geometry = self.bedGeometry(fileList)
+      if geometry is None:
+        continue
+      groupKey = (geometry['studyInstanceUID'], geometry['frameOfReferenceUID'], geometry['orientation'],
+                  geometry['rows'], geometry['columns'], geometry['pixelSpacing'])
+      groups.setdefault(groupKey, []).append((geometry, seriesLoadables))
+
+    loadables = []
+    for beds in groups.values():
+      if len(beds) < 2:
+        continue
+      beds.sort(key=lambda bed: bed[0]['positions'][0])
+      geometries = [geometry for geometry, seriesLoadables in beds]
+      inPlaneOrigins = np.array([geometry['inPlaneOrigin'] for geometry in geometries])
+      if np.abs(inPlaneOrigins - inPlaneOrigins[0]).max() > 0.01 * min(geometries[0]['pixelSpacingValues']):
+        continue
+      acquisitionTimes = [geometry['acquisitionTime'] for geometry in geometries]
+      if len(set(acquisitionTimes)) != len(acquisitionTimes):
+        # reconstructions of the same bed, not bed positions of one acquisition
+        logging.info("PET series with the same frame of reference and acquisition time, not combined")
+        continue
+      plan = self.planBedPositions([geometry['positions'] for geometry in geometries])
+      if plan is None:
+        continue
+      try:
+        suvInputs = [self.bedSUVInputs(geometry['files'][0]) for geometry in geometries]
+      except Exception as e:
+        logging.debug(f"Cannot compare the SUV inputs of bed positions: {str(e)}")
+        continue
+      if any(inputs != suvInputs[0] for inputs in suvInputs[1:]):
+        logging.info("PET series with the same frame of reference have different SUV inputs, not combined")
+        continue
+
+      for variant in beds[0][1]:
+        if getattr(variant, 'preview', False):
+          continue
+        unitsCodeValue = getattr(variant, 'unitsCodeValue', None)
+        bedLoadables = []
+        for geometry, seriesLoadables in beds:
+          matching = [l for l in seriesLoadables
+                      if getattr(l, 'unitsCodeValue', None) == unitsCodeValue and not getattr(l, 'preview', False)]
+          if matching:
+            bedLoadables.append(matching[0])
+        if len(bedLoadables) != len(beds):
+          continue
+        loadable = DICOMLoadable()
+        loadable.files = [f for geometry in geometries for f in geometry['files']]
+        loadable.name = variant.name + ' whole body (%d beds)' % len(beds)
+        loadable.tooltip = loadable.name
+        loadable.confidence = variant.confidence - 0.05
+        loadable.selected = False
+        loadable.unitsCodeValue = unitsCodeValue
+        loadable.referencedSeriesInstanceUID = getattr(variant, 'referencedSeriesInstanceUID', None)
+        loadable.multiframe = 2
+        loadable.bedLoadables = bedLoadables
+        loadable.bedFileLists = [geometry['files'] for geometry in geometries]
+        loadable.bedSliceIndices = plan['sliceIndices']
+        loadable.numberOfSlices = plan['numberOfSlices']
+        loadable.sliceSpacing = plan['sliceSpacing']
+        loadables.append(loadable)
+    return loadables
+
+
+  def bedGeometry(self, fileList):
+    """Return the slice geometry of a single slice PET series, its files
+    sorted along the slice normal, None if the slices are not parallel"""
+    value = lambda fileName, tag: slicer.dicomDatabase.fileValue(fileName, self.tags[tag])
+    try:
+      orientation = [float(v) for v in value(fileList[0], 'orientation').split('\\')]
+      pixelSpacing = value(fileList[0], 'spacing')
+      pixelSpacingValues = [float(v) for v in pixelSpacing.split('\\')]
+      positions = [[float(v) for v in value(f, 'position').split('\\')] for f in fileList]
+      orientations = set(value(f, 'orientation') for f in fileList)
+    except ValueError:
+      return None
+    geometry = {
+      'studyInstanceUID': value(fileList[0], 'studyInstanceUID'),
+      'frameOfReferenceUID': value(fileList[0], 'frameOfReferenceUID'),
+      'rows': value(fileList[0], 'rows'),
+      'columns': value(fileList[0], 'columns'),
+      'pixelSpacing': pixelSpacing,
+      'pixelSpacingValues': pixelSpacingValues,
+      'acquisitionTime': value(fileList[0], 'acquisitionTime').strip() or value(fileList[0], 'seriesTime').strip(),
+      }
+    if len(orientation) != 6 or len(orientations) != 1 or not geometry['frameOfReferenceUID']:
+      return None
+    rowDirection = np.array(orientation[:3])
+    columnDirection = np.array(orientation[3:])
+    normal = np.cross(rowDirection, columnDirection)
+    positions = np.array(positions)
+    order = np.argsort(positions @ normal)
+    geometry['orientation'] = tuple(np.round(orientation, 4))
+    geometry['files'] = [fileList[index] for index in order]
+    geometry['positions'] = list((positions @ normal)[order])
+    geometry['inPlaneOrigin'] = (float(positions[order[0]] @ rowDirection), float(positions[order[0]] @ columnDirection))
+    return geometry
+
+
+  def bedSUVInputs(self, fileName):
+    """Return the header values of a bed position that must be equal for all
+    beds of a whole body acquisition (all SUV inputs but the series time)"""
+    inputs = CohortSUVFactors().readHeader(fileName)
+    for keyword in ('SeriesInstanceUID', 'SeriesTime', 'FrameReferenceTime'):
+      inputs.pop(keyword, None)
+    return inputs
+
+
+  @staticmethod
+  def planBedPositions(bedPositions, tolerance=0.1):
+    """Place the slices of several bed positions on one grid. bedPositions
+    holds the sorted slice positions (mm along the slice normal) of every bed,
+    the beds sorted by their first slice. Beds must have the same uniform
+    slice spacing, slices on a common grid and no gap between consecutive
+    beds. Each bed must start and end after the previous one; consecutive
+    beds may overlap by at most half of the shorter bed. Returns
+    numberOfSlices, sliceSpacing and the slice index of every slice of every
+    bed, None if the beds do not fit."""
+    spacings = []
+    for positions in bedPositions:
+      if len(positions) < 2:
+        return None
+      steps = np.diff(positions)
+      spacings.append(float(np.median(steps)))
+      if spacings[-1] <= 0 or np.abs(steps - spacings[-1]).max() > tolerance * spacings[-1]:
+        return None
+    sliceSpacing = spacings[0]
+    if max(abs(spacing - sliceSpacing) for spacing in spacings) > 0.01 * sliceSpacing:
+      return None
+    start = bedPositions[0][0]
+    sliceIndices = []
+    for bedIndex, positions in enumerate(bedPositions):
+      continuous = (np.asarray(positions) - start) / sliceSpacing
+      indices = np.rint(continuous).astype(int)
+      if np.abs(continuous - indices).max() > tolerance:
+        return None
+      if bedIndex > 0:
+        previous = sliceIndices[-1]
+        if indices[0] > previous[-1] + 1:
+          # gap between this bed and the previous one
+          return None
+        if indices[0] <= previous[0] or indices[-1] <= previous[-1]:
+          # same or contained bed
+          return None
+        if 2*(previous[-1] - indices[0] + 1) > min(len(previous), len(indices)):
+          return None
+      sliceIndices.append([int(index) for index in indices])
+    numberOfSlices = max(indices[-1] for indices in sliceIndices) + 1
+    return {'numberOfSlices': numberOfSlices, 'sliceSpacing': sliceSpacing, 'sliceIndices': sliceIndices}
+
+
+  def seriesDimension(self, fileList):
+    """Return the dimension of the pixel array of the files of a series, 2
+    for one slice per file and 3 for multiframe files"""
+    numberOfFrames = self.__getSeriesInformation(fileList,self.tags['numberOfFrames'])
+    return 3 if int(numberOfFrames or 1) > 1 else 2
 
+
+  def deferredGenerationEnabled(self):
+    """Return True if examine offers placeholder loadables and the RWVM of a
+    PET series is only generated when it is loaded (DICOM/PETSUV/DeferRWVMGeneration
+    setting, enabled by default). Placeholders are only offered for series
+    whose header passes the checks of the SUV Factor Calculator, see
+    createDeferredLoadables."""
+    return slicer.util.settingsValue('DICOM/PETSUV/DeferRWVMGeneration', True, converter=slicer.util.toBool)
+
+
+  def createDeferredLoadables(self, fileList):
+    """Return placeholder loadables for the SUV variants the header of a PET
+    series allows to compute, named like the loadables of its future RWVM.
+    Series the SUV Factor Calculator would reject get no loadables."""
+    value = lambda tag: self.__getSeriesInformation(fileList, self.tags[tag]) or ''
+    failure = CohortSUVFactors.correctionFailure(value('correctedImage'), value('decayCorrection').strip())
+    if not failure and 'BQML' not in value('units'):
+      failure = "Units are not BQML"
+    if not failure:
+      try:
+        dose = float(value('radionuclideTotalDose') or 0)
+      except ValueError:
+        dose = 0.0
+      if not dose:
+        failure = "Missing injected dose"
+    if failure:
+      logging.info(f"{failure} in PET series {value('seriesInstanceUID')}, no SUV loadables")
+      return []
+    try:
+      weight = float(value('patientWeight') or 0)
+      height = float(value('patientHeight') or 0)
+    except ValueError:
+      weight, height = 0.0, 0.0
+    sex = value('patientSex').strip()
+
+    variants = []
+    if weight:
+      variants.append(('{SUVbw}g/ml', 'Standardized Uptake Value body weight'))
+      if height and sex in ['M', 'F']:
+        variants.append(('{SUVlbm}g/ml', 'Standardized Uptake Value lean body mass'))
+      if height:
+        variants.append(('{SUVbsa}cm2/ml', 'Standardized Uptake Value body surface area'))
+      if height and sex in ['M', 'F']:
+        variants.append(('{SUVibw}g/ml', 'Standardized Uptake Value ideal body weight'))
+
+    loadables = []
+    for unitsCodeValue, unitsCodeMeaning in variants:
+      loadable = DICOMLoadable()
+      loadable.files = fileList
+      loadable.patientName = value('patientName')
+      loadable.patientID = value('patientID')
+      loadable.studyDate = value('studyDate')
+      loadable.name = loadable.patientName + ' ' + self.rwvPlugin.convertStudyDate(loadable.studyDate) + ' ' + unitsCodeMeaning
+      loadable.confidence = 0.95
+      loadable.selected = False
+      self.abbreviateLoadableName(loadable)
+      loadable.tooltip = loadable.name
+      loadable.unitsCodeValue = unitsCodeValue
+      loadable.referencedSeriesInstanceUID = value('seriesInstanceUID')
+      loadable.deferred = True
+      loadables.append(loadable)
     return loadables
 
 
+  def resolveDeferredLoadable(self, loadable):
+    """Generate (or reuse) the RWVM of the PET series of a placeholder
+    loadable and return the loadable of the RWVM with the same units"""
+    seriesInstanceUID = loadable.referencedSeriesInstanceUID
+    # the variants of a series share one RWVM, generate it once
+    rwvmFile = self.resolvedRWVMFiles.get(seriesInstanceUID)
+    if not rwvmFile or not os.path.exists(rwvmFile):
+      rwvmFile = self.generateRWVMforFileList(loadable.files)
+      # the DICOM module only adds derived items known at examine time
+      indexer = ctk.ctkDICOMIndexer()
+      indexer.addFile(slicer.dicomDatabase, rwvmFile)
+      self.resolvedRWVMFiles[seriesInstanceUID] = rwvmFile
+    rwvLoadables = self.rwvPlugin.getLoadablePetSeriesFromRWVMFile(rwvmFile)
+    for rwvLoadable in rwvLoadables:
+      if rwvLoadable.unitsCodeValue == loadable.unitsCodeValue:
+        rwvLoadable.name = loadable.name
+        rwvLoadable.tooltip = loadable.tooltip
+        rwvLoadable.confidence = loadable.confidence
+        rwvLoadable.selected = loadable.selected
+        rwvLoadable.preview = getattr(loadable, 'preview', False)
+        rwvLoadable.multiframe = getattr(loadable, 'multiframe', None)
+        return rwvLoadable
+    raise RuntimeError(f"SUVFactorCalculator did not compute {loadable.unitsCodeValue} for series {seriesInstanceUID}")
+
+
+  def previewEnabled(self):
+    """Return True if low resolution preview loadables are offered for PET
+    series (DICOM/PETSUV/PreviewLoadable setting)."""
+    return slicer.util.settingsValue('DICOM/PETSUV/PreviewLoadable', False, converter=slicer.util.toBool)
+
+
+  def createPreviewLoadable(self, loadable):
+    """Return a lower confidence copy of a loadable that loads a decimated preview"""
+    previewLoadable = copy.copy(loadable)
+    previewLoadable.name = loadable.name + ' (preview)'
+    previewLoadable.tooltip = previewLoadable.name
+    previewLoadable.confidence = loadable.confidence - 0.1
+    previewLoadable.selected = False
+    previewLoadable.derivedItems = []
+    previewLoadable.preview = True
+    return previewLoadable
+
+
   def generateRWVMforFileList(self, fileList):
-    """Return a list of loadables after generating Real World Value Mapping
-    objects for a PET series
+    """Return the Real World Value Mapping object for a PET series. An RWVM
+    generated before from the same header inputs is reused if the registry
+    knows it, otherwise the SUV Factor Calculator CLI creates one.
     """
-    loadables = []
+    registry = RWVMRegistry() if RWVMRegistry.isEnabled() else None
+    if registry:
+      seriesInstanceUID = self.__getSeriesInformation(fileList, self.tags['seriesInstanceUID'])
+      inputsHash = registry.inputsHash(fileList)
+      rwvmFile = registry.lookup(seriesInstanceUID, inputsHash)
+      if rwvmFile:
+        logging.debug(f"Reusing RWVM {rwvmFile} of series {seriesInstanceUID}")
+        return rwvmFile
+
+    rwvmFile = self.runSUVFactorCalculator(fileList)
+    if registry:
+      registry.register(seriesInstanceUID, inputsHash, rwvmFile)
+    return rwvmFile
+
+
+  def runSUVFactorCalculator(self, fileList):
+    """Generate a new Real World Value Mapping object for a PET series in the
+    directory of the series and return its file name"""
     # Call SUV Factor Calculator module
     sopInstanceUID = self.__getSeriesInformation(fileList, self.tags['sopInstanceUID'])
     seriesDirectory = self.__getDirectoryOfImageSeries(sopInstanceUID)
@@ -175,6 +526,13 @@ class DICOMPETSUVPluginClass(DICOMPlugin):
     return rwvFile
 
 
+  def pruneDuplicateRWVMs(self, deleteFiles=False):
+    """Remove the duplicate Real World Value Mapping objects of all PET series
+    of the DICOM database, keeping the registered (or most recent) one.
+    Returns the removed files."""
+    return RWVMRegistry().pruneDuplicates(self, deleteFiles)
+
+
   def getReferencedSeriesInstanceUID(self, rwvmFile):
     """Helper method to read the Referenced Series Instance UID from an RWVM file"""
     if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
@@ -201,16 +559,488 @@ class DICOMPETSUVPluginClass(DICOMPlugin):
 
 
   def load(self,loadable):
-    """Load the series into Slicer"""
+    """Load the series into Slicer. Must be called on the main thread."""
+
+    if getattr(loadable, 'deferred', False):
+      loadable = self.resolveDeferredLoadable(loadable)
+    multiframe = getattr(loadable, 'multiframe', None) or self.seriesDimension(loadable.files)
 
     # Call the DICOMRWVMPlugin to get the image node
-    if self.multiframe==2:
+    if getattr(loadable, 'bedLoadables', None):
+      bedLoadables = [self.resolveDeferredLoadable(bedLoadable) if getattr(bedLoadable, 'deferred', False)
+                      else bedLoadable for bedLoadable in loadable.bedLoadables]
+      imageNode = self.rwvPlugin.loadPetBedPositions(loadable, bedLoadables)
+    elif getattr(loadable, 'preview', False):
+      imageNode = self.rwvPlugin.loadPetSeriesPreview(loadable,
+        sliceStep=slicer.util.settingsValue('DICOM/PETSUV/PreviewSliceStep', 4, converter=int),
+        inPlaneStep=slicer.util.settingsValue('DICOM/PETSUV/PreviewInPlaneStep', 2, converter=int))
+    elif multiframe == 2:
       imageNode = self.rwvPlugin.loadPetSeries(loadable)
     else:
       imageNode = self.rwvPlugin.loadPetMultiVolumeSeries(loadable)
+    if imageNode and self.prefetchEnabled():
+      self.prefetchPairedCT(loadable)
     return imageNode
 
 
+  def prefetchEnabled(self):
+    """Return True if the CT series paired with a loaded PET series is read in
+    the background (DICOM/PETSUV/PrefetchCT setting)"""
+    return slicer.util.settingsValue('DICOM/PETSUV/PrefetchCT', False, converter=slicer.util.toBool)
+
+
+  def findPairedCTSeries(self, petFiles):
+    """Return the CT series of the study of a PET series that share its frame
+    of reference. If none does, return the CT series of the study whose
+    series time is closest to the one of the PET series."""
+    studyUID = slicer.dicomDatabase.fileValue(petFiles[0], self.tags['studyInstanceUID'])
+    frameOfReferenceUID = slicer.dicomDatabase.fileValue(petFiles[0], self.tags['frameOfReferenceUID'])
+    ctSeries = []
+    ctSeriesTimes = []
+    sameFrameOfReference = []
+    for series in slicer.dicomDatabase.seriesForStudy(studyUID):
+      seriesFiles = slicer.dicomDatabase.filesForSeries(series)
+      if not seriesFiles or slicer.dicomDatabase.fileValue(seriesFiles[0], self.tags['seriesModality']) != self.ctTerm:
+        continue
+      ctSeries.append(series)
+      ctSeriesTimes.append(slicer.dicomDatabase.fileValue(seriesFiles[0], self.tags['seriesTime']).strip())
+      if frameOfReferenceUID and slicer.dicomDatabase.fileValue(seriesFiles[0], self.tags['frameOfReferenceUID']) == frameOfReferenceUID:
+        sameFrameOfReference.append(series)
+    if sameFrameOfReference or not ctSeries:
+      return sameFrameOfReference
+    petSeriesTime = slicer.dicomDatabase.fileValue(petFiles[0], self.tags['seriesTime']).strip()
+    timeDifferences = np.abs(CohortSUVFactors.timeToSeconds(ctSeriesTimes) -
+                             CohortSUVFactors.timeToSeconds([petSeriesTime])[0])
+    if np.all(np.isnan(timeDifferences)):
+      # no series times to compare
+      return ctSeries[:1]
+    return [ctSeries[int(np.nanargmin(timeDifferences))]]
+
+
+  def prefetchPairedCT(self, loadable):
+    """Read the files of the CT paired with a PET loadable on a background
+    thread, so that they are in the file system cache when the CT is loaded"""
+    for series in self.findPairedCTSeries(loadable.files):
+      SeriesPrefetcher.prefetch(series, slicer.dicomDatabase.filesForSeries(series))
+
+
+  def resampleToPairedCT(self, petNode, interpolation='linear'):
+    """Resample the SUV of a loaded PET volume onto the grid of the loaded CT
+    volume paired with it (see findPairedCTSeries). Returns None if no paired
+    CT volume is in the scene."""
+    instanceUIDs = (petNode.GetAttribute("DICOM.instanceUIDs") or "").split()
+    petFile = slicer.dicomDatabase.fileForInstance(instanceUIDs[0]) if instanceUIDs else None
+    if not petFile:
+      return None
+    ctInstanceUIDs = {}
+    for series in self.findPairedCTSeries([petFile]):
+      for instanceUID in slicer.dicomDatabase.instancesForSeries(series):
+        ctInstanceUIDs[instanceUID] = series
+    for ctNode in slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode'):
+      nodeInstanceUIDs = (ctNode.GetAttribute("DICOM.instanceUIDs") or "").split()
+      if nodeInstanceUIDs and nodeInstanceUIDs[0] in ctInstanceUIDs:
+        return self.rwvPlugin.resampleToCT(petNode, ctNode, interpolation)
+    return None
+
+
+#
+# RWVMRegistry
+#
+
+class RWVMRegistry:
+  """ Registry of the RWVM files generated for PET series, keyed by the
+  SeriesInstanceUID and a hash of the header inputs of the SUV factors, so
+  that generating the mapping of a series again returns the existing file.
+  Enabled unless the DICOM/PETSUV/RWVMRegistry/Enabled setting is false.
+  """
+
+  settingsPrefix = 'DICOM/PETSUV/RWVMRegistry'
+  lock = threading.Lock()
+
+  # header inputs of SUVFactorCalculator, the radiopharmaceutical ones are
+  # read from the first item of the Radiopharmaceutical Information Sequence
+  inputKeywords = ['PatientWeight', 'PatientSize', 'PatientSex', 'Units', 'CorrectedImage',
+    'DecayCorrection', 'DecayFactor', 'FrameReferenceTime', 'SeriesDate', 'SeriesTime',
+    'AcquisitionDate', 'AcquisitionTime']
+  radiopharmaceuticalKeywords = ['RadiopharmaceuticalStartTime', 'RadiopharmaceuticalStartDateTime',
+    'RadionuclideTotalDose', 'RadionuclideHalfLife', 'RadionuclidePositronFraction']
+
+  def __init__(self, path=None):
+    if path is None:
+      path = slicer.util.settingsValue(self.settingsPrefix+'/Path', '')
+      if not path:
+        directory = slicer.dicomDatabase.databaseDirectory if slicer.dicomDatabase else ''
+        path = os.path.join(directory or slicer.app.cachePath, 'PETSUVRWVMRegistry.json')
+    self.path = path
+
+  @classmethod
+  def isEnabled(cls):
+    return slicer.util.settingsValue(cls.settingsPrefix+'/Enabled', True, converter=slicer.util.toBool)
+
+  def inputsHash(self, fileList):
+    """Return a hash of the SUV relevant header values of a PET series"""
+    if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+      header = pydicom.dcmread(fileList[0], stop_before_pixels=True)
+    else:
+      header = dicom.read_file(fileList[0], stop_before_pixels=True)
+    inputs = {keyword: str(header.get(keyword, '')) for keyword in self.inputKeywords}
+    radiopharmaceuticalSequence = header.get('RadiopharmaceuticalInformationSequence', None)
+    radiopharmaceutical = radiopharmaceuticalSequence[0] if radiopharmaceuticalSequence else {}
+    for keyword in self.radiopharmaceuticalKeywords:
+      inputs[keyword] = str(radiopharmaceutical.get(keyword, ''))
+    # the instances of the series, a changed or incomplete series gets a new mapping
+    inputs['SOPInstanceUIDs'] = sorted(slicer.dicomDatabase.fileValue(f, "0008,0018") for f in fileList)
+    sha = hashlib.sha1()
+    sha.update(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
+  def read(self):
+    try:
+      with open(self.path) as registryFile:
+        return json.load(registryFile)
+    except FileNotFoundError:
+      return {}
+    except (OSError, ValueError) as e:
+      logging.warning(f"Ignoring invalid RWVM registry {self.path}: {str(e)}")
+      return {}
+
+  def write(self, entries):
+    directory = os.path.dirname(self.path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    temporaryPath = self.path + '.tmp'
+    with open(temporaryPath, 'w') as registryFile:
+      json.dump(entries, registryFile, indent=1, sort_keys=True)
+    os.replace(temporaryPath, self.path)
+
+  def lookup(self, seriesInstanceUID, inputsHash):
+    """Return the registered RWVM file for the series and inputs if it still exists"""
+    with self.lock:
+      rwvmFile = self.read().get(seriesInstanceUID, {}).get(inputsHash)
+    if rwvmFile and os.path.exists(rwvmFile):
+      return rwvmFile
+    return None
+
+  def register(self, seriesInstanceUID, inputsHash, rwvmFile):
+    with self.lock:
+      entries = self.read()
+      entries.setdefault(seriesInstanceUID, {})[inputsHash] = rwvmFile
+      self.write(entries)
+
+  def findDuplicates(self, plugin):
+    """Return {PET SeriesInstanceUID: (kept RWVM file, [duplicate RWVM files])}
+    for the PET series of the DICOM database with more than one RWVM. The
+    registered file is kept, or the most recent one if none is registered."""
+    rwvmFilesBySeries = {}
+    for patient in slicer.dicomDatabase.patients():
+      for study in slicer.dicomDatabase.studiesForPatient(patient):
+        for series in slicer.dicomDatabase.seriesForStudy(study):
+          for seriesFile in slicer.dicomDatabase.filesForSeries(series):
+            if slicer.dicomDatabase.fileValue(seriesFile, plugin.tags['seriesModality']) != "RWV":
+              break
+            try:
+              referencedSeries = plugin.getReferencedSeriesInstanceUID(seriesFile)
+            except (AttributeError, IndexError) as e:
+              logging.debug(f"Skipping RWVM {seriesFile}: {str(e)}")
+              continue
+            rwvmFilesBySeries.setdefault(referencedSeries, []).append(seriesFile)
+
+    with self.lock:
+      entries = self.read()
+    duplicates = {}
+    for seriesInstanceUID, rwvmFiles in rwvmFilesBySeries.items():
+      if len(rwvmFiles) < 2:
+        continue
+      registeredFiles = set(entries.get(seriesInstanceUID, {}).values())
+      registered = [f for f in rwvmFiles if f in registeredFiles]
+      kept = registered[0] if registered else max(rwvmFiles, key=os.path.getmtime)
+      duplicates[seriesInstanceUID] = (kept, [f for f in rwvmFiles if f != kept])
+    return duplicates
+
+  def pruneDuplicates(self, plugin, deleteFiles=False):
+    """Remove duplicate RWVMs of PET series from the DICOM database, and from
+    disk if deleteFiles is set. Returns the removed files."""
+    removedFiles = []
+    for seriesInstanceUID, (kept, duplicateFiles) in self.findDuplicates(plugin).items():
+      for rwvmFile in duplicateFiles:
+        rwvmSeries = slicer.dicomDatabase.fileValue(rwvmFile, plugin.tags['seriesInstanceUID'])
+        slicer.dicomDatabase.removeSeries(rwvmSeries)
+        if deleteFiles and os.path.exists(rwvmFile):
+          os.remove(rwvmFile)
+        removedFiles.append(rwvmFile)
+      logging.info(f"Kept RWVM {kept} of series {seriesInstanceUID}, removed {len(duplicateFiles)} duplicates")
+    return removedFiles
+
+
+#
+# CohortSUVFactors
+#
+
+class CohortSUVFactors:
+  """ SUVbw/lbm/bsa/ibw conversion factors of all PET series of a DICOM
+  database, computed from one header per series as NumPy column operations
+  that follow DecayCorrection and ComputeSUV of the SUVFactorCalculator CLI.
+  No RWVM objects are written. Header values come from the tag cache of the
+  DICOM database, all tags are also tags of DICOMPETSUVPluginClass and so
+  precached. Use it from the main thread.
+
+    columns, failures = CohortSUVFactors().table()
+
+  columns maps the column names to arrays with one entry per PET series
+  (NaN where a factor cannot be computed), failures maps the
+  SeriesInstanceUID of each series without factors to the reason.
+  """
+
+  headerTags = {'SeriesInstanceUID': "0020,000E", 'StudyInstanceUID': "0020,000D", 'PatientID': "0010,0020",
+    'PatientWeight': "0010,1030", 'PatientSize': "0010,1020", 'PatientSex': "0010,0040", 'Units': "0054,1001",
+    'CorrectedImage': "0028,0051", 'DecayCorrection': "0054,1102", 'FrameReferenceTime': "0054,1300",
+    'SeriesTime': "0008,0031", 'RadiopharmaceuticalStartTime': "0018,1072", 'RadionuclideTotalDose': "0018,1074",
+    'RadionuclideHalfLife': "0018,1075"}
+  # nested in the Radiopharmaceutical Information Sequence, read from the file
+  # if the database does not return them
+  radiopharmaceuticalKeywords = ['RadiopharmaceuticalStartTime', 'RadionuclideTotalDose', 'RadionuclideHalfLife']
+
+  # kBq per unit of the injected dose, the unit is derived from the Units of the image
+  radioactivityUnitsToKBq = [('BQML', 0.001), ('MBq', 1000.0), ('MBQ', 1000.0), ('kBq', 1.0), ('kBQ', 1.0),
+    ('KBQ', 1.0), ('mBq', 0.000001), ('mBQ', 0.000001), ('uBq', 0.000000001), ('uBQ', 0.000000001),
+    ('Bq', 0.001), ('BQ', 0.001), ('MCi', 37000000000000.0), ('MCI', 37000000000000.0),
+    ('kCi', 37000000000.0), ('kCI', 37000000000.0), ('KCI', 37000000000.0), ('mCi', 37000.0),
+    ('mCI', 37000.0), ('uCi', 37.0), ('uCI', 37.0), ('Ci', 37000000.0), ('CI', 37000000.0)]
+
+  def __init__(self, numberOfThreads=8):
+    self.numberOfThreads = numberOfThreads
+
+  def petSeriesFiles(self):
+    """Return {SeriesInstanceUID: first file} of the PET series of the database"""
+    seriesFiles = {}
+    for patient in slicer.dicomDatabase.patients():
+      for study in slicer.dicomDatabase.studiesForPatient(patient):
+        for series in slicer.dicomDatabase.seriesForStudy(study):
+          files = slicer.dicomDatabase.filesForSeries(series)
+          if files and slicer.dicomDatabase.fileValue(files[0], "0008,0060") == "PT":
+            seriesFiles[series] = files[0]
+    return seriesFiles
+
+  def readCachedHeader(self, fileName):
+    """Return the SUV relevant header values of a file as strings, as cached
+    by the DICOM database"""
+    return {keyword: slicer.dicomDatabase.fileValue(fileName, tag).strip() for keyword, tag in self.headerTags.items()}
+
+  def isIncomplete(self, values):
+    return not all(values[keyword] for keyword in self.radiopharmaceuticalKeywords)
+
+  def readRadiopharmaceutical(self, fileName):
+    """Return the values of the first Radiopharmaceutical Information
+    Sequence item of a file as strings. Does not use the DICOM database."""
+    if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+      header = pydicom.dcmread(fileName, stop_before_pixels=True,
+                               specific_tags=['RadiopharmaceuticalInformationSequence'])
+    else:
+      header = dicom.read_file(fileName, stop_before_pixels=True)
+    radiopharmaceuticalSequence = header.get('RadiopharmaceuticalInformationSequence', None)
+    radiopharmaceutical = radiopharmaceuticalSequence[0] if radiopharmaceuticalSequence else {}
+    return {keyword: str(radiopharmaceutical.get(keyword, '')).strip() for keyword in self.radiopharmaceuticalKeywords}
+
+  def readHeader(self, fileName):
+    """Return the SUV relevant header values of a file as strings"""
+    values = self.readCachedHeader(fileName)
+    if self.isIncomplete(values):
+      for keyword, value in self.readRadiopharmaceutical(fileName).items():
+        values[keyword] = values[keyword] or value
+    return values
+
+  def readHeaders(self, seriesFiles):
+    """Return one column (list of strings) per header keyword, and the
+    failures of the series whose header cannot be read. The database is only
+    queried on the calling thread, the radiopharmaceutical values it does not
+    return are read from the files on a thread pool."""
+    headers = {seriesInstanceUID: self.readCachedHeader(fileName) for seriesInstanceUID, fileName in seriesFiles.items()}
+    incompleteUIDs = [seriesInstanceUID for seriesInstanceUID, values in headers.items() if self.isIncomplete(values)]
+    def read(seriesInstanceUID):
+      try:
+        return self.readRadiopharmaceutical(seriesFiles[seriesInstanceUID])
+      except Exception as e:
+        return e
+    failures = {}
+    with ThreadPoolExecutor(max_workers=self.numberOfThreads) as executor:
+      for seriesInstanceUID, radiopharmaceutical in zip(incompleteUIDs, executor.map(read, incompleteUIDs)):
+        if isinstance(radiopharmaceutical, Exception):
+          failures[seriesInstanceUID] = f"Cannot read header: {str(radiopharmaceutical)}"
+          del headers[seriesInstanceUID]
+          continue
+        values = headers[seriesInstanceUID]
+        for keyword, value in radiopharmaceutical.items():
+          values[keyword] = values[keyword] or value
+
+    columns = {keyword: [values[keyword] for values in headers.values()] for keyword in self.headerTags}
+    return columns, failures
+
+  @staticmethod
+  def correctionFailure(correctedImage, decayCorrection):
+    """Return why a PET series with these CorrectedImage and DecayCorrection
+    values cannot be converted to SUV, None if it can. Pixel values of START
+    and ADMIN series are decay corrected (DECY), those of NONE series are not."""
+    if not correctedImage:
+      return "No corrected image"
+    if 'ATTN' not in correctedImage:
+      return "No attenuation correction"
+    if decayCorrection not in ['START', 'ADMIN', 'NONE']:
+      return "Decay correction is not START, ADMIN or NONE"
+    if ('DECY' in correctedImage or 'DECAY' in correctedImage) != (decayCorrection != 'NONE'):
+      return f"Decay correction {decayCorrection} does not match corrected image {correctedImage}"
+    return None
+
+  @staticmethod
+  def timeToSeconds(times):
+    """Convert DICOM TM strings (hhmmss.frac) to seconds, NaN if empty"""
+    seconds = np.full(len(times), np.nan)
+    for i, time in enumerate(times):
+      if time:
+        hours = float(time[0:2] or 0)
+        minutes = float(time[2:4] or 0)
+        seconds[i] = float(time[4:] or 0) + 60.0*minutes + 3600.0*hours
+    return seconds
+
+  @staticmethod
+  def toFloat(values):
+    """Convert DS strings to floats, NaN if empty or invalid"""
+    result = np.full(len(values), np.nan)
+    for i, value in enumerate(values):
+      try:
+        result[i] = float(value)
+      except ValueError:
+        pass
+    return result
+
+  @classmethod
+  def computeFactors(cls, columns):
+    """Return the conversion factor columns and {row: failure reason} for
+    header columns as returned by readHeaders"""
+    n = len(columns['SeriesInstanceUID'])
+    dose = cls.toFloat(columns['RadionuclideTotalDose'])
+    weight = cls.toFloat(columns['PatientWeight'])
+    height = cls.toFloat(columns['PatientSize'])*100.0 # cm
+    halfLife = cls.toFloat(columns['RadionuclideHalfLife'])
+    frameReferenceTime = np.nan_to_num(cls.toFloat(columns['FrameReferenceTime']))
+    seriesTime = cls.timeToSeconds(columns['SeriesTime'])
+    injectionTime = cls.timeToSeconds(columns['RadiopharmaceuticalStartTime'])
+    decayCorrection = np.array(columns['DecayCorrection'], dtype=object)
+    sex = np.array(columns['PatientSex'], dtype=object)
+
+    # injected dose in kBq, the units of the dose are those of the image (MBq if none)
+    unitsToKBq = np.ones(n)
+    for i, units in enumerate(columns['Units']):
+      if not units:
+        unitsToKBq[i] = 1000.0
+        continue
+      for unitsName, factor in cls.radioactivityUnitsToKBq:
+        if unitsName in units:
+          unitsToKBq[i] = factor
+          break
+    dose = dose*unitsToKBq
+
+    # decay to the time the pixel values are corrected to
+    scanTime = seriesTime + np.where(decayCorrection == 'NONE', frameReferenceTime/1000.0, 0.0)
+    decayedDose = np.where(decayCorrection == 'ADMIN', dose, dose*np.power(2.0, -(scanTime-injectionTime)/halfLife))
+
+    failures = {}
+    def fail(rows, reason):
+      for row in np.nonzero(rows)[0]:
+        failures.setdefault(int(row), reason)
+    correctedImage = columns['CorrectedImage']
+    fail(np.isnan(dose) | (dose == 0.0), "Missing injected dose")
+    fail(np.isnan(weight) | (weight == 0.0), "Missing patient weight")
+    fail(np.isnan(seriesTime), "Missing series time")
+    fail(np.isnan(injectionTime), "Missing radiopharmaceutical start time")
+    fail(np.isnan(halfLife), "Missing radionuclide half life")
+    for row, (rowCorrectedImage, rowDecayCorrection) in enumerate(zip(correctedImage, decayCorrection)):
+      correctionFailure = cls.correctionFailure(rowCorrectedImage, rowDecayCorrection)
+      if correctionFailure:
+        failures.setdefault(row, correctionFailure)
+    fail(~np.isfinite(decayedDose) | (decayedDose == 0.0), "Got 0.0 decayed dose")
+
+    valid = np.ones(n, dtype=bool)
+    valid[list(failures.keys())] = False
+    hasHeight = valid & ~np.isnan(height) & (height != 0.0)
+    male = hasHeight & (sex == 'M')
+    female = hasHeight & (sex == 'F')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      bodySurfaceArea = np.power(weight, 0.425)*np.power(height, 0.725)*0.007184
+      leanBodyMass = np.where(male, 1.10*weight - 128.0*(weight/height)**2, 1.07*weight - 148.0*(weight/height)**2)
+      idealBodyMass = np.minimum(np.where(male, 48.0 + 1.06*(height-152.0), 45.5 + 0.91*(height-152.0)), weight)
+      factors = {
+        'SUVbwConversionFactor': np.where(valid, weight/decayedDose, np.nan),
+        'SUVbsaConversionFactor': np.where(hasHeight, bodySurfaceArea/decayedDose, np.nan),
+        'SUVlbmConversionFactor': np.where(male | female, leanBodyMass/decayedDose, np.nan),
+        'SUVibwConversionFactor': np.where(male | female, idealBodyMass/decayedDose, np.nan),
+        'decayedDose': np.where(valid, decayedDose, np.nan),
+        }
+    return factors, failures
+
+  def table(self):
+    """Return (columns, failures) for all PET series of the DICOM database"""
+    columns, failures = self.readHeaders(self.petSeriesFiles())
+    factors, rowFailures = self.computeFactors(columns)
+    for row, reason in rowFailures.items():
+      failures[columns['SeriesInstanceUID'][row]] = reason
+    columns.update(factors)
+    return columns, failures
+
+
+#
+# SeriesPrefetcher
+#
+
+class SeriesPrefetcher:
+  """Read all files of a series once on a daemon thread to warm the file
+  system cache. Each series is prefetched at most once per scene, closing
+  the scene forgets the prefetched series."""
+
+  chunkSize = 1024*1024
+  prefetchedSeries = set()
+  lock = threading.Lock()
+  sceneObserverTag = None
+
+  @classmethod
+  def prefetch(cls, seriesInstanceUID, files):
+    if cls.sceneObserverTag is None:
+      cls.sceneObserverTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, cls.onSceneEndClose)
+    with cls.lock:
+      if seriesInstanceUID in cls.prefetchedSeries:
+        return
+      cls.prefetchedSeries.add(seriesInstanceUID)
+    worker = threading.Thread(target=cls.readFiles, args=(seriesInstanceUID, list(files)), name='PETSUVPrefetch')
+    worker.daemon = True
+    worker.start()
+
+  @classmethod
+  def readFiles(cls, seriesInstanceUID, files):
+    bytesRead = 0
+    for seriesFile in files:
+      try:
+        with open(seriesFile, 'rb') as f:
+          while True:
+            chunk = f.read(cls.chunkSize)
+            if not chunk:
+              break
+            bytesRead += len(chunk)
+      except OSError as e:
+        logging.debug(f"Prefetch of {seriesFile} failed: {str(e)}")
+    logging.debug(f"Prefetched {len(files)} files ({bytesRead} bytes) of series {seriesInstanceUID}")
+
+  @classmethod
+  def onSceneEndClose(cls, caller, event):
+    cls.reset()
+
+  @classmethod
+  def reset(cls):
+    """Forget the prefetched series, their files may be evicted from the
+    file system cache before they are loaded in the next scene"""
+    with cls.lock:
+      cls.prefetchedSeries.clear()
+
+
 #
 # DICOMPETSUVPlugin
 #
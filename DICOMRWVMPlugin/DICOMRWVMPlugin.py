@@ -12,7 +12,15 @@ else:
 
 import DICOMLib
 
+import copy
+import datetime
 import math as math
+import json
+import hashlib
+import numpy as np
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 class CodedValueTuple:
   def __init__(self, CodeValue=None, CodeMeaning=None, CodingSchemeDesignator=None):
@@ -23,6 +31,498 @@ class CodedValueTuple:
   def getDictionary(self):
     return {"CodeValue":self.CodeValue, "CodeMeaning":self.CodeMeaning, "CodingSchemeDesignator":self.CodingSchemeDesignator}
 
+class RealWorldValueMappingItem:
+  """ One item of a RealWorldValueMappingSequence: either a linear
+  slope/intercept mapping or a LUT over [firstValueMapped, lastValueMapped]
+  """
+  def __init__(self, firstValueMapped=None, lastValueMapped=None, slope=None, intercept=0.0, lutData=None):
+    self.firstValueMapped = firstValueMapped
+    self.lastValueMapped = lastValueMapped
+    self.slope = slope
+    self.intercept = intercept
+    self.lutData = lutData
+
+  @classmethod
+  def fromDataset(cls, item):
+    lutData = getattr(item, 'RealWorldValueLUTData', None)
+    if lutData is not None:
+      lutData = np.asarray(lutData, dtype=np.float64).ravel()
+    slope = getattr(item, 'RealWorldValueSlope', None)
+    return cls(firstValueMapped=getattr(item, 'RealWorldValueFirstValueMapped', None),
+               lastValueMapped=getattr(item, 'RealWorldValueLastValueMapped', None),
+               slope=float(slope) if slope is not None else None,
+               intercept=float(getattr(item, 'RealWorldValueIntercept', 0.0) or 0.0),
+               lutData=lutData)
+
+  def isLinear(self):
+    return self.lutData is None
+
+  def valueRange(self):
+    """Return the inclusive range of stored values mapped by this item"""
+    first = self.firstValueMapped
+    last = self.lastValueMapped
+    if first is None:
+      first = 0
+    if last is None:
+      last = first + len(self.lutData) - 1 if self.lutData is not None else first
+    return (int(first), int(last))
+
+#
+# On-disk cache of decoded PET voxels, so that compressed (e.g. JPEG2000 or
+# JPEG-LS) series do not have to be decompressed again every time a study is
+# reopened.  Entries hold the stored (not yet SUV scaled) voxels of an already
+# sorted file list as a raw buffer plus a JSON header with the geometry, the
+# node attributes and the loader warnings, and the acquisition transform of
+# the volume, if there is any.
+#
+
+class DecodedVolumeCache:
+  """ LRU cache of decoded volumes keyed by the series, the transfer syntax
+  and the ordered files (path, size and modification time) of a volume.
+  Volumes created from a cache hit use a copy-on-write memory map of the
+  cached buffer as their voxels. Opt-in through the
+  DICOM/PETSUV/DecodedVolumeCache/* application settings.
+  """
+
+  settingsPrefix = 'DICOM/PETSUV/DecodedVolumeCache'
+
+  def __init__(self, directory=None, maxSizeMB=None):
+    if directory is None:
+      directory = slicer.util.settingsValue(self.settingsPrefix+'/Directory', '')
+      if not directory:
+        directory = os.path.join(slicer.app.cachePath, 'PETSUVDecodedVolumes')
+    if maxSizeMB is None:
+      maxSizeMB = slicer.util.settingsValue(self.settingsPrefix+'/MaxSizeMB', 4096, converter=int)
+    self.directory = directory
+    self.maxSizeBytes = int(maxSizeMB)*1024*1024
+    if not os.path.exists(self.directory):
+      os.makedirs(self.directory)
+
+  @classmethod
+  def isEnabled(cls):
+    return slicer.util.settingsValue(cls.settingsPrefix+'/Enabled', False, converter=slicer.util.toBool)
+
+  def keyForFiles(self, files, variant=''):
+    """Return the cache key for an already sorted list of DICOM files. Only
+    the header of the first file is read, the other files are identified by
+    their path, size and modification time, without database queries.
+    variant distinguishes loaders that decode the same files differently."""
+    if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+      header = pydicom.dcmread(files[0], stop_before_pixels=True)
+    else:
+      header = dicom.read_file(files[0], stop_before_pixels=True)
+    sha = hashlib.sha1()
+    sha.update(variant.encode('utf-8'))
+    sha.update(b'\\')
+    sha.update(str(getattr(header, 'SeriesInstanceUID', '')).encode('utf-8'))
+    sha.update(b'\\')
+    sha.update(str(header.file_meta.get('TransferSyntaxUID', '')).encode('utf-8'))
+    for dicomFile in files:
+      fileStat = os.stat(dicomFile)
+      sha.update(f"\\{dicomFile}|{fileStat.st_size}|{fileStat.st_mtime_ns}".encode('utf-8'))
+    return sha.hexdigest()
+
+  def __paths(self, key):
+    base = os.path.join(self.directory, key)
+    return (base+'.raw', base+'.json', base+'.transform.h5')
+
+  def get(self, key):
+    """Return (voxels, header) for a cache hit, otherwise None. The voxels
+    are a copy-on-write memory map of the cached buffer."""
+    rawPath, headerPath, transformPath = self.__paths(key)
+    if not (os.path.exists(rawPath) and os.path.exists(headerPath)):
+      return None
+    try:
+      with open(headerPath) as headerFile:
+        header = json.load(headerFile)
+      dtype = np.dtype(header['dtype'])
+      shape = tuple(header['shape'])
+      if os.path.getsize(rawPath) != int(np.prod(shape))*dtype.itemsize:
+        raise ValueError("size mismatch")
+      if header.get('transform') and not os.path.exists(transformPath):
+        raise ValueError("missing acquisition transform")
+      voxels = np.memmap(rawPath, dtype=dtype, mode='c', shape=shape)
+      header['transformFile'] = transformPath if header.get('transform') else ''
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      logging.warning(f"Discarding invalid decoded volume cache entry {key}: {str(e)}")
+      self.remove(key)
+      return None
+    # mark as most recently used
+    os.utime(rawPath, None)
+    return (voxels, header)
+
+  def put(self, key, volumeNode, warning=''):
+    """Store the voxels, geometry, attributes and acquisition transform of a
+    volume node, and the warning of the loader that created it"""
+    voxels = slicer.util.arrayFromVolume(volumeNode)
+    if voxels is None:
+      return
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    rawPath, headerPath, transformPath = self.__paths(key)
+    transformNode = volumeNode.GetParentTransformNode()
+    header = {
+      'dtype': voxels.dtype.str,
+      'shape': list(voxels.shape),
+      'ijkToRAS': [ijkToRAS.GetElement(row,column) for row in range(4) for column in range(4)],
+      'attributes': {name: volumeNode.GetAttribute(name) for name in volumeNode.GetAttributeNames()},
+      'warning': warning or '',
+      'transform': transformNode is not None,
+      }
+    try:
+      np.ascontiguousarray(voxels).tofile(rawPath+'.tmp')
+      os.replace(rawPath+'.tmp', rawPath)
+      if transformNode:
+        storageNode = transformNode.CreateDefaultStorageNode()
+        storageNode.SetFileName(transformPath)
+        if not storageNode.WriteData(transformNode):
+          raise OSError("cannot write the acquisition transform")
+      with open(headerPath+'.tmp', 'w') as headerFile:
+        json.dump(header, headerFile)
+      os.replace(headerPath+'.tmp', headerPath)
+    except OSError as e:
+      logging.warning(f"Failed to write decoded volume cache entry {key}: {str(e)}")
+      self.remove(key)
+      return
+    self.evict()
+
+  def remove(self, key):
+    for path in self.__paths(key):
+      for candidate in (path, path+'.tmp'):
+        if os.path.exists(candidate):
+          try:
+            os.remove(candidate)
+          except OSError as e:
+            # still memory mapped by a loaded volume on some platforms
+            logging.debug(f"Cannot remove decoded volume cache file {candidate}: {str(e)}")
+
+  def evict(self):
+    """Remove least recently used entries until the cache fits its size cap"""
+    entries = []
+    totalSize = 0
+    for fileName in os.listdir(self.directory):
+      if not fileName.endswith('.raw'):
+        continue
+      key = fileName[:-len('.raw')]
+      size = sum(os.path.getsize(path) for path in self.__paths(key) if os.path.exists(path))
+      entries.append((os.path.getmtime(self.__paths(key)[0]), size, key))
+      totalSize += size
+    for (lastUsed, size, key) in sorted(entries):
+      if totalSize <= self.maxSizeBytes:
+        break
+      self.remove(key)
+      totalSize -= size
+
+  def createVolumeNode(self, entry, name):
+    """Create a scalar volume node from a cache hit returned by get(). The
+    image data of the node uses the memory map of the entry as its buffer."""
+    (voxels, header) = entry
+    imageNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    for index, value in enumerate(header['ijkToRAS']):
+      ijkToRAS.SetElement(index//4, index%4, value)
+    imageNode.SetIJKToRASMatrix(ijkToRAS)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(voxels.shape[::-1])
+    # the vtk array keeps a reference to the memory map instead of copying it
+    imageData.GetPointData().SetScalars(vtk.util.numpy_support.numpy_to_vtk(voxels.reshape(-1), deep=False))
+    imageNode.SetAndObserveImageData(imageData)
+    for attributeName, value in header.get('attributes', {}).items():
+      imageNode.SetAttribute(attributeName, value)
+    imageNode.CreateDefaultDisplayNodes()
+    if header.get('transformFile'):
+      transformNode = slicer.util.loadTransform(header['transformFile'])
+      imageNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    if header.get('warning'):
+      logging.warning(f"{name}: {header['warning']}")
+    return imageNode
+
+#
+# Memory budget of the voxel buffers of loaded PET volumes. Volumes and
+# frames that are not shown are released when the budget is exceeded and
+# read again from their DICOM files (through the decoded volume cache, if
+# enabled) when they are shown or their voxels are needed.
+#
+
+class SUVMemoryBudget:
+  """ Accounting of the voxel buffers of PET volumes and volume sequence
+  frames loaded by DICOMRWVMPluginClass. If the buffers exceed the
+  DICOM/PETSUV/MemoryBudget/MaxSizeMB setting (0: no budget, the default),
+  the least recently shown volumes that are not in a slice view, and frames
+  of volume sequences that are not selected in their browser, are released.
+  Volumes that are volume rendered or referenced by another node of the scene
+  are in use like the volumes of slice views. A released node keeps its
+  geometry and attributes, its image data is rematerialized from the sorted
+  file list and the real world value mapping when it is shown again or
+  ensureLoaded() is called. Closing the scene resets the accounting.
+  """
+
+  settingsPrefix = 'DICOM/PETSUV/MemoryBudget'
+  keyAttribute = "DICOM.PETSUV.MemoryBudget.Key"
+  releasedAttribute = "DICOM.PETSUV.MemoryBudget.Released"
+
+  # key -> record of a tracked buffer, the key is the node ID of volumes and
+  # "<sequence node ID>|<index value>" for frames of volume sequences
+  records = {}
+  lock = threading.RLock()
+  lastUse = 0
+  # (node, observer tag) of the observed slice composite, volume rendering
+  # display and browser nodes
+  observations = {}
+  sceneObserverTag = None
+
+  @classmethod
+  def maxSizeBytes(cls):
+    return slicer.util.settingsValue(cls.settingsPrefix+'/MaxSizeMB', 0, converter=int)*1024*1024
+
+  @classmethod
+  def isEnabled(cls):
+    return cls.maxSizeBytes() > 0
+
+  @classmethod
+  def trackVolume(cls, rwvmPlugin, volumeNode, loadable, conversionFactor, bedLoadables=None):
+    """Track the voxels of a PET volume loaded from loadable.files, or of
+    the bed positions of a whole body loadable"""
+    if not cls.isEnabled():
+      return
+    cls.track(volumeNode.GetID(), volumeNode, rwvmPlugin, loadable, loadable.files, conversionFactor, frame=False,
+              bedLoadables=bedLoadables)
+    cls.enforce()
+
+  @classmethod
+  def trackFrame(cls, rwvmPlugin, volumeSequenceNode, indexValue, loadable, frameFiles, conversionFactor):
+    """Track the voxels of a frame of a volume sequence"""
+    if not cls.isEnabled():
+      return
+    dataNode = volumeSequenceNode.GetDataNodeAtValue(indexValue)
+    if dataNode is None:
+      return
+    key = volumeSequenceNode.GetID() + '|' + indexValue
+    cls.track(key, dataNode, rwvmPlugin, loadable, frameFiles, conversionFactor, frame=True)
+
+  @classmethod
+  def track(cls, key, node, rwvmPlugin, loadable, files, conversionFactor, frame, bedLoadables=None):
+    node.SetAttribute(cls.keyAttribute, key)
+    with cls.lock:
+      cls.lastUse += 1
+      cls.records[key] = {
+        'rwvmPlugin': rwvmPlugin,
+        'loadable': loadable,
+        'files': list(files),
+        'conversionFactor': conversionFactor,
+        'frame': frame,
+        'bedLoadables': bedLoadables,
+        'lastUse': cls.lastUse,
+        }
+
+  @classmethod
+  def node(cls, key):
+    """Return the tracked node of a key, None if it was removed from the scene"""
+    (nodeID, separator, indexValue) = key.partition('|')
+    node = slicer.mrmlScene.GetNodeByID(nodeID)
+    if node is None or not separator:
+      return node
+    return node.GetDataNodeAtValue(indexValue)
+
+  @classmethod
+  def bufferSize(cls, node):
+    imageData = node.GetImageData()
+    return imageData.GetActualMemorySize()*1024 if imageData else 0
+
+  @classmethod
+  def shownKeys(cls):
+    """Keys of the volumes in slice views, of volume rendered and referenced
+    volumes and of the selected sequence frames"""
+    shown = set()
+    for compositeNode in slicer.util.getNodesByClass('vtkMRMLSliceCompositeNode'):
+      for volumeID in (compositeNode.GetBackgroundVolumeID(), compositeNode.GetForegroundVolumeID(),
+                       compositeNode.GetLabelVolumeID()):
+        if volumeID:
+          shown.add(volumeID)
+    for displayNode in slicer.util.getNodesByClass('vtkMRMLVolumeRenderingDisplayNode'):
+      if displayNode.GetVolumeNodeID():
+        shown.add(displayNode.GetVolumeNodeID())
+    # e.g. the reference geometry of a segmentation or the active volume
+    for index in range(slicer.mrmlScene.GetNumberOfNodes()):
+      node = slicer.mrmlScene.GetNthNode(index)
+      for roleIndex in range(node.GetNumberOfNodeReferenceRoles()):
+        role = node.GetNthNodeReferenceRole(roleIndex)
+        for referenceIndex in range(node.GetNumberOfNodeReferences(role)):
+          referencedID = node.GetNthNodeReferenceID(role, referenceIndex)
+          if referencedID and referencedID != node.GetID():
+            shown.add(referencedID)
+    for browserNode in slicer.util.getNodesByClass('vtkMRMLSequenceBrowserNode'):
+      sequenceNode = browserNode.GetMasterSequenceNode()
+      itemNumber = browserNode.GetSelectedItemNumber()
+      if sequenceNode and 0 <= itemNumber < sequenceNode.GetNumberOfDataNodes():
+        shown.add(sequenceNode.GetID() + '|' + sequenceNode.GetNthIndexValue(itemNumber))
+    return shown
+
+  @classmethod
+  def enforce(cls, keep=()):
+    """Release the least recently shown buffers that are not shown (or in
+    keep) until the tracked buffers fit the budget"""
+    if not cls.isEnabled():
+      return
+    cls.observeViews()
+    shown = cls.shownKeys()
+    with cls.lock:
+      candidates = []
+      totalSize = 0
+      for key, record in list(cls.records.items()):
+        node = cls.node(key)
+        if node is None or node.GetAttribute(cls.keyAttribute) != key:
+          # removed, or its ID now belongs to another node
+          del cls.records[key]
+          continue
+        size = cls.bufferSize(node)
+        totalSize += size
+        if key in shown or key in keep:
+          # shown buffers count against the budget but are never released
+          cls.lastUse += 1
+          record['lastUse'] = cls.lastUse
+          continue
+        if size:
+          candidates.append((record['lastUse'], key, node, size))
+      maxSizeBytes = cls.maxSizeBytes()
+      for (lastUse, key, node, size) in sorted(candidates):
+        if totalSize <= maxSizeBytes:
+          break
+        logging.debug(f"Releasing the voxels of {node.GetName()} ({size} bytes) to fit the PET memory budget")
+        node.SetAttribute(cls.releasedAttribute, "1")
+        node.SetAndObserveImageData(None)
+        totalSize -= size
+
+  @classmethod
+  def ensureLoaded(cls, node):
+    """Rematerialize the voxels of a released node, no-op for other nodes"""
+    if node is None or not node.GetAttribute(cls.releasedAttribute):
+      return node
+    key = node.GetAttribute(cls.keyAttribute)
+    with cls.lock:
+      record = cls.records.get(key)
+      if record is None:
+        raise OSError(f"Cannot rematerialize {node.GetName()}, it is not tracked anymore")
+      cls.lastUse += 1
+      record['lastUse'] = cls.lastUse
+      imageData = cls.readVoxels(node, record)
+      node.SetAndObserveImageData(imageData)
+      node.RemoveAttribute(cls.releasedAttribute)
+    if record['frame']:
+      # the proxy node of a selected frame still holds the released buffer
+      sequenceNode = slicer.mrmlScene.GetNodeByID(key.partition('|')[0])
+      browserNode = slicer.modules.sequences.logic().GetFirstBrowserNodeForSequenceNode(sequenceNode)
+      if browserNode:
+        slicer.modules.sequences.logic().UpdateProxyNodesFromSequences(browserNode)
+    cls.enforce(keep={key})
+    return node
+
+  @classmethod
+  def readVoxels(cls, node, record):
+    """Read the files of a record again and return the image data mapped like
+    the voxels of node (stored values if node keeps them)"""
+    rwvmPlugin = record['rwvmPlugin']
+    loadable = record['loadable']
+    files = record['files']
+    name = slicer.mrmlScene.GenerateUniqueName(node.GetName() or 'frame')
+    warning = getattr(loadable, 'warning', '')
+    if record.get('bedLoadables'):
+      # whole body volumes are SUV, blended from the slices of their beds
+      voxels = rwvmPlugin.readBedPositionVoxels(loadable, record['bedLoadables'])
+      volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+      try:
+        slicer.util.updateVolumeFromArray(volumeNode, voxels)
+        return volumeNode.GetImageData()
+      finally:
+        slicer.mrmlScene.RemoveNode(volumeNode)
+    if record['frame']:
+      scalarVolumePlugin = slicer.modules.dicomPlugins['DICOMScalarVolumePlugin']()
+      svLoadables = scalarVolumePlugin.examine([files])
+      if not svLoadables:
+        raise OSError(f"Cannot read the files of {name} again")
+      loadFunction = lambda: rwvmPlugin.loadFrame(scalarVolumePlugin, svLoadables[0])
+      files = svLoadables[0].files
+      warning = svLoadables[0].warning
+    else:
+      loadFunction = lambda: rwvmPlugin.scalarVolumePlugin.loadFilesWithArchetype(files, name)
+    volumeNode = rwvmPlugin.loadPetVolumeFiles(loadable, files, name, loadFunction, warning)
+    if volumeNode is None or volumeNode.GetImageData() is None:
+      raise OSError(f"Cannot read the files of {name} again")
+    try:
+      rwvmPlugin.applyRealWorldValueMappingToNode(volumeNode, loadable, record['conversionFactor'], files)
+      if rwvmPlugin.getStoredValueMapping(node) is None:
+        rwvmPlugin.materializeSUVVolume(volumeNode)
+      else:
+        # the voxels may be read as stored or as rescaled values, node takes the mapping of this read
+        mapping = rwvmPlugin.getStoredValueMapping(volumeNode)
+        if mapping:
+          rwvmPlugin.setStoredValueMapping(node, *mapping)
+        else:
+          rwvmPlugin.removeStoredValueMapping(node)
+      return volumeNode.GetImageData()
+    finally:
+      for helperNode in [volumeNode.GetDisplayNode(), volumeNode.GetStorageNode()]:
+        if helperNode:
+          slicer.mrmlScene.RemoveNode(helperNode)
+      slicer.mrmlScene.RemoveNode(volumeNode)
+
+  @classmethod
+  def observeViews(cls):
+    """Rematerialize released volumes when they are put in a slice view, are
+    volume rendered or their frame is selected in a sequence browser"""
+    if cls.sceneObserverTag is None:
+      cls.sceneObserverTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, cls.onSceneEndClose)
+    for node in slicer.util.getNodesByClass('vtkMRMLSliceCompositeNode') + \
+                slicer.util.getNodesByClass('vtkMRMLVolumeRenderingDisplayNode') + \
+                slicer.util.getNodesByClass('vtkMRMLSequenceBrowserNode'):
+      if node.GetID() in cls.observations:
+        continue
+      tag = node.AddObserver(vtk.vtkCommand.ModifiedEvent, cls.onViewModified)
+      cls.observations[node.GetID()] = (node, tag)
+
+  @classmethod
+  def onSceneEndClose(cls, caller, event):
+    cls.reset()
+
+  @classmethod
+  def reset(cls):
+    """Forget all tracked buffers and stop observing the views, node IDs are
+    reused in the next scene"""
+    with cls.lock:
+      cls.records.clear()
+      for (node, tag) in cls.observations.values():
+        node.RemoveObserver(tag)
+      cls.observations.clear()
+
+  @classmethod
+  def onViewModified(cls, caller, event):
+    # rematerialize after the modification is processed, not in the middle of it
+    qt.QTimer.singleShot(0, lambda: cls.ensureShownLoaded(caller))
+
+  @classmethod
+  def ensureShownLoaded(cls, viewNode):
+    """Rematerialize the released volumes shown by a slice composite, volume
+    rendering display or sequence browser node"""
+    if viewNode.GetScene() is None:
+      # removed, e.g. by closing the scene
+      return
+    try:
+      if viewNode.IsA('vtkMRMLSequenceBrowserNode'):
+        sequenceNode = viewNode.GetMasterSequenceNode()
+        itemNumber = viewNode.GetSelectedItemNumber()
+        if sequenceNode and 0 <= itemNumber < sequenceNode.GetNumberOfDataNodes():
+          cls.ensureLoaded(sequenceNode.GetNthDataNode(itemNumber))
+        return
+      if viewNode.IsA('vtkMRMLVolumeRenderingDisplayNode'):
+        volumeIDs = [viewNode.GetVolumeNodeID()]
+      else:
+        volumeIDs = [viewNode.GetBackgroundVolumeID(), viewNode.GetForegroundVolumeID(), viewNode.GetLabelVolumeID()]
+      for volumeID in volumeIDs:
+        if volumeID:
+          cls.ensureLoaded(slicer.mrmlScene.GetNodeByID(volumeID))
+    except Exception as e:
+      logging.error(f"Cannot rematerialize the PET volumes shown by {viewNode.GetName()}: {str(e)}")
+
 #
 # This is the plugin to handle Real World Value Mapping objects
 # from DICOM files into MRML nodes.  It follows the DICOM module's
@@ -49,8 +549,12 @@ class DICOMRWVMPluginClass(DICOMPlugin):
     self.tags['contentTime'] = "0008,0033"
     self.tags['seriesTime'] = "0008,0031"
     self.tags['triggerTime'] = "0018,1060"
+    self.tags['acquisitionTime'] = "0008,0032"
+    self.tags['actualFrameDuration'] = "0018,1242"
+    self.tags['frameReferenceTime'] = "0054,1300"
     self.tags['diffusionGradientOrientation'] = "0018,9089"
     self.tags['imageOrientationPatient'] = "0020,0037"
+    self.tags['frameOfReferenceUID'] = "0020,0052"
     self.tags['numberOfFrames'] = "0028,0008"
 
     self.tags['seriesDescription'] = "0008,103e"
@@ -68,6 +572,8 @@ class DICOMRWVMPluginClass(DICOMPlugin):
     self.tags['spacing'] = "0028,0030"
     self.tags['position'] = "0020,0032"
     self.tags['orientation'] = "0020,0037"
+    self.tags['rescaleIntercept'] = "0028,1052"
+    self.tags['rescaleSlope'] = "0028,1053"
     self.tags['pixelData'] = "7fe0,0010"
 
     self.tags['referencedImageRWVMappingSeq'] = "0040,9094"
@@ -143,16 +649,26 @@ class DICOMRWVMPluginClass(DICOMPlugin):
       refRWVMSeq = dicomFile.ReferencedImageRealWorldValueMappingSequence
       refSeriesSeq = dicomFile.ReferencedSeriesSequence
       if refRWVMSeq:
-        # May have more than one RWVM value, create loadables for each
+        # May have more than one RWVM value, create loadables for each units.
+        # Dynamic series may have one item per units and time frame (frame
+        # dependent decay), these are merged into a single loadable.
+        itemsByUnits = {}
         for item in refRWVMSeq:
+          unitsCode = item.RealWorldValueMappingSequence[0].MeasurementUnitsCodeSequence[0].CodeValue
+          itemsByUnits.setdefault(unitsCode, []).append(item)
+        for items in itemsByUnits.values():
+          item = items[0]
           rwvLoadable = DICOMLib.DICOMLoadable()
           # Get the referenced files from the database
-          refImageSeq = item.ReferencedImageSequence
           instanceFiles = []
-          for instance in refImageSeq:
-            uid = instance.ReferencedSOPInstanceUID
-            if uid:
-              instanceFiles += [slicer.dicomDatabase.fileForInstance(uid)]
+          instanceSlopes = {}
+          for frameItem in items:
+            frameSlope = getattr(frameItem.RealWorldValueMappingSequence[0], 'RealWorldValueSlope', None)
+            for instance in frameItem.ReferencedImageSequence:
+              uid = instance.ReferencedSOPInstanceUID
+              if uid:
+                instanceFiles += [slicer.dicomDatabase.fileForInstance(uid)]
+                instanceSlopes[uid] = frameSlope
           # Get the Real World Values
           rwvLoadable.files = instanceFiles
           rwvLoadable.rwvFile = file
@@ -172,7 +688,12 @@ class DICOMRWVMPluginClass(DICOMPlugin):
 
           rwvLoadable.confidence = 0.90
           rwvLoadable.selected = True # added by CB
-          rwvLoadable.slope = rwvmSeq[0].RealWorldValueSlope
+          rwvLoadable.slope = getattr(rwvmSeq[0], 'RealWorldValueSlope', None)
+          rwvLoadable.intercept = float(getattr(rwvmSeq[0], 'RealWorldValueIntercept', 0.0) or 0.0)
+          rwvLoadable.mappings = [RealWorldValueMappingItem.fromDataset(mappingItem) for mappingItem in rwvmSeq]
+          rwvLoadable.unitsCodeValue = unitsCode
+          # per instance slopes, only set if the slope differs between time frames
+          rwvLoadable.instanceSlopes = instanceSlopes if len(items) > 1 else {}
           rwvLoadable.referencedSeriesInstanceUID = refSeriesSeq[0].SeriesInstanceUID
 
           # determine modality of referenced series
@@ -187,6 +708,7 @@ class DICOMRWVMPluginClass(DICOMPlugin):
           if rwvLoadable.referencedModality == 'PT':
             print('Found Referenced PET series')
             ris = refSeriesFile0.RadiopharmaceuticalInformationSequence[0]
+            rwvLoadable.radiopharmaceuticalStartTime = getattr(ris, 'RadiopharmaceuticalStartTime', None)
             try: # TODO Many DICOM series do not have radiopharmaceutical code sequence!
               rcs = ris.RadiopharmaceuticalCodeSequence
               if len(rcs) > 0:
@@ -245,21 +767,108 @@ class DICOMRWVMPluginClass(DICOMPlugin):
     loadablePetSeries = self.getLoadablePetSeriesFromRWVMFile( loadable.files[0] )
     return self.loadPetSeries(loadablePetSeries[0])
 
+  def loadCachedVolume(self, files, name, loadFunction, warning='', variant=''):
+    """Return the unscaled volume for a sorted file list, either from the
+    decoded volume cache (if enabled) or by calling loadFunction and storing
+    its result in the cache. warning is the geometry warning of the loader,
+    it is logged again when the volume comes from the cache."""
+    if not DecodedVolumeCache.isEnabled():
+      return loadFunction()
+    cache = DecodedVolumeCache()
+    key = cache.keyForFiles(files, variant)
+    entry = cache.get(key)
+    if entry:
+      logging.debug(f"Loading {name} from decoded volume cache")
+      return cache.createVolumeNode(entry, name)
+    imageNode = loadFunction()
+    if imageNode and imageNode.GetImageData():
+      cache.put(key, imageNode, warning)
+    return imageNode
+
+  def loadPetVolumeFiles(self, loadable, files, name, loadFunction, warning=''):
+    """Return the volume of a sorted file list before the RWVM is applied. In
+    compact mode (see keepStoredVoxels) with a linear RWVM the stored pixels
+    are kept (see loadStoredVolume), otherwise loadFunction reads the modality
+    rescaled float voxels."""
+    if self.keepStoredVoxels() and self.hasLinearMapping(loadable):
+      imageNode = self.loadCachedVolume(files, name, lambda: self.loadStoredVolume(files, name), variant='stored')
+      if imageNode is not None:
+        return imageNode
+    return self.loadCachedVolume(files, name, loadFunction, warning)
+
+  def loadStoredVolume(self, files, name):
+    """Return a scalar volume holding the stored pixel values (int16 or
+    uint16) of a sorted single frame series, with RescaleSlope and
+    RescaleIntercept recorded as its stored value mapping. Returns None if
+    the slices have different rescale parameters or are not evenly spaced,
+    these are loaded as rescaled float voxels instead."""
+    voxels = None
+    positions = []
+    rescale = None
+    for sliceIndex, fileName in enumerate(files):
+      if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+        ds = pydicom.dcmread(fileName)
+      else:
+        ds = dicom.read_file(fileName)
+      if int(getattr(ds, 'NumberOfFrames', 1) or 1) > 1:
+        return None
+      sliceRescale = (float(getattr(ds, 'RescaleSlope', 1.0) or 1.0), float(getattr(ds, 'RescaleIntercept', 0.0) or 0.0))
+      if rescale is None:
+        rescale = sliceRescale
+        header = ds
+      elif sliceRescale != rescale:
+        logging.debug(f"{name}: slices have different rescale parameters, keeping rescaled float voxels")
+        return None
+      pixels = ds.pixel_array
+      if voxels is None:
+        voxels = np.empty((len(files),) + pixels.shape, dtype=pixels.dtype)
+      voxels[sliceIndex] = pixels
+      positions.append([float(v) for v in ds.ImagePositionPatient])
+
+    origin = np.array(positions[0])
+    if len(positions) > 1:
+      sliceStepVector = (np.array(positions[-1]) - origin) / (len(positions) - 1)
+      expected = origin + np.outer(np.arange(len(positions)), sliceStepVector)
+      if np.abs(np.array(positions) - expected).max() > 0.01*np.linalg.norm(sliceStepVector):
+        logging.debug(f"{name}: slices are not evenly spaced, keeping rescaled float voxels")
+        return None
+    else:
+      sliceStepVector = None
+    imageNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+    imageNode.SetIJKToRASMatrix(self.ijkToRASFromDataset(header, sliceStepVector))
+    slicer.util.updateVolumeFromArray(imageNode, voxels)
+    imageNode.CreateDefaultDisplayNodes()
+    self.setStoredValueMapping(imageNode, *rescale)
+    return imageNode
+
+  def ijkToRASFromDataset(self, ds, sliceStepVector=None, inPlaneStep=1):
+    """Return the IJK to RAS matrix of a volume whose first slice is ds, with
+    slices sliceStepVector (LPS, mm) apart and decimated in-plane by
+    inPlaneStep"""
+    orientation = np.array([float(v) for v in ds.ImageOrientationPatient])
+    (rowSpacing, columnSpacing) = (float(v) for v in ds.PixelSpacing)
+    origin = np.array([float(v) for v in ds.ImagePositionPatient])
+    if sliceStepVector is None:
+      sliceStepVector = np.cross(orientation[:3], orientation[3:]) * float(getattr(ds, 'SliceThickness', 1.0))
+    columns = [orientation[:3]*columnSpacing*inPlaneStep, orientation[3:]*rowSpacing*inPlaneStep, sliceStepVector, origin]
+    # DICOM LPS to RAS
+    ijkToRAS = vtk.vtkMatrix4x4()
+    for column, vector in enumerate(columns):
+      for row, sign in enumerate((-1, -1, 1)):
+        ijkToRAS.SetElement(row, column, sign*vector[row])
+    return ijkToRAS
+
   def loadPetSeries(self, loadable):
     """Use the conversion factor to load the volume into Slicer"""
 
     conversionFactor = loadable.slope
 
     # Create volume node
-    imageNode = self.scalarVolumePlugin.loadFilesWithArchetype(loadable.files, loadable.name)
+    imageNode = self.loadPetVolumeFiles(loadable, loadable.files, loadable.name,
+      lambda: self.scalarVolumePlugin.loadFilesWithArchetype(loadable.files, loadable.name),
+      getattr(loadable, 'warning', ''))
     if imageNode:
-      # apply the conversion factor
-      multiplier = vtk.vtkImageMathematics()
-      multiplier.SetOperationToMultiplyByK()
-      multiplier.SetConstantK(float(conversionFactor))
-      multiplier.SetInput1Data(imageNode.GetImageData())
-      multiplier.Update()
-      imageNode.GetImageData().DeepCopy(multiplier.GetOutput())
+      self.applyRealWorldValueMappingToNode(imageNode, loadable, conversionFactor)
 
       # create list of DICOM instance UIDs corresponding to the loaded files
       instanceUIDs = ""
@@ -298,38 +907,7 @@ class DICOMRWVMPluginClass(DICOMPlugin):
       appLogic.PropagateVolumeSelection()
 
       # Change display
-      displayNode = imageNode.GetVolumeDisplayNode()
-      displayNode.SetInterpolate(0)
-      if loadable.referencedModality == 'PT':
-        radiopharmaceuticalCode = ''
-        try:
-          radiopharmaceuticalCode = loadable.RadiopharmaceuticalCodeValue
-          imageNode.SetAttribute('DICOM.RadiopharmaceuticalCodeValue',radiopharmaceuticalCode)
-          print('Found Radiopharmaceutical Code ' + radiopharmaceuticalCode)
-        except AttributeError:
-          imageNode.SetAttribute('DICOM.RadiopharmaceuticalCodeValue','unknown')
-          # use radionuclide info instead
-          radionuclideCode = ''
-          try:
-            radionuclideCode = loadable.RadionuclideCodeValue
-            imageNode.SetAttribute('DICOM.RadionuclideCodeValue',radionuclideCode)
-            print('Found Radionuclide Code ' + radionuclideCode)
-          except AttributeError:
-            imageNode.SetAttribute('DICOM.RadionuclideCodeValue','unknown')
-        if radiopharmaceuticalCode == 'C-B1031': # FDG
-          displayNode.AutoWindowLevelOff()
-          displayNode.SetWindowLevel(6,3)
-          displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeInvertedGrey')
-        elif radiopharmaceuticalCode == 'C-B1036': # FLT
-          displayNode.AutoWindowLevelOff()
-          displayNode.SetWindowLevel(4,2)
-          displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeInvertedGrey')
-        else: # Default W/L if no info about radiopharmaceutical can be found, often FDG
-          displayNode.AutoWindowLevelOff()
-          displayNode.SetWindowLevel(6,3)
-          displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeInvertedGrey')
-      else:
-        displayNode.SetAutoWindowLevel(1)
+      self.configureDisplayNode(imageNode, loadable)
 
       # Change name
       name = (loadable.name).replace(' ','_')
@@ -338,12 +916,206 @@ class DICOMRWVMPluginClass(DICOMPlugin):
       # create Subject Hierarchy nodes for the loaded series
       self.addSeriesInSubjectHierarchy(loadable,imageNode)
 
+      SUVMemoryBudget.trackVolume(self, imageNode, loadable, conversionFactor)
+
     return imageNode
 
-  def loadPetMultiVolumeSeries(self, loadable):
-    """Use the conversion factor to load the volume into Slicer"""
+  def loadPetSeriesPreview(self, loadable, sliceStep=4, inPlaneStep=2):
+    """Load a small SUV volume from every sliceStep-th slice of the series
+    along the slice normal, decimated in-plane by inPlaneStep. The full
+    resolution volume can later replace it in place with
+    replacePreviewWithFullResolution."""
+    # sort the slices by their position along the slice normal, the pixels
+    # are only read for the slices of the preview
+    if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+      headers = [pydicom.dcmread(previewFile, stop_before_pixels=True) for previewFile in loadable.files]
+    else:
+      headers = [dicom.read_file(previewFile, stop_before_pixels=True) for previewFile in loadable.files]
+    orientation = np.array([float(v) for v in headers[0].ImageOrientationPatient])
+    normal = np.cross(orientation[:3], orientation[3:])
+    positions = np.array([[float(v) for v in header.ImagePositionPatient] for header in headers])
+    order = np.argsort(positions @ normal, kind='stable')
+    selected = order[::sliceStep]
+    files = [loadable.files[index] for index in selected]
+    if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+      datasets = [pydicom.dcmread(previewFile) for previewFile in files]
+    else:
+      datasets = [dicom.read_file(previewFile) for previewFile in files]
+    ds = datasets[0]
+    voxels = np.empty((len(datasets),) + ds.pixel_array[::inPlaneStep, ::inPlaneStep].shape, dtype=np.float32)
+    for sliceIndex, sliceDataset in enumerate(datasets):
+      self.mapSlice(sliceDataset.pixel_array[::inPlaneStep, ::inPlaneStep], sliceDataset, loadable, loadable.slope,
+                    voxels[sliceIndex])
+
+    # geometry of the decimated grid
+    sliceStepVector = None
+    if len(selected) > 1:
+      sliceStepVector = (positions[selected[-1]] - positions[selected[0]]) / (len(selected) - 1)
+    elif len(order) > 1:
+      sliceStepVector = (positions[order[1]] - positions[order[0]]) * sliceStep
+    ijkToRAS = self.ijkToRASFromDataset(ds, sliceStepVector, inPlaneStep)
+
+    imageNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', loadable.name.replace(' ','_'))
+    imageNode.SetIJKToRASMatrix(ijkToRAS)
+    slicer.util.updateVolumeFromArray(imageNode, voxels)
+    imageNode.CreateDefaultDisplayNodes()
+    if loadable.quantity:
+      imageNode.SetVoxelValueQuantity(loadable.quantity)
+    if loadable.units:
+      imageNode.SetVoxelValueUnits(loadable.units)
+    imageNode.SetAttribute("DICOM.instanceUIDs", " ".join(str(sliceDataset.SOPInstanceUID) for sliceDataset in datasets))
+    # what is needed to load the full resolution volume later
+    imageNode.SetAttribute("DICOM.PETSUV.Preview.RWVMFile", loadable.rwvFile)
+    imageNode.SetAttribute("DICOM.PETSUV.Preview.UnitsCodeValue", getattr(loadable, 'unitsCodeValue', ''))
 
-    conversionFactor = loadable.slope
+    appLogic = slicer.app.applicationLogic()
+    appLogic.GetSelectionNode().SetReferenceActiveVolumeID(imageNode.GetID())
+    appLogic.PropagateVolumeSelection()
+    self.configureDisplayNode(imageNode, loadable)
+    self.addSeriesInSubjectHierarchy(loadable, imageNode)
+    return imageNode
+
+  def loadPetBedPositions(self, loadable, bedLoadables):
+    """Load the bed positions of a whole body PET (see
+    DICOMPETSUVPluginClass.examineBedPositions) as one SUV volume, see
+    readBedPositionVoxels. Returns None if loading is canceled."""
+    unitsCodeValues = set(getattr(bedLoadable, 'unitsCodeValue', None) for bedLoadable in bedLoadables)
+    if len(unitsCodeValues) != 1:
+      raise ValueError(f"The bed positions of {loadable.name} have different units: {sorted(map(str, unitsCodeValues))}")
+    progressbar = slicer.util.createProgressDialog(labelText="Loading "+loadable.name, value=0,
+                                                   maximum=len(loadable.files), windowModality=qt.Qt.WindowModal)
+    try:
+      voxels = self.readBedPositionVoxels(loadable, bedLoadables, progressbar)
+    finally:
+      progressbar.close()
+    if voxels is None:
+      logging.info(f"Loading {loadable.name} canceled")
+      return None
+
+    # geometry of the combined grid, starting at the first slice of the first bed
+    if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+      header = pydicom.dcmread(loadable.bedFileLists[0][0], stop_before_pixels=True)
+    else:
+      header = dicom.read_file(loadable.bedFileLists[0][0], stop_before_pixels=True)
+    orientation = np.array([float(v) for v in header.ImageOrientationPatient])
+    normal = np.cross(orientation[:3], orientation[3:])
+    ijkToRAS = self.ijkToRASFromDataset(header, normal*loadable.sliceSpacing)
+
+    firstBed = bedLoadables[0]
+    imageNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', loadable.name.replace(' ','_'))
+    imageNode.SetIJKToRASMatrix(ijkToRAS)
+    slicer.util.updateVolumeFromArray(imageNode, voxels)
+    imageNode.CreateDefaultDisplayNodes()
+    if firstBed.quantity:
+      imageNode.SetVoxelValueQuantity(firstBed.quantity)
+    if firstBed.units:
+      imageNode.SetVoxelValueUnits(firstBed.units)
+    imageNode.SetAttribute("DICOM.instanceUIDs", " ".join(
+      slicer.dicomDatabase.fileValue(fileName, self.tags['sopInstanceUID']) or "Unknown"
+      for files in loadable.bedFileLists for fileName in files))
+    imageNode.SetAttribute("DICOM.RWV.instanceUID", " ".join(
+      slicer.dicomDatabase.fileValue(bedLoadable.rwvFile, self.tags['sopInstanceUID'])
+      for bedLoadable in bedLoadables if hasattr(bedLoadable, 'rwvFile')))
+
+    appLogic = slicer.app.applicationLogic()
+    appLogic.GetSelectionNode().SetReferenceActiveVolumeID(imageNode.GetID())
+    appLogic.PropagateVolumeSelection()
+    self.configureDisplayNode(imageNode, firstBed)
+    self.addSeriesInSubjectHierarchy(firstBed, imageNode)
+    SUVMemoryBudget.trackVolume(self, imageNode, loadable, 1.0, bedLoadables=bedLoadables)
+    return imageNode
+
+  def readBedPositionVoxels(self, loadable, bedLoadables, progressbar=None):
+    """Return the SUV voxels of the combined grid of a whole body loadable.
+    The slices of all beds are decoded on a thread pool directly into the
+    preallocated volume and mapped with the RWVM of their own bed. Where beds
+    overlap the slices are blended, weighted by their distance to the end of
+    their bed. Returns None if progressbar is canceled."""
+    if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+      header = pydicom.dcmread(loadable.bedFileLists[0][0], stop_before_pixels=True)
+    else:
+      header = dicom.read_file(loadable.bedFileLists[0][0], stop_before_pixels=True)
+    voxels = np.empty((loadable.numberOfSlices, int(header.Rows), int(header.Columns)), dtype=np.float32)
+    slicesPerIndex = np.bincount([index for indices in loadable.bedSliceIndices for index in indices],
+                                 minlength=loadable.numberOfSlices)
+
+    # (file, slice index, bed loadable, blending weight) of every slice
+    plan = []
+    for bedLoadable, files, indices in zip(bedLoadables, loadable.bedFileLists, loadable.bedSliceIndices):
+      for fileName, index in zip(files, indices):
+        plan.append((fileName, index, bedLoadable, float(min(index - indices[0], indices[-1] - index) + 1)))
+
+    def readSlice(task):
+      (fileName, index, bedLoadable, weight) = task
+      if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+        ds = pydicom.dcmread(fileName)
+      else:
+        ds = dicom.read_file(fileName)
+      target = voxels[index] if slicesPerIndex[index] == 1 else np.empty(voxels.shape[1:], dtype=np.float32)
+      self.mapSlice(ds.pixel_array, ds, bedLoadable, bedLoadable.slope, target)
+      # overlapping slices are blended on the calling thread
+      return None if slicesPerIndex[index] == 1 else (index, weight, target)
+
+    overlapping = {}
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+      for sliceNumber, result in enumerate(executor.map(readSlice, plan)):
+        if result is not None:
+          (index, weight, suv) = result
+          (weightedSum, weightSum) = overlapping.get(index, (0.0, 0.0))
+          overlapping[index] = (weightedSum + weight*suv, weightSum + weight)
+        if progressbar and sliceNumber % 16 == 0:
+          progressbar.value = sliceNumber
+          slicer.app.processEvents()
+          if progressbar.wasCanceled:
+            # drop the slices that are not read yet
+            executor.shutdown(wait=True, cancel_futures=True)
+            return None
+    for index, (weightedSum, weightSum) in overlapping.items():
+      voxels[index] = weightedSum / weightSum
+    return voxels
+
+  def isPreview(self, volumeNode):
+    return volumeNode.GetAttribute("DICOM.PETSUV.Preview.RWVMFile") is not None
+
+  def replacePreviewWithFullResolution(self, previewNode):
+    """Load the full resolution volume of a preview and move it into the
+    preview node, so that views and references to the node are kept"""
+    if not self.isPreview(previewNode):
+      return previewNode
+    unitsCodeValue = previewNode.GetAttribute("DICOM.PETSUV.Preview.UnitsCodeValue")
+    loadables = self.getLoadablePetSeriesFromRWVMFile(previewNode.GetAttribute("DICOM.PETSUV.Preview.RWVMFile"))
+    loadables = [loadable for loadable in loadables if getattr(loadable, 'unitsCodeValue', '') == unitsCodeValue] or loadables
+    if not loadables:
+      raise OSError(f"Cannot find the series of preview {previewNode.GetName()}")
+    loadable = loadables[0]
+    fullNode = self.loadPetSeries(loadable)
+    if fullNode is None:
+      raise OSError(f"Failed to load the full resolution volume of {previewNode.GetName()}")
+
+    ijkToRAS = vtk.vtkMatrix4x4()
+    fullNode.GetIJKToRASMatrix(ijkToRAS)
+    previewNode.SetIJKToRASMatrix(ijkToRAS)
+    previewNode.SetAndObserveImageData(fullNode.GetImageData())
+    previewNode.RemoveAttribute("DICOM.PETSUV.Preview.RWVMFile")
+    previewNode.RemoveAttribute("DICOM.PETSUV.Preview.UnitsCodeValue")
+    for attributeName in fullNode.GetAttributeNames():
+      previewNode.SetAttribute(attributeName, fullNode.GetAttribute(attributeName))
+    self.configureDisplayNode(previewNode, loadable)
+    SUVMemoryBudget.trackVolume(self, previewNode, loadable, loadable.slope)
+
+    if fullNode.GetDisplayNode():
+      slicer.mrmlScene.RemoveNode(fullNode.GetDisplayNode())
+    if fullNode.GetStorageNode():
+      slicer.mrmlScene.RemoveNode(fullNode.GetStorageNode())
+    slicer.mrmlScene.RemoveNode(fullNode)
+
+    appLogic = slicer.app.applicationLogic()
+    appLogic.GetSelectionNode().SetReferenceActiveVolumeID(previewNode.GetID())
+    appLogic.PropagateVolumeSelection()
+    return previewNode
+
+  def loadPetMultiVolumeSeries(self, loadable):
+    """Use the conversion factors to load the volume into Slicer"""
 
     multiVolumePlugin = slicer.modules.dicomPlugins['MultiVolumeImporterPlugin']()
     mVLoadables = multiVolumePlugin.examine([loadable.files])
@@ -385,22 +1157,35 @@ class DICOMRWVMPluginClass(DICOMPlugin):
       mvImageArray = None
 
     scalarVolumePlugin = slicer.modules.dicomPlugins['DICOMScalarVolumePlugin']()
-    instanceUIDs = ""
+    fileInstanceUIDs = []
     for file in files:
       uid = slicer.dicomDatabase.fileValue(file,multiVolumePlugin.tags['instanceUID'])
       if uid == "":
         uid = "Unknown"
-      instanceUIDs += uid+" "
-    instanceUIDs = instanceUIDs[:-1]
+      fileInstanceUIDs.append(uid)
+    instanceUIDs = " ".join(fileInstanceUIDs)
     mvNode.SetAttribute("DICOM.instanceUIDs", instanceUIDs)
 
+    frameFactors = self.frameConversionFactors(loadable, fileInstanceUIDs[::filesPerFrame][:nFrames])
+    frameMidTimes = self.frameMidTimes(files[::filesPerFrame][:nFrames],
+                                       getattr(loadable, 'radiopharmaceuticalStartTime', None))
+    linearMapping = self.hasLinearMapping(loadable)
+    keepStoredVoxels = self.keepStoredVoxels() and linearMapping and np.all(frameFactors == frameFactors[0])
+    # Multivolumes are scaled with a single broadcast over the whole buffer
+    # after all frames are read, instead of frame by frame
+    broadcastScaling = not loadAsVolumeSequence and linearMapping and not keepStoredVoxels
+    # Progressive mode only loads the first frame here, the others are read
+    # in the background by a ProgressiveFrameLoader
+    progressive = (loadAsVolumeSequence and nFrames > 1 and filesPerFrame > 1
+                   and not self.keepStoredVoxels() and self.progressiveLoading())
+
     progressbar = slicer.util.createProgressDialog(labelText="Loading "+baseName,
                                                    value=0, maximum=nFrames,
                                                    windowModality = qt.Qt.WindowModal)
 
     try:
       # read each frame into scalar volume
-      for frameNumber in range(nFrames):
+      for frameNumber in range(1 if progressive else nFrames):
 
         progressbar.value = frameNumber
         slicer.app.processEvents()
@@ -417,15 +1202,13 @@ class DICOMRWVMPluginClass(DICOMPlugin):
         if len(svLoadables) == 0:
           raise OSError(f"volume frame {frameNumber} is invalid")
 
-        frame = scalarVolumePlugin.load(svLoadables[0])
-
-        # Harden the acquisition transform if there is any
-        # (for example due to varying slice spacing)
-        # and then remove the transform from the scene
-        parentTransformNode = frame.GetParentTransformNode()
-        if parentTransformNode:
-          frame.HardenTransform()
-          slicer.mrmlScene.RemoveNode(parentTransformNode)
+        loadFunction = lambda: self.loadFrame(scalarVolumePlugin, svLoadables[0])
+        if loadAsVolumeSequence:
+          frame = self.loadPetVolumeFiles(loadable, svLoadables[0].files, svLoadables[0].name, loadFunction,
+                                          svLoadables[0].warning)
+        else:
+          # frames of a multivolume share one buffer and one mapping, keep them rescaled
+          frame = self.loadCachedVolume(svLoadables[0].files, svLoadables[0].name, loadFunction, svLoadables[0].warning)
 
         if frame == None or frame.GetImageData() == None:
           raise OSError(f"Volume frame {frameNumber} is invalid - {svLoadables[0].warning}")
@@ -433,24 +1216,21 @@ class DICOMRWVMPluginClass(DICOMPlugin):
         #
         # SCALING
         #
-        frame = self.conversion(loadable, frame, conversionFactor, frameFileList)
+        if not broadcastScaling:
+          frame = self.conversion(loadable, frame, frameFactors[frameNumber], svLoadables[0].files)
 
         if loadAsVolumeSequence:
           # Load into volume sequence
-
-          # volumeSequenceNode.SetDataNodeAtValue would deep-copy the volume frame.
-          # To avoid memory reallocation, add an empty node and shallow-copy the contents
-          # of the volume frame.
-
-          # Create an empty volume node in the sequence node
-          proxyVolume = slicer.mrmlScene.AddNewNodeByClass(frame.GetClassName())
-          indexValue = str(frameNumber)
-          volumeSequenceNode.SetDataNodeAtValue(proxyVolume, indexValue)
-          slicer.mrmlScene.RemoveNode(proxyVolume)
-
-          # Update the data node
-          shallowCopy = True
-          volumeSequenceNode.UpdateDataNodeAtValue(frame, indexValue, shallowCopy)
+          self.addFrameToSequence(volumeSequenceNode, frame, str(frameNumber))
+          frameMapping = self.getStoredValueMapping(frame)
+          if frameMapping:
+            self.setStoredValueMapping(volumeSequenceNode.GetDataNodeAtValue(str(frameNumber)), *frameMapping)
+          SUVMemoryBudget.trackFrame(self, volumeSequenceNode, str(frameNumber), loadable, frameFileList,
+                                     frameFactors[frameNumber])
+          if progressive:
+            firstFrameFiles = svLoadables[0].files
+            firstFrameIJKToRAS = vtk.vtkMatrix4x4()
+            frame.GetIJKToRASMatrix(firstFrameIJKToRAS)
 
         else:
           # Load into multi-volume
@@ -461,7 +1241,7 @@ class DICOMRWVMPluginClass(DICOMPlugin):
             frameSize = frameExtent[1]*frameExtent[3]*frameExtent[5]
 
             mvImage.SetExtent(frameExtent)
-            mvImage.AllocateScalars(frame.GetImageData().GetScalarType(), nFrames)
+            mvImage.AllocateScalars(vtk.VTK_FLOAT if broadcastScaling else frame.GetImageData().GetScalarType(), nFrames)
 
             mvImageArray = vtk.util.numpy_support.vtk_to_numpy(mvImage.GetPointData().GetScalars())
 
@@ -510,15 +1290,33 @@ class DICOMRWVMPluginClass(DICOMPlugin):
         # Show under the right patient/study in subject hierarchy
         self.addSeriesInSubjectHierarchy(mVLoadable, imageProxyVolumeNode)
 
+        self.setFrameMidTimes(volumeSequenceNode, frameMidTimes)
+
         # Show sequence browser toolbar
         sequencesModule = slicer.modules.sequences
         if sequencesModule.autoShowToolBar:
           sequencesModule.setToolBarActiveBrowserNode(sequenceBrowserNode)
           sequencesModule.setToolBarVisible(True)
+        if self.keepStoredVoxels() and linearMapping:
+          # frames with a frame dependent slope keep their own mapping
+          self.setStoredValueMapping(volumeSequenceNode, frameFactors[0], getattr(loadable, 'intercept', 0.0))
         self.configureDisplayNode(imageProxyVolumeNode, loadable)
+        SUVMemoryBudget.enforce()
+
+        if progressive:
+          frameLoader = ProgressiveFrameLoader(self, loadable, volumeSequenceNode, firstFrameIJKToRAS, firstFrameFiles,
+            [files[frameNumber*filesPerFrame:(frameNumber+1)*filesPerFrame] for frameNumber in range(1, nFrames)],
+            frameFactors[1:], firstFrameNumber=1)
+          frameLoader.start()
       else:
         # Finalize multi-volume import
 
+        if broadcastScaling:
+          # mvImageArray is (voxels, frames), scale every frame with its own factor
+          mvImageArray *= frameFactors.astype(mvImageArray.dtype)
+          if getattr(loadable, 'intercept', 0.0):
+            mvImageArray += np.float32(loadable.intercept)
+
         mvDisplayNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMultiVolumeDisplayNode')
         mvDisplayNode.SetDefaultColorMap()
 
@@ -541,6 +1339,9 @@ class DICOMRWVMPluginClass(DICOMPlugin):
 
         # file list is no longer needed - remove the attribute
         mvNode.RemoveAttribute('MultiVolume.FrameFileList')
+        self.setFrameMidTimes(mvNode, frameMidTimes)
+        if keepStoredVoxels:
+          self.setStoredValueMapping(mvNode, frameFactors[0], getattr(loadable, 'intercept', 0.0))
         self.configureDisplayNode(mvNode, loadable)
 
 
@@ -556,6 +1357,103 @@ class DICOMRWVMPluginClass(DICOMPlugin):
     return mvNode
 
 
+  def frameConversionFactors(self, loadable, frameInstanceUIDs):
+    """Return the conversion factor of every time frame of a dynamic series,
+    given the instance UID of the first file of each frame. Frames without a
+    frame specific RWVM item use the series slope."""
+    slope = float(loadable.slope) if loadable.slope is not None else 1.0
+    factors = np.full(len(frameInstanceUIDs), slope)
+    instanceSlopes = getattr(loadable, 'instanceSlopes', None)
+    if instanceSlopes:
+      for frameNumber, uid in enumerate(frameInstanceUIDs):
+        frameSlope = instanceSlopes.get(uid)
+        if frameSlope is not None:
+          factors[frameNumber] = float(frameSlope)
+    return factors
+
+  def timeToSeconds(self, dicomTime):
+    """Return the seconds since midnight of a DICOM TM value"""
+    dicomTime = str(dicomTime).strip().replace(':', '')
+    if len(dicomTime) < 2:
+      return None
+    hours = int(dicomTime[0:2])
+    minutes = int(dicomTime[2:4] or 0)
+    seconds = float(dicomTime[4:] or 0)
+    return hours*3600 + minutes*60 + seconds
+
+  def frameMidTimes(self, frameFiles, injectionTime=None):
+    """Return the mid time (s) of every frame of a dynamic series, given the
+    first file of each frame. Times are relative to the injection time if it
+    is known, otherwise to the start of the first frame. Frames are located
+    by AcquisitionTime and ActualFrameDuration, FrameReferenceTime is used if
+    the acquisition time is missing."""
+    starts = []
+    durations = []
+    for frameFile in frameFiles:
+      start = self.timeToSeconds(slicer.dicomDatabase.fileValue(frameFile, self.tags['acquisitionTime']))
+      duration = slicer.dicomDatabase.fileValue(frameFile, self.tags['actualFrameDuration'])
+      duration = float(duration)/1000. if duration else 0.
+      if start is None:
+        referenceTime = slicer.dicomDatabase.fileValue(frameFile, self.tags['frameReferenceTime'])
+        if not referenceTime:
+          logging.warning('Cannot determine frame times, using frame numbers')
+          return np.arange(len(frameFiles), dtype=float)
+        start = float(referenceTime)/1000. - duration/2.
+      starts.append(start)
+      durations.append(duration)
+    starts = np.array(starts)
+    origin = self.timeToSeconds(injectionTime) if injectionTime else None
+    if origin is None:
+      origin = starts.min()
+    # acquisition past midnight
+    starts[starts < origin] += 24*3600
+    return starts - origin + np.array(durations)/2.
+
+  def setFrameMidTimes(self, node, frameMidTimes):
+    node.SetAttribute("DICOM.PET.FrameMidTimes", " ".join(repr(float(t)) for t in frameMidTimes))
+
+  def getFrameMidTimes(self, node):
+    """Return the frame mid times (s) stored on a dynamic PET node at load time, None if unknown"""
+    frameMidTimes = node.GetAttribute("DICOM.PET.FrameMidTimes")
+    if not frameMidTimes:
+      return None
+    return np.array([float(t) for t in frameMidTimes.split()])
+
+  def addFrameToSequence(self, volumeSequenceNode, frame, indexValue):
+    """Add a volume frame to a volume sequence without copying its voxels"""
+    # volumeSequenceNode.SetDataNodeAtValue would deep-copy the volume frame.
+    # To avoid memory reallocation, add an empty node and shallow-copy the contents
+    # of the volume frame.
+
+    # Create an empty volume node in the sequence node
+    proxyVolume = slicer.mrmlScene.AddNewNodeByClass(frame.GetClassName())
+    volumeSequenceNode.SetDataNodeAtValue(proxyVolume, indexValue)
+    slicer.mrmlScene.RemoveNode(proxyVolume)
+
+    # Update the data node
+    shallowCopy = True
+    volumeSequenceNode.UpdateDataNodeAtValue(frame, indexValue, shallowCopy)
+
+  def progressiveLoading(self):
+    """Return True if dynamic series loaded as volume sequences show the first
+    frame immediately and read the other frames in the background
+    (DICOM/PETSUV/ProgressiveLoading setting)."""
+    return slicer.util.settingsValue('DICOM/PETSUV/ProgressiveLoading', False, converter=slicer.util.toBool)
+
+  def loadFrame(self, scalarVolumePlugin, svLoadable):
+    """Load a single frame of a multivolume series with the scalar volume plugin"""
+    frame = scalarVolumePlugin.load(svLoadable)
+
+    # Harden the acquisition transform if there is any
+    # (for example due to varying slice spacing)
+    # and then remove the transform from the scene
+    if frame:
+      parentTransformNode = frame.GetParentTransformNode()
+      if parentTransformNode:
+        frame.HardenTransform()
+        slicer.mrmlScene.RemoveNode(parentTransformNode)
+    return frame
+
   def configureDisplayNode(self, volumeNode, loadable):
     appLogic = slicer.app.applicationLogic()
     selNode = appLogic.GetSelectionNode()
@@ -581,32 +1479,230 @@ class DICOMRWVMPluginClass(DICOMPlugin):
           print('Found Radionuclide Code ' + radionuclideCode)
         except AttributeError:
           volumeNode.SetAttribute('DICOM.RadionuclideCodeValue','unknown')
-      if radiopharmaceuticalCode == 'C-B1031': # FDG
-        displayNode.AutoWindowLevelOff()
-        displayNode.SetWindowLevel(6,3)
-        displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeInvertedGrey')
-      elif radiopharmaceuticalCode == 'C-B1036': # FLT
-        displayNode.AutoWindowLevelOff()
-        displayNode.SetWindowLevel(4,2)
-        displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeInvertedGrey')
-      else: # Default W/L if no info about radiopharmaceutical can be found, often FDG
+      windowLevel = SUVDisplayRange(rwvmPlugin=self).windowLevel(volumeNode) if self.dataDrivenDisplayRange() else None
+      if windowLevel is None:
+        if radiopharmaceuticalCode == 'C-B1031': # FDG
+          (window, level) = (6,3)
+        elif radiopharmaceuticalCode == 'C-B1036': # FLT
+          (window, level) = (4,2)
+        else: # Default W/L if no info about radiopharmaceutical can be found, often FDG
+          (window, level) = (6,3)
+        # window/level are given in SUV, convert if the stored voxels are kept
+        mapping = self.getStoredValueMapping(volumeNode)
+        if mapping:
+          (slope, intercept) = mapping
+          (window, level) = (window/slope, (level-intercept)/slope)
+      else:
+        (window, level) = windowLevel
+      displayNode.AutoWindowLevelOff()
+      displayNode.SetWindowLevel(window,level)
+      displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeInvertedGrey')
+    else:
+      windowLevel = SUVDisplayRange(rwvmPlugin=self).windowLevel(volumeNode) if self.dataDrivenDisplayRange() else None
+      if windowLevel is None:
+        displayNode.SetAutoWindowLevel(1)
+      else:
         displayNode.AutoWindowLevelOff()
-        displayNode.SetWindowLevel(6,3)
-        displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeInvertedGrey')
+        displayNode.SetWindowLevel(*windowLevel)
+
+  def dataDrivenDisplayRange(self):
+    """Return True if window/level are estimated from the voxels (see
+    SUVDisplayRange) rather than set per radiopharmaceutical
+    (DICOM/PETSUV/DataDrivenDisplayRange setting)"""
+    return slicer.util.settingsValue('DICOM/PETSUV/DataDrivenDisplayRange', True, converter=slicer.util.toBool)
+
+  def hasLinearMapping(self, loadable):
+    """Return True if the RWVM of the loadable is a single slope/intercept"""
+    mappings = getattr(loadable, 'mappings', None)
+    return not mappings or (len(mappings) == 1 and mappings[0].isLinear())
+
+  def applyRealWorldValueMappingToNode(self, imageNode, loadable, conversionFactor, files=None):
+    """Map the voxels of imageNode, read from the sorted files (loadable.files
+    by default), to real world values in place. A linear RWVM applies to the
+    modality rescaled voxels, LUT and piecewise mappings to the stored pixel
+    values (see storedPixelValues)."""
+    intercept = getattr(loadable, 'intercept', 0.0)
+    if self.hasLinearMapping(loadable):
+      if self.keepStoredVoxels():
+        # keep the stored voxels, SUV is applied on demand, after the modality
+        # rescale of voxels read by loadStoredVolume
+        (rescaleSlope, rescaleIntercept) = self.getStoredValueMapping(imageNode) or (1.0, 0.0)
+        self.setStoredValueMapping(imageNode, rescaleSlope*float(conversionFactor),
+                                   rescaleIntercept*float(conversionFactor) + intercept)
+      else:
+        # apply the conversion factor and the intercept
+        multiplier = vtk.vtkImageMathematics()
+        multiplier.SetOperationToMultiplyByK()
+        multiplier.SetConstantK(float(conversionFactor))
+        multiplier.SetInput1Data(imageNode.GetImageData())
+        multiplier.Update()
+        output = multiplier.GetOutput()
+        if intercept:
+          adder = vtk.vtkImageMathematics()
+          adder.SetOperationToAddConstant()
+          adder.SetConstantC(float(intercept))
+          adder.SetInput1Data(output)
+          adder.Update()
+          output = adder.GetOutput()
+        imageNode.GetImageData().DeepCopy(output)
+    else:
+      storedValues = self.storedPixelValues(imageNode, loadable.files if files is None else files)
+      slicer.util.updateVolumeFromArray(imageNode, self.applyRealWorldValueMapping(storedValues, loadable.mappings))
+      self.removeStoredValueMapping(imageNode)
+
+  def storedPixelValues(self, imageNode, files):
+    """Return the stored pixel values of a volume read from the sorted files,
+    one file per slice. Voxels read by the scalar volume plugin are modality
+    rescaled, the RescaleSlope/Intercept of each slice is undone. A single
+    (multiframe) file applies its rescale to all slices."""
+    voxels = slicer.util.arrayFromVolume(imageNode)
+    if self.getStoredValueMapping(imageNode):
+      # read by loadStoredVolume, the mapping is the modality rescale
+      return voxels
+    rescale = [(float(slicer.dicomDatabase.fileValue(dicomFile, self.tags['rescaleSlope']) or 1.0),
+                float(slicer.dicomDatabase.fileValue(dicomFile, self.tags['rescaleIntercept']) or 0.0))
+               for dicomFile in files]
+    if len(rescale) != voxels.shape[0]:
+      rescale = rescale[:1]*voxels.shape[0]
+    (slopes, intercepts) = (np.array(values, dtype=np.float64).reshape(-1, 1, 1) for values in zip(*rescale))
+    return ((voxels - intercepts) / slopes).astype(np.float32)
+
+  def mapSlice(self, pixels, ds, loadable, conversionFactor, out):
+    """Write the real world values of the stored pixels of slice dataset ds
+    into the float32 array out. A linear RWVM is applied after the modality
+    rescale in one multiply-add, LUT and piecewise mappings to the stored
+    pixel values."""
+    if self.hasLinearMapping(loadable):
+      conversionFactor = float(conversionFactor)
+      np.multiply(pixels, float(getattr(ds, 'RescaleSlope', 1.0))*conversionFactor, out=out, casting='unsafe')
+      out += float(getattr(ds, 'RescaleIntercept', 0.0))*conversionFactor + getattr(loadable, 'intercept', 0.0)
     else:
-      displayNode.SetAutoWindowLevel(1)
+      out[...] = self.applyRealWorldValueMapping(pixels, loadable.mappings)
+
+  def applyRealWorldValueMapping(self, voxels, mappings):
+    """Return the real world values (float32) of an array of stored values.
+
+    A single linear item is applied as one multiply-add. Several linear items
+    are applied piecewise over their value ranges. As soon as a LUT is
+    involved, all items are merged into one lookup table over the combined
+    value range and applied with a single np.take. Stored values that are not
+    covered by any item map to 0.
+    """
+    if len(mappings) == 1 and mappings[0].isLinear():
+      item = mappings[0]
+      realWorldValues = np.multiply(voxels, item.slope, dtype=np.float32)
+      if item.intercept:
+        realWorldValues += item.intercept
+      return realWorldValues
+
+    ranges = [item.valueRange() for item in mappings]
+    if all(item.isLinear() for item in mappings):
+      conditions = [(voxels >= first) & (voxels <= last) for (first, last) in ranges]
+      choices = [np.multiply(voxels, item.slope, dtype=np.float32) + np.float32(item.intercept) for item in mappings]
+      return np.select(conditions, choices, default=0).astype(np.float32, copy=False)
+
+    first = min(itemFirst for (itemFirst, itemLast) in ranges)
+    last = max(itemLast for (itemFirst, itemLast) in ranges)
+    # one padding entry on each side collects values outside of the mapped range
+    lut = np.zeros(last - first + 3, dtype=np.float32)
+    for item, (itemFirst, itemLast) in zip(mappings, ranges):
+      storedValues = np.arange(itemFirst, itemLast + 1)
+      if item.isLinear():
+        values = storedValues * item.slope + item.intercept
+      else:
+        values = item.lutData[:len(storedValues)]
+      lut[itemFirst - first + 1:itemFirst - first + 1 + len(values)] = values
+    indices = np.rint(voxels).astype(np.int64) if voxels.dtype.kind == 'f' else voxels.astype(np.int64)
+    indices -= first - 1
+    np.clip(indices, 0, len(lut) - 1, out=indices)
+    return np.take(lut, indices)
+
+  def keepStoredVoxels(self):
+    """Return True if loaded volumes keep their stored voxels and record the
+    mapping to SUV as node attributes instead of being converted to SUV at
+    load time (DICOM/PETSUV/KeepStoredVoxels setting).
+
+    Volumes and volume sequence frames whose slices share one RescaleSlope
+    and RescaleIntercept keep the stored int16/uint16 pixels, the mapping
+    combines the modality rescale and the RWVM. Other series and multivolumes
+    keep the rescaled float voxels, only the RWVM multiply is deferred. The
+    Data Probe shows the kept voxel values, use arrayFromSUVVolume for SUV."""
+    return slicer.util.settingsValue('DICOM/PETSUV/KeepStoredVoxels', False, converter=slicer.util.toBool)
+
+  def setStoredValueMapping(self, node, slope, intercept=0.0):
+    """Record the mapping from stored voxel values to SUV on a node"""
+    node.SetAttribute("DICOM.RWV.Slope", repr(float(slope)))
+    node.SetAttribute("DICOM.RWV.Intercept", repr(float(intercept)))
+
+  def getStoredValueMapping(self, node):
+    """Return (slope, intercept) if the voxels of node are stored values that
+    still have to be mapped to SUV, None if the voxels are already SUV"""
+    slope = node.GetAttribute("DICOM.RWV.Slope")
+    if not slope:
+      return None
+    intercept = node.GetAttribute("DICOM.RWV.Intercept")
+    return (float(slope), float(intercept) if intercept else 0.0)
+
+  def arrayFromSUVVolume(self, volumeNode):
+    """Return the voxels of a loaded PET volume in SUV, applying the stored
+    value mapping on the fly for volumes that keep their stored voxels.
+    Use this instead of slicer.util.arrayFromVolume for statistics."""
+    voxels = slicer.util.arrayFromVolume(SUVMemoryBudget.ensureLoaded(volumeNode))
+    mapping = self.getStoredValueMapping(volumeNode)
+    if mapping is None:
+      return voxels
+    (slope, intercept) = mapping
+    suv = np.multiply(voxels, slope, dtype=np.float32)
+    if intercept:
+      suv += intercept
+    return suv
+
+  def materializeSUVVolume(self, node):
+    """Convert a volume (or all volumes of a volume sequence) that keeps its
+    stored voxels into a float SUV volume in place"""
+    mapping = self.getStoredValueMapping(node)
+    if mapping is None:
+      return
+    if node.IsA('vtkMRMLSequenceNode'):
+      for index in range(node.GetNumberOfDataNodes()):
+        dataNode = node.GetNthDataNode(index)
+        if self.getStoredValueMapping(dataNode) is None:
+          self.setStoredValueMapping(dataNode, *mapping)
+        self.materializeSUVVolume(dataNode)
+      self.removeStoredValueMapping(node)
+      return
+    (slope, intercept) = mapping
+    slicer.util.updateVolumeFromArray(node, self.arrayFromSUVVolume(node))
+    self.removeStoredValueMapping(node)
+    displayNode = node.GetDisplayNode()
+    if displayNode and displayNode.IsA('vtkMRMLScalarVolumeDisplayNode') and not displayNode.GetAutoWindowLevel():
+      displayNode.SetWindowLevel(displayNode.GetWindow()*slope, displayNode.GetLevel()*slope+intercept)
+
+  def removeStoredValueMapping(self, node):
+    node.RemoveAttribute("DICOM.RWV.Slope")
+    node.RemoveAttribute("DICOM.RWV.Intercept")
+
+  def resampleToCT(self, petNode, ctNode, interpolation='linear'):
+    """Return the SUV of a loaded PET volume resampled onto the grid of a CT
+    volume of the same frame of reference (see SUVResampler)"""
+    return SUVResampler(rwvmPlugin=self).resample(petNode, ctNode, interpolation)
+
+  def exportParametricMap(self, volumeNode, outputDirectory, addToDatabase=True):
+    """Write an SUV volume loaded by this plugin as DICOM Parametric Map
+    (see ParametricMapExporter) into outputDirectory, optionally add it to
+    the DICOM database, and return the file name. Raises ValueError for
+    volumes that are not in SUV units."""
+    fileName = ParametricMapExporter(rwvmPlugin=self).export(volumeNode, outputDirectory)
+    if addToDatabase:
+      indexer = ctk.ctkDICOMIndexer()
+      indexer.addFile(slicer.dicomDatabase, fileName)
+    return fileName
 
   def conversion(self, loadable, imageNode, conversionFactor, files):
     # Create volume node
     # imageNode = self.scalarVolumePlugin.loadFilesWithArchetype(loadable.files, loadable.name)
     if imageNode:
-      # apply the conversion factor
-      multiplier = vtk.vtkImageMathematics()
-      multiplier.SetOperationToMultiplyByK()
-      multiplier.SetConstantK(float(conversionFactor))
-      multiplier.SetInput1Data(imageNode.GetImageData())
-      multiplier.Update()
-      imageNode.GetImageData().DeepCopy(multiplier.GetOutput())
+      self.applyRealWorldValueMappingToNode(imageNode, loadable, conversionFactor, files)
 
       # create list of DICOM instance UIDs corresponding to the loaded files
       instanceUIDs = ""
@@ -647,6 +1743,1051 @@ class DICOMRWVMPluginClass(DICOMPlugin):
     return imageNode
 
 
+class SUVQuantification:
+  """SUVmax, SUVpeak, SUVmean, metabolic volume and TLG of PET volumes loaded
+  by DICOMRWVMPluginClass (scalar volumes, multivolumes and volume sequences).
+
+  SUVpeak is the highest mean SUV in a sphere of peakVolumeMl (1 ml, radius
+  6.2 mm) centered on a voxel of the region. The sphere is sampled with
+  partial voxel weights at the voxel spacing of the volume, so anisotropic
+  spacing is handled, and the sphere mean of all voxels is computed at once
+  with an FFT convolution over the bounding box of the region. Frames of
+  dynamic series are quantified in parallel (numpy releases the GIL in the
+  FFT and most array operations).
+
+  The label map must have the geometry of the PET volume.
+  """
+
+  def __init__(self, peakVolumeMl=1.0, numberOfThreads=None, rwvmPlugin=None):
+    self.peakVolumeMl = peakVolumeMl
+    self.numberOfThreads = numberOfThreads or os.cpu_count() or 1
+    self.rwvmPlugin = rwvmPlugin or DICOMRWVMPluginClass()
+
+  def quantify(self, volumeNode, labelmapNode=None, label=None, threshold=None):
+    """Return a dictionary of SUV metrics for a PET volume, or a list of
+    dictionaries (one per frame) for a multivolume or volume sequence.
+
+    The region is the voxels of labelmapNode equal to label (any non-zero
+    label if label is None), optionally restricted to voxels with SUV >= threshold.
+    Without label map the region is the voxels above threshold (whole volume
+    if no threshold is given either).
+    """
+    labels = slicer.util.arrayFromVolume(labelmapNode) if labelmapNode else None
+    if labels is not None:
+      mask = (labels != 0) if label is None else (labels == label)
+    else:
+      mask = None
+
+    frames = self.suvFrames(volumeNode)
+    spacing = self.spacingKJI(volumeNode)
+    if len(frames) == 1 and not self.isDynamic(volumeNode):
+      return self.quantifyArray(frames[0](), spacing, mask, threshold)
+    with ThreadPoolExecutor(max_workers=self.numberOfThreads) as executor:
+      return list(executor.map(lambda frame: self.quantifyArray(frame(), spacing, mask, threshold), frames))
+
+  def isDynamic(self, volumeNode):
+    return volumeNode.IsA('vtkMRMLSequenceNode') or volumeNode.IsA('vtkMRMLMultiVolumeNode')
+
+  def spacingKJI(self, volumeNode):
+    """Voxel spacing (mm) in the axis order of slicer.util.arrayFromVolume"""
+    if volumeNode.IsA('vtkMRMLSequenceNode'):
+      volumeNode = volumeNode.GetNthDataNode(0)
+    return tuple(reversed(volumeNode.GetSpacing()))
+
+  def suvFrames(self, volumeNode):
+    """Return one callable per frame returning the SUV voxels (KJI) of the
+    frame, so that the stored value mapping is applied in the worker threads"""
+    def mapped(voxels, mapping):
+      if mapping is None:
+        return voxels
+      (slope, intercept) = mapping
+      suv = np.multiply(voxels, slope, dtype=np.float32)
+      if intercept:
+        suv += intercept
+      return suv
+
+    if volumeNode.IsA('vtkMRMLSequenceNode'):
+      sequenceMapping = self.rwvmPlugin.getStoredValueMapping(volumeNode)
+      frames = []
+      for index in range(volumeNode.GetNumberOfDataNodes()):
+        dataNode = volumeNode.GetNthDataNode(index)
+        mapping = self.rwvmPlugin.getStoredValueMapping(dataNode) or sequenceMapping
+        voxels = slicer.util.arrayFromVolume(SUVMemoryBudget.ensureLoaded(dataNode))
+        frames.append(lambda voxels=voxels, mapping=mapping: mapped(voxels, mapping))
+      return frames
+
+    voxels = slicer.util.arrayFromVolume(SUVMemoryBudget.ensureLoaded(volumeNode))
+    mapping = self.rwvmPlugin.getStoredValueMapping(volumeNode)
+    if volumeNode.IsA('vtkMRMLMultiVolumeNode'):
+      # frames are the last axis of the multivolume array
+      return [lambda frame=frame: mapped(np.ascontiguousarray(voxels[..., frame]), mapping)
+              for frame in range(voxels.shape[-1])]
+    return [lambda: mapped(voxels, mapping)]
+
+  def quantifyArray(self, suv, spacing, mask=None, threshold=None):
+    """Return SUV metrics of the region mask (boolean, same shape as suv) of
+    an SUV array with the given voxel spacing (mm, same axis order as suv)"""
+    region = np.ones(suv.shape, dtype=bool) if mask is None else mask
+    if threshold is not None:
+      region = region & (suv >= threshold)
+    voxelCount = int(np.count_nonzero(region))
+    if voxelCount == 0:
+      return {'voxelCount': 0, 'volume': 0.0, 'SUVmax': float('nan'),
+              'SUVpeak': float('nan'), 'SUVmean': float('nan'), 'TLG': 0.0}
+
+    regionValues = suv[region]
+    suvMean = float(regionValues.mean(dtype=np.float64))
+    volumeMl = voxelCount * float(np.prod(spacing)) / 1000.0
+    return {'voxelCount': voxelCount,
+            'volume': volumeMl,
+            'SUVmax': float(regionValues.max()),
+            'SUVpeak': self.suvPeak(suv, spacing, region),
+            'SUVmean': suvMean,
+            'TLG': suvMean * volumeMl}
+
+  def sphereRadius(self):
+    """Radius (mm) of the SUVpeak sphere"""
+    return (3.0 * self.peakVolumeMl * 1000.0 / (4.0 * np.pi)) ** (1.0 / 3.0)
+
+  def sphereKernel(self, spacing, supersampling=4):
+    """Return the fraction of every voxel (of the given spacing) inside the
+    SUVpeak sphere centered on the middle voxel"""
+    radius = self.sphereRadius()
+    halfSize = [int(np.ceil(radius / axisSpacing)) for axisSpacing in spacing]
+    # sub-voxel sample positions, in voxels relative to the voxel center
+    offsets = (np.arange(supersampling) + 0.5) / supersampling - 0.5
+    axes = [((np.arange(-h, h + 1)[:, np.newaxis] + offsets) * axisSpacing).ravel()
+            for h, axisSpacing in zip(halfSize, spacing)]
+    distance2 = (axes[0][:, np.newaxis, np.newaxis] ** 2
+                 + axes[1][np.newaxis, :, np.newaxis] ** 2
+                 + axes[2][np.newaxis, np.newaxis, :] ** 2)
+    inside = (distance2 <= radius * radius).reshape(
+      2 * halfSize[0] + 1, supersampling, 2 * halfSize[1] + 1, supersampling, 2 * halfSize[2] + 1, supersampling)
+    return inside.mean(axis=(1, 3, 5))
+
+  def suvPeak(self, suv, spacing, region):
+    """Return the highest sphere mean SUV centered on a voxel of region"""
+    kernel = self.sphereKernel(spacing)
+    halfSize = [k // 2 for k in kernel.shape]
+
+    # only the bounding box of the region, extended by the sphere radius, is needed
+    indices = np.nonzero(region.any(axis=(1, 2)))[0], np.nonzero(region.any(axis=(0, 2)))[0], np.nonzero(region.any(axis=(0, 1)))[0]
+    box = tuple(slice(max(axisIndices[0] - h, 0), min(axisIndices[-1] + h + 1, n))
+                for axisIndices, h, n in zip(indices, halfSize, suv.shape))
+    sphereMean = self.sphereMeanImage(suv[box].astype(np.float64), kernel)
+    return float(sphereMean[region[box]].max())
+
+  def sphereMeanImage(self, image, kernel):
+    """Mean of image in the kernel centered on every voxel. Near the image
+    border only the kernel weights inside the image are used."""
+    fullShape = [n + k - 1 for n, k in zip(image.shape, kernel.shape)]
+    fftShape = [self.fftLength(n) for n in fullShape]
+    spectrum = np.fft.rfftn(image, fftShape) * np.fft.rfftn(kernel[::-1, ::-1, ::-1], fftShape)
+    full = np.fft.irfftn(spectrum, fftShape)
+    same = tuple(slice(k // 2, k // 2 + n) for n, k in zip(image.shape, kernel.shape))
+    return full[same] / self.kernelWeightInside(image.shape, kernel)
+
+  def kernelWeightInside(self, shape, kernel):
+    """Sum of the kernel weights inside an image of the given shape for every
+    kernel position. The image indicator is separable, so this is three
+    small tensor contractions instead of another convolution."""
+    indicators = []
+    for n, k in zip(shape, kernel.shape):
+      # indicator[i, a]: voxel i + a - k//2 is inside the image
+      positions = np.arange(n)[:, np.newaxis] + np.arange(k)[np.newaxis, :] - k // 2
+      indicators.append(((positions >= 0) & (positions < n)).astype(np.float64))
+    weights = np.tensordot(kernel, indicators[2], axes=([2], [1]))   # (a, b, z)
+    weights = np.tensordot(weights, indicators[1], axes=([1], [1]))  # (a, z, y)
+    weights = np.tensordot(weights, indicators[0], axes=([0], [1]))  # (z, y, x)
+    return weights.transpose(2, 1, 0)
+
+  def fftLength(self, n):
+    """Smallest length >= n that only has the prime factors 2, 3 and 5"""
+    while True:
+      m = n
+      for p in (2, 3, 5):
+        while m % p == 0:
+          m //= p
+      if m == 1:
+        return n
+      n += 1
+
+
+class TimeActivityCurves:
+  """Time-activity curves of all labels of a label map over the frames of a
+  dynamic PET series loaded by DICOMRWVMPluginClass (multivolume or volume
+  sequence).
+
+  The voxels of all labels are gathered once into a (voxels, frames) array
+  sorted by label, and mean and max of every label and frame are computed
+  with a single reduceat pass. The stored value mapping of compact mode is
+  applied to the reduced curves instead of the voxels.
+
+  The label map must have the geometry of the PET frames.
+  """
+
+  def __init__(self, rwvmPlugin=None):
+    self.rwvmPlugin = rwvmPlugin or DICOMRWVMPluginClass()
+
+  def compute(self, volumeNode, labelmapNode):
+    """Return a dictionary with
+      labels: label values (L)
+      times: frame mid times in s (F)
+      mean, max: curves (F, L)
+      count: number of voxels of every label (L)
+    """
+    labels = slicer.util.arrayFromVolume(labelmapNode).ravel()
+    roi = np.flatnonzero(labels)
+    labelValues, labelIndex = np.unique(labels[roi], return_inverse=True)
+    order = np.argsort(labelIndex, kind='stable')
+    roi = roi[order]
+    counts = np.bincount(labelIndex, minlength=len(labelValues))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+
+    (values, slopes, intercepts) = self.frameValues(volumeNode, roi)
+    nFrames = len(slopes)
+    if len(labelValues):
+      mean = np.add.reduceat(values, starts, axis=0, dtype=np.float64) / counts[:, np.newaxis]
+      maximum = np.maximum.reduceat(values, starts, axis=0).astype(np.float64)
+    else:
+      mean = maximum = np.zeros((0, nFrames))
+    mean = mean.T*slopes[:, np.newaxis] + intercepts[:, np.newaxis]
+    maximum = maximum.T*slopes[:, np.newaxis] + intercepts[:, np.newaxis]
+
+    times = self.rwvmPlugin.getFrameMidTimes(volumeNode)
+    if times is None or len(times) != nFrames:
+      logging.warning('No frame times found on %s, using frame numbers' % volumeNode.GetName())
+      times = np.arange(nFrames, dtype=float)
+    return {'labels': labelValues, 'times': times, 'mean': mean, 'max': maximum, 'count': counts}
+
+  def frameValues(self, volumeNode, roi):
+    """Return the stored voxels at the flat indices roi of all frames as a
+    (voxels, frames) array, and the slope and intercept of every frame"""
+    def mapping(node, default=(1.0, 0.0)):
+      return self.rwvmPlugin.getStoredValueMapping(node) or default
+
+    if volumeNode.IsA('vtkMRMLSequenceNode'):
+      sequenceMapping = mapping(volumeNode)
+      nFrames = volumeNode.GetNumberOfDataNodes()
+      frameMappings = []
+      values = None
+      for frame in range(nFrames):
+        dataNode = volumeNode.GetNthDataNode(frame)
+        frameValues = slicer.util.arrayFromVolume(SUVMemoryBudget.ensureLoaded(dataNode)).ravel()[roi]
+        if values is None:
+          values = np.empty((len(roi), nFrames), dtype=frameValues.dtype)
+        values[:, frame] = frameValues
+        frameMappings.append(mapping(dataNode, sequenceMapping))
+    else:
+      voxels = slicer.util.arrayFromVolume(volumeNode)
+      if volumeNode.IsA('vtkMRMLMultiVolumeNode'):
+        values = voxels.reshape(-1, voxels.shape[-1])[roi]
+      else:
+        values = voxels.reshape(-1, 1)[roi]
+      frameMappings = [mapping(volumeNode)]*values.shape[1]
+    slopes = np.array([slope for (slope, intercept) in frameMappings])
+    intercepts = np.array([intercept for (slope, intercept) in frameMappings])
+    return (values, slopes, intercepts)
+
+
+class ParametricImaging:
+  """Voxelwise Patlak (Ki, intercept) and Logan (distribution volume,
+  intercept) images of a dynamic PET series loaded by DICOMRWVMPluginClass
+  (multivolume or volume sequence) and a plasma input function.
+
+  The input function (times in s, values in the units of the loaded voxels)
+  is interpolated at the frame mid times stored on the node at load time.
+  Only frames with a mid time >= startTime are used for the linear fit.
+  Each fit is an ordinary least squares line solved in closed form over all
+  voxels at once; blocks of slices are processed in a thread pool.
+  """
+
+  def __init__(self, numberOfThreads=None, rwvmPlugin=None):
+    self.numberOfThreads = numberOfThreads or os.cpu_count() or 1
+    self.rwvmPlugin = rwvmPlugin or DICOMRWVMPluginClass()
+
+  def patlak(self, volumeNode, inputTimes, inputValues, startTime, name=None):
+    """Return (Ki, intercept) scalar volume nodes"""
+    (times, shape, frameSlices, slopes, intercepts) = self.dynamicData(volumeNode)
+    (cp, cpIntegral) = self.inputFunction(times, inputTimes, inputValues)
+    selected = self.selectFrames(times, startTime)
+
+    # the abscissa is the same for all voxels, so the normal equations are shared
+    x = cpIntegral[selected] / cp[selected]
+    xCentered = x - x.mean()
+    xVariance = np.dot(xCentered, xCentered)
+
+    def fit(block):
+      y = block[:, selected] / cp[selected]
+      ki = np.dot(y, xCentered) / xVariance
+      return (ki, y.mean(axis=1) - ki*x.mean())
+
+    (ki, intercept) = self.processBlocks(shape, frameSlices, slopes, intercepts, fit)
+    name = name or volumeNode.GetName()
+    return (self.createParametricVolume(volumeNode, ki, name + ' Patlak Ki'),
+            self.createParametricVolume(volumeNode, intercept, name + ' Patlak intercept'))
+
+  def logan(self, volumeNode, inputTimes, inputValues, startTime, name=None):
+    """Return (distribution volume, intercept) scalar volume nodes. Voxels
+    without positive activity in all fitted frames are set to 0."""
+    (times, shape, frameSlices, slopes, intercepts) = self.dynamicData(volumeNode)
+    (cp, cpIntegral) = self.inputFunction(times, inputTimes, inputValues)
+    selected = self.selectFrames(times, startTime)
+    # trapezoid from t=0 (no activity) over the frame mid times
+    dt = np.diff(np.concatenate(([0.], times)))
+
+    def fit(block):
+      previous = np.concatenate((np.zeros((block.shape[0], 1)), block[:, :-1]), axis=1)
+      ctIntegral = np.cumsum((block + previous)/2. * dt, axis=1)[:, selected]
+      ct = block[:, selected]
+      valid = np.all(ct > 0, axis=1)
+      ct = np.where(valid[:, np.newaxis], ct, 1.)
+      x = cpIntegral[selected] / ct
+      y = ctIntegral / ct
+      # per voxel 2x2 normal equations
+      n = x.shape[1]
+      sx = x.sum(axis=1)
+      sy = y.sum(axis=1)
+      sxx = np.einsum('ij,ij->i', x, x)
+      sxy = np.einsum('ij,ij->i', x, y)
+      determinant = n*sxx - sx*sx
+      valid &= determinant > 0
+      determinant[~valid] = 1.
+      dv = np.where(valid, (n*sxy - sx*sy) / determinant, 0.)
+      return (dv, np.where(valid, (sy - dv*sx) / n, 0.))
+
+    (dv, intercept) = self.processBlocks(shape, frameSlices, slopes, intercepts, fit)
+    name = name or volumeNode.GetName()
+    return (self.createParametricVolume(volumeNode, dv, name + ' Logan DV'),
+            self.createParametricVolume(volumeNode, intercept, name + ' Logan intercept'))
+
+  def inputFunction(self, times, inputTimes, inputValues):
+    """Return the input function and its integral from 0 at the frame mid times"""
+    inputTimes = np.asarray(inputTimes, dtype=float)
+    inputValues = np.asarray(inputValues, dtype=float)
+    if inputTimes[0] > 0:
+      inputTimes = np.concatenate(([0.], inputTimes))
+      inputValues = np.concatenate(([0.], inputValues))
+    cumulative = np.concatenate(([0.], np.cumsum(np.diff(inputTimes) * (inputValues[1:] + inputValues[:-1]) / 2.)))
+    cp = np.interp(times, inputTimes, inputValues)
+    if np.any(cp <= 0):
+      raise ValueError('Input function must be positive at the frame times')
+    return (cp, np.interp(times, inputTimes, cumulative))
+
+  def selectFrames(self, times, startTime):
+    selected = np.flatnonzero(times >= startTime)
+    if len(selected) < 2:
+      raise ValueError('At least two frames after %g s are needed for the fit' % startTime)
+    return selected
+
+  def dynamicData(self, volumeNode):
+    """Return frame mid times, the (K, J, I) shape of a frame, a function
+    returning the stored voxels of a range of slices of all frames as
+    (K, J, I, F), and the stored value slope and intercept of every frame"""
+    times = self.rwvmPlugin.getFrameMidTimes(volumeNode)
+    if times is None:
+      raise ValueError('%s has no frame times, load it with the PET plugins' % volumeNode.GetName())
+    if volumeNode.IsA('vtkMRMLSequenceNode'):
+      sequenceMapping = self.rwvmPlugin.getStoredValueMapping(volumeNode) or (1.0, 0.0)
+      dataNodes = [volumeNode.GetNthDataNode(index) for index in range(volumeNode.GetNumberOfDataNodes())]
+      frames = [slicer.util.arrayFromVolume(SUVMemoryBudget.ensureLoaded(dataNode)) for dataNode in dataNodes]
+      mappings = [self.rwvmPlugin.getStoredValueMapping(dataNode) or sequenceMapping for dataNode in dataNodes]
+      frameSlices = lambda first, last: np.stack([frame[first:last] for frame in frames], axis=-1)
+      shape = frames[0].shape
+    else:
+      voxels = slicer.util.arrayFromVolume(volumeNode)
+      mappings = [self.rwvmPlugin.getStoredValueMapping(volumeNode) or (1.0, 0.0)] * voxels.shape[-1]
+      frameSlices = lambda first, last: voxels[first:last]
+      shape = voxels.shape[:3]
+    if len(times) != len(mappings):
+      raise ValueError('Number of frame times does not match the number of frames')
+    slopes = np.array([slope for (slope, intercept) in mappings])
+    intercepts = np.array([intercept for (slope, intercept) in mappings])
+    return (times, shape, frameSlices, slopes, intercepts)
+
+  def processBlocks(self, shape, frameSlices, slopes, intercepts, fit):
+    """Apply fit to blocks of slices in parallel. fit gets the (voxels, frames)
+    values of a block and returns a tuple of per voxel parameters.
+    Returns a tuple of (K, J, I) float32 parameter images."""
+    numberOfSlices = shape[0]
+    bounds = np.linspace(0, numberOfSlices, min(numberOfSlices, self.numberOfThreads*4) + 1).astype(int)
+
+    def processBlock(first, last):
+      block = frameSlices(first, last)
+      values = block.reshape(-1, block.shape[-1]) * slopes + intercepts
+      return fit(values)
+
+    with ThreadPoolExecutor(max_workers=self.numberOfThreads) as executor:
+      results = list(executor.map(processBlock, bounds[:-1], bounds[1:]))
+    return tuple(np.concatenate([result[index] for result in results]).reshape(shape).astype(np.float32)
+                 for index in range(len(results[0])))
+
+  def createParametricVolume(self, referenceNode, voxels, name):
+    """Create a scalar volume with the geometry of a frame of referenceNode,
+    in the same study as referenceNode"""
+    geometryNode = referenceNode.GetNthDataNode(0) if referenceNode.IsA('vtkMRMLSequenceNode') else referenceNode
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', slicer.mrmlScene.GenerateUniqueName(name))
+    ijkToRAS = vtk.vtkMatrix4x4()
+    geometryNode.GetIJKToRASMatrix(ijkToRAS)
+    volumeNode.SetIJKToRASMatrix(ijkToRAS)
+    slicer.util.updateVolumeFromArray(volumeNode, voxels)
+    volumeNode.CreateDefaultDisplayNodes()
+
+    if referenceNode.IsA('vtkMRMLSequenceNode'):
+      # the proxy node of a sequence is the one shown in subject hierarchy
+      browserNode = slicer.modules.sequences.logic().GetFirstBrowserNodeForSequenceNode(referenceNode)
+      if browserNode:
+        referenceNode = browserNode.GetProxyNode(referenceNode)
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    referenceItem = shNode.GetItemByDataNode(referenceNode)
+    if referenceItem:
+      shNode.SetItemParent(shNode.GetItemByDataNode(volumeNode), shNode.GetItemParent(referenceItem))
+    return volumeNode
+
+
+class ParametricMapExporter:
+  """Write SUV volumes loaded by DICOMRWVMPluginClass (scalar volumes,
+  multivolumes and volume sequences) as DICOM Parametric Maps with 32 bit
+  float pixel data, one frame per slice of every time frame, like the
+  --parametricMapDICOMPath output of the SUV Factor Calculator CLI.
+
+  The map is written from the voxels of the volume in the scene, with the
+  real world value mapping it was loaded with (stored value mapping of
+  int16 volumes, LUTs and per bed slopes are already applied). Patient,
+  study and frame of reference are copied from the first PET instance the
+  volume was loaded from. The SUV voxels of all frames are gathered into one
+  contiguous float32 array that becomes the Float Pixel Data as is. Only SUV
+  volumes can be exported. Requires pydicom.
+  """
+
+  sopClassUID = '1.2.840.10008.5.1.4.1.1.30'
+  # units of the volumes that can be exported, the SUV variants of the CLI
+  supportedUnits = ('{SUVbw}g/ml', '{SUVlbm}g/ml', '{SUVbsa}cm2/ml', '{SUVibw}g/ml')
+  # attributes copied from the PET instance, the modules dcmHelpersCommon copies in the CLI
+  sourceKeywords = ('PatientName', 'PatientID', 'IssuerOfPatientID', 'PatientBirthDate', 'PatientSex',
+    'PatientBirthTime', 'OtherPatientIDsSequence', 'EthnicGroup', 'PatientComments', 'PatientIdentityRemoved',
+    'DeidentificationMethod', 'DeidentificationMethodCodeSequence',
+    'ClinicalTrialSponsorName', 'ClinicalTrialProtocolID', 'ClinicalTrialProtocolName', 'ClinicalTrialSiteID',
+    'ClinicalTrialSiteName', 'ClinicalTrialSubjectID', 'ClinicalTrialSubjectReadingID',
+    'StudyInstanceUID', 'StudyDate', 'StudyTime', 'ReferringPhysicianName', 'StudyID', 'AccessionNumber',
+    'StudyDescription', 'PatientAge', 'PatientSize', 'PatientWeight',
+    'FrameOfReferenceUID', 'PositionReferenceIndicator', 'Modality')
+
+  def __init__(self, rwvmPlugin=None):
+    self.rwvmPlugin = rwvmPlugin or DICOMRWVMPluginClass()
+
+  def export(self, volumeNode, outputDirectory, sourceDataset=None, seriesDescription=None, seriesNumber=1001):
+    """Write volumeNode into outputDirectory as <SOPInstanceUID>.dcm and
+    return the file name. sourceDataset is the header of a PET instance of
+    the volume, by default the first referenced instance in the database."""
+    units = self.units(volumeNode)
+    instanceUIDs = self.referencedInstanceUIDs(volumeNode)
+    if sourceDataset is None:
+      sourceDataset = self.sourceDataset(instanceUIDs)
+    (voxels, timeFrames) = self.voxelFrames(volumeNode)
+    dataset = self.createDataset(sourceDataset, voxels, timeFrames, self.geometry(volumeNode), units, instanceUIDs,
+                                 seriesDescription or units[2], seriesNumber)
+    fileName = os.path.join(outputDirectory, dataset.SOPInstanceUID + '.dcm')
+    dataset.save_as(fileName)
+    return fileName
+
+  def frameNodes(self, volumeNode):
+    if volumeNode.IsA('vtkMRMLSequenceNode'):
+      return [volumeNode.GetNthDataNode(index) for index in range(volumeNode.GetNumberOfDataNodes())]
+    return [volumeNode]
+
+  def referencedInstanceUIDs(self, volumeNode):
+    """Return the PET instance UIDs the volume was loaded from, in load order"""
+    instanceUIDs = []
+    for node in [volumeNode] + self.frameNodes(volumeNode):
+      for uid in (node.GetAttribute("DICOM.instanceUIDs") or "").split():
+        if uid != "Unknown" and uid not in instanceUIDs:
+          instanceUIDs.append(uid)
+    return instanceUIDs
+
+  def sourceDataset(self, instanceUIDs):
+    fileName = slicer.dicomDatabase.fileForInstance(instanceUIDs[0]) if instanceUIDs else None
+    if not fileName:
+      raise ValueError('The PET instances of the volume are not in the DICOM database')
+    return pydicom.dcmread(fileName, stop_before_pixels=True)
+
+  def voxelFrames(self, volumeNode):
+    """Return the SUV voxels of all time frames as one contiguous float32
+    array of frames (time frame major, then slice) and the number of time frames"""
+    frames = SUVQuantification(rwvmPlugin=self.rwvmPlugin).suvFrames(volumeNode)
+    first = frames[0]()
+    numberOfSlices = first.shape[0]
+    voxels = np.empty((len(frames)*numberOfSlices,) + first.shape[1:], dtype=np.float32)
+    voxels[:numberOfSlices] = first
+    for index, frame in enumerate(frames[1:], 1):
+      voxels[index*numberOfSlices:(index+1)*numberOfSlices] = frame()
+    return (voxels, len(frames))
+
+  def geometry(self, volumeNode):
+    """Return the LPS origin, the LPS directions of increasing I, J and K and
+    the (I, J, K) spacing of the volume (of its first frame for sequences)"""
+    node = self.frameNodes(volumeNode)[0]
+    directions = vtk.vtkMatrix4x4()
+    node.GetIJKToRASDirectionMatrix(directions)
+    rasToLPS = np.array([-1., -1., 1.])
+    axes = [np.array([directions.GetElement(row, column) for row in range(3)]) * rasToLPS for column in range(3)]
+    return (np.array(node.GetOrigin()) * rasToLPS, axes, node.GetSpacing())
+
+  def units(self, volumeNode):
+    """Return code value, coding scheme designator and meaning of the voxel
+    units, raise ValueError if the volume is not an SUV volume"""
+    node = self.frameNodes(volumeNode)[0]
+    units = node.GetVoxelValueUnits() if node and hasattr(node, 'GetVoxelValueUnits') else None
+    codeValue = units.GetCodeValue() if units else None
+    if codeValue not in self.supportedUnits:
+      raise ValueError(f"{volumeNode.GetName()} has units {codeValue or 'none'}, only SUV volumes "
+                       f"({', '.join(self.supportedUnits)}) can be exported as parametric map")
+    return (codeValue, units.GetCodingSchemeDesignator(), units.GetCodeMeaning())
+
+  @staticmethod
+  def codeItem(codeValue, codingSchemeDesignator, codeMeaning):
+    item = pydicom.dataset.Dataset()
+    item.CodeValue = codeValue
+    item.CodingSchemeDesignator = codingSchemeDesignator
+    item.CodeMeaning = codeMeaning
+    return item
+
+  def createDataset(self, sourceDataset, voxels, timeFrames, geometry, units, instanceUIDs,
+                    seriesDescription, seriesNumber):
+    Dataset = pydicom.dataset.Dataset
+    (origin, axes, spacing) = geometry
+    numberOfSlices = voxels.shape[0] // timeFrames
+
+    meta = pydicom.dataset.FileMetaDataset()
+    meta.MediaStorageSOPClassUID = self.sopClassUID
+    meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    ds = pydicom.dataset.FileDataset(None, {}, file_meta=meta, preamble=b'\0'*128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    for keyword in self.sourceKeywords:
+      if keyword in sourceDataset:
+        ds[keyword] = copy.deepcopy(sourceDataset[keyword])
+
+    now = datetime.datetime.now()
+    ds.SOPClassUID = self.sopClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+    ds.SeriesNumber = seriesNumber
+    ds.SeriesDescription = seriesDescription
+    ds.SeriesDate = ds.ContentDate = now.strftime('%Y%m%d')
+    ds.SeriesTime = ds.ContentTime = now.strftime('%H%M%S')
+    ds.Manufacturer = 'https://github.com/QIICR/Slicer-PETDICOMExtension'
+    ds.ManufacturerModelName = 'DICOMRWVMPlugin'
+    ds.DeviceSerialNumber = '1'
+    ds.SoftwareVersions = slicer.app.applicationVersion
+    ds.ImageType = ['DERIVED', 'PRIMARY', 'QUANTITY']
+    ds.ContentQualification = 'RESEARCH'
+    ds.InstanceNumber = 1
+    ds.ContentLabel = 'SUV'
+    ds.ContentDescription = units[2]
+    ds.ContentCreatorName = 'QIICR'
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = voxels.shape[1]
+    ds.Columns = voxels.shape[2]
+    ds.BitsAllocated = 32
+    ds.PresentationLUTShape = 'IDENTITY'
+    ds.LossyImageCompression = '00'
+    ds.BurnedInAnnotation = 'NO'
+    ds.RecognizableVisualFeatures = 'NO'
+    ds.NumberOfFrames = voxels.shape[0]
+
+    referencedSeries = Dataset()
+    referencedSeries.SeriesInstanceUID = sourceDataset.SeriesInstanceUID
+    referencedSeries.ReferencedInstanceSequence = []
+    for uid in instanceUIDs:
+      referencedInstance = Dataset()
+      referencedInstance.ReferencedSOPClassUID = sourceDataset.SOPClassUID
+      referencedInstance.ReferencedSOPInstanceUID = uid
+      referencedSeries.ReferencedInstanceSequence.append(referencedInstance)
+    ds.ReferencedSeriesSequence = [referencedSeries]
+
+    # dimensions: (time frame,) slice position
+    dimensionOrganizationUID = pydicom.uid.generate_uid()
+    organization = Dataset()
+    organization.DimensionOrganizationUID = dimensionOrganizationUID
+    ds.DimensionOrganizationSequence = [organization]
+    dimensions = [('TemporalPositionIndex', 'FrameContentSequence', 'Temporal Position Index')] if timeFrames > 1 else []
+    dimensions.append(('ImagePositionPatient', 'PlanePositionSequence', 'Image Position Patient'))
+    ds.DimensionIndexSequence = []
+    for (indexKeyword, groupKeyword, label) in dimensions:
+      index = Dataset()
+      index.DimensionOrganizationUID = dimensionOrganizationUID
+      index.DimensionIndexPointer = pydicom.datadict.tag_for_keyword(indexKeyword)
+      index.FunctionalGroupPointer = pydicom.datadict.tag_for_keyword(groupKeyword)
+      index.DimensionDescriptionLabel = label
+      ds.DimensionIndexSequence.append(index)
+
+    shared = Dataset()
+    pixelMeasures = Dataset()
+    pixelMeasures.PixelSpacing = [round(spacing[1], 6), round(spacing[0], 6)]
+    pixelMeasures.SliceThickness = pixelMeasures.SpacingBetweenSlices = round(spacing[2], 6)
+    shared.PixelMeasuresSequence = [pixelMeasures]
+    planeOrientation = Dataset()
+    planeOrientation.ImageOrientationPatient = [round(float(value), 6) for value in np.concatenate(axes[:2])]
+    shared.PlaneOrientationSequence = [planeOrientation]
+    frameAnatomy = Dataset()
+    frameAnatomy.FrameLaterality = 'U'
+    frameAnatomy.AnatomicRegionSequence = [self.codeItem('38266002', 'SCT', 'Entire body')]
+    shared.FrameAnatomySequence = [frameAnatomy]
+    frameType = Dataset()
+    frameType.FrameType = ['DERIVED', 'PRIMARY', 'QUANTITY', 'NONE']
+    shared.ParametricMapFrameTypeSequence = [frameType]
+    # the voxels are SUV already: identity mapping to the units
+    mapping = Dataset()
+    mapping.LUTExplanation = units[2]
+    mapping.LUTLabel = units[0]
+    mapping.DoubleFloatRealWorldValueFirstValueMapped = float(voxels.min())
+    mapping.DoubleFloatRealWorldValueLastValueMapped = float(voxels.max())
+    mapping.RealWorldValueIntercept = 0.0
+    mapping.RealWorldValueSlope = 1.0
+    mapping.MeasurementUnitsCodeSequence = [self.codeItem(*units)]
+    quantity = Dataset()
+    quantity.ValueType = 'CODE'
+    quantity.ConceptNameCodeSequence = [self.codeItem('G-C1C6', 'SRT', 'Quantity')]
+    quantity.ConceptCodeSequence = [self.codeItem('126400', 'DCM', 'Standardized Uptake Value')]
+    mapping.QuantityDefinitionSequence = [quantity]
+    shared.RealWorldValueMappingSequence = [mapping]
+    ds.SharedFunctionalGroupsSequence = [shared]
+
+    # per frame: plane position and dimension index only. The plane position
+    # items of a slice are shared by all time frames, they are only written.
+    planePositions = []
+    for slice in range(numberOfSlices):
+      planePosition = Dataset()
+      planePosition.ImagePositionPatient = [round(float(value), 6) for value in origin + slice*spacing[2]*axes[2]]
+      planePositions.append(pydicom.sequence.Sequence([planePosition]))
+    perFrame = []
+    for timeFrame in range(timeFrames):
+      for slice in range(numberOfSlices):
+        frameContent = Dataset()
+        if timeFrames > 1:
+          frameContent.DimensionIndexValues = [timeFrame+1, slice+1]
+          frameContent.TemporalPositionIndex = timeFrame+1
+        else:
+          frameContent.DimensionIndexValues = slice+1
+        frame = Dataset()
+        frame.PlanePositionSequence = planePositions[slice]
+        frame.FrameContentSequence = [frameContent]
+        perFrame.append(frame)
+    ds.PerFrameFunctionalGroupsSequence = perFrame
+
+    ds.FloatPixelData = voxels.tobytes()
+    return ds
+
+
+class SUVResampler:
+  """Resample a PET volume loaded by DICOMRWVMPluginClass onto the grid of a
+  CT volume of the same frame of reference, for quantitative overlays at CT
+  resolution. The SUV voxels are interpolated trilinearly or with the
+  nearest neighbour; CT voxels outside of the PET field of view are 0. Blocks
+  of CT slices are resampled in a thread pool (numpy releases the GIL in the
+  gathers and arithmetic).
+
+  The result is a float32 scalar volume in the study of the PET volume. It is
+  cached per (PET, CT, interpolation) for the session and recomputed only if
+  the voxels of either volume were modified.
+  """
+
+  # (PET node ID, CT node ID, interpolation) -> (resampled node ID, modification key)
+  cache = {}
+  lock = threading.Lock()
+
+  def __init__(self, numberOfThreads=None, rwvmPlugin=None):
+    self.numberOfThreads = numberOfThreads or os.cpu_count() or 1
+    self.rwvmPlugin = rwvmPlugin or DICOMRWVMPluginClass()
+
+  def resample(self, petNode, ctNode, interpolation='linear', name=None):
+    """Return the scalar volume of the SUV of petNode on the grid of ctNode.
+    interpolation is 'linear' or 'nearest'."""
+    if interpolation not in ('linear', 'nearest'):
+      raise ValueError('Unknown interpolation %s' % interpolation)
+    petFrameOfReference = self.frameOfReferenceUID(petNode)
+    ctFrameOfReference = self.frameOfReferenceUID(ctNode)
+    if petFrameOfReference and ctFrameOfReference and petFrameOfReference != ctFrameOfReference:
+      raise ValueError('%s and %s are not in the same frame of reference' % (petNode.GetName(), ctNode.GetName()))
+
+    key = (petNode.GetID(), ctNode.GetID(), interpolation)
+    modificationKey = (petNode.GetImageData().GetMTime(), ctNode.GetImageData().GetMTime(),
+                       self.rwvmPlugin.getStoredValueMapping(petNode))
+    with self.lock:
+      (resampledNodeID, cachedModificationKey) = self.cache.get(key, (None, None))
+    resampledNode = slicer.mrmlScene.GetNodeByID(resampledNodeID) if resampledNodeID else None
+    if resampledNode and cachedModificationKey == modificationKey:
+      return resampledNode
+
+    suv = self.rwvmPlugin.arrayFromSUVVolume(petNode)
+    ctShape = tuple(reversed(ctNode.GetImageData().GetDimensions()))
+    resampled = self.resampleArray(suv, ctShape, self.ctToPETIndexMatrix(petNode, ctNode), interpolation)
+    if resampledNode is None:
+      resampledNode = self.createResampledVolume(petNode, ctNode, name or '%s on %s' % (petNode.GetName(), ctNode.GetName()))
+    slicer.util.updateVolumeFromArray(resampledNode, resampled)
+    with self.lock:
+      self.cache[key] = (resampledNode.GetID(), modificationKey)
+    return resampledNode
+
+  def frameOfReferenceUID(self, volumeNode):
+    """Return the FrameOfReferenceUID of the DICOM instances of a volume, None if unknown"""
+    instanceUIDs = (volumeNode.GetAttribute("DICOM.instanceUIDs") or "").split()
+    fileName = slicer.dicomDatabase.fileForInstance(instanceUIDs[0]) if instanceUIDs else None
+    if not fileName:
+      return None
+    return slicer.dicomDatabase.fileValue(fileName, self.rwvmPlugin.tags['frameOfReferenceUID']) or None
+
+  def ctToPETIndexMatrix(self, petNode, ctNode):
+    """Return the 4x4 matrix from CT voxel indices (IJK) to continuous PET
+    voxel indices, including linear transforms the volumes are under"""
+    ctIJKToRAS = vtk.vtkMatrix4x4()
+    ctNode.GetIJKToRASMatrix(ctIJKToRAS)
+    petRASToIJK = vtk.vtkMatrix4x4()
+    petNode.GetRASToIJKMatrix(petRASToIJK)
+    ctToPET = vtk.vtkMatrix4x4()
+    slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(ctNode.GetParentTransformNode(),
+      petNode.GetParentTransformNode(), ctToPET)
+    matrix = slicer.util.arrayFromVTKMatrix(petRASToIJK) @ slicer.util.arrayFromVTKMatrix(ctToPET) \
+      @ slicer.util.arrayFromVTKMatrix(ctIJKToRAS)
+    return matrix
+
+  def resampleArray(self, suv, shape, indexMatrix, interpolation='linear'):
+    """Resample suv (K, J, I) onto a grid of the given (K, J, I) shape.
+    indexMatrix maps the (I, J, K, 1) indices of the grid to continuous
+    (I, J, K) indices of suv."""
+    suv = np.ascontiguousarray(suv, dtype=np.float32)
+    resampled = np.empty(shape, dtype=np.float32)
+    bounds = np.linspace(0, shape[0], min(shape[0], self.numberOfThreads*4) + 1).astype(int)
+    i = np.arange(shape[2], dtype=np.float32)[np.newaxis, np.newaxis, :]
+    j = np.arange(shape[1], dtype=np.float32)[np.newaxis, :, np.newaxis]
+
+    def resampleBlock(first, last):
+      k = np.arange(first, last, dtype=np.float32)[:, np.newaxis, np.newaxis]
+      # continuous PET indices of the CT voxels of the block, in suv axis order
+      (x, y, z) = [(indexMatrix[row, 0]*i + indexMatrix[row, 1]*j) + (indexMatrix[row, 2]*k + indexMatrix[row, 3])
+                   for row in range(3)]
+      if interpolation == 'nearest':
+        resampled[first:last] = self.nearest(suv, (z, y, x))
+      else:
+        resampled[first:last] = self.trilinear(suv, (z, y, x))
+
+    with ThreadPoolExecutor(max_workers=self.numberOfThreads) as executor:
+      list(executor.map(resampleBlock, bounds[:-1], bounds[1:]))
+    return resampled
+
+  @staticmethod
+  def inside(shape, coordinates):
+    """Mask of the continuous indices within the volume (half a voxel beyond the voxel centers)"""
+    mask = None
+    for (size, c) in zip(shape, coordinates):
+      axisMask = (c >= -0.5) & (c <= size - 0.5)
+      mask = axisMask if mask is None else mask & axisMask
+    return mask
+
+  def nearest(self, suv, coordinates):
+    flatIndex = 0
+    for (size, c) in zip(suv.shape, coordinates):
+      flatIndex = flatIndex*size + np.clip(np.rint(c), 0, size-1).astype(np.intp)
+    values = np.take(suv, flatIndex)
+    values[~self.inside(suv.shape, coordinates)] = 0
+    return values
+
+  def trilinear(self, suv, coordinates):
+    lower = []
+    upper = []
+    fractions = []
+    for (size, c) in zip(suv.shape, coordinates):
+      c = np.clip(c, 0, size-1)
+      index = np.floor(c).astype(np.intp)
+      lower.append(index)
+      upper.append(np.minimum(index+1, size-1))
+      fractions.append((c - index).astype(np.float32))
+    (K, J, I) = suv.shape
+    values = np.zeros(coordinates[0].shape, dtype=np.float32)
+    for corner in range(8):
+      (k, wk) = (upper[0], fractions[0]) if corner & 4 else (lower[0], 1 - fractions[0])
+      (j, wj) = (upper[1], fractions[1]) if corner & 2 else (lower[1], 1 - fractions[1])
+      (i, wi) = (upper[2], fractions[2]) if corner & 1 else (lower[2], 1 - fractions[2])
+      values += np.take(suv, (k*J + j)*I + i) * (wk*wj*wi)
+    values[~self.inside(suv.shape, coordinates)] = 0
+    return values
+
+  def createResampledVolume(self, petNode, ctNode, name):
+    """Create a volume with the geometry of ctNode, in the study of petNode and
+    displayed like petNode"""
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', slicer.mrmlScene.GenerateUniqueName(name))
+    ijkToRAS = vtk.vtkMatrix4x4()
+    ctNode.GetIJKToRASMatrix(ijkToRAS)
+    volumeNode.SetIJKToRASMatrix(ijkToRAS)
+    volumeNode.SetAndObserveTransformNodeID(ctNode.GetTransformNodeID())
+    for attribute in ("DICOM.instanceUIDs", "DICOM.RWV.instanceUID"):
+      if petNode.GetAttribute(attribute):
+        volumeNode.SetAttribute(attribute, petNode.GetAttribute(attribute))
+    if petNode.GetVoxelValueQuantity():
+      volumeNode.SetVoxelValueQuantity(petNode.GetVoxelValueQuantity())
+    if petNode.GetVoxelValueUnits():
+      volumeNode.SetVoxelValueUnits(petNode.GetVoxelValueUnits())
+    volumeNode.CreateDefaultDisplayNodes()
+
+    petDisplayNode = petNode.GetDisplayNode()
+    displayNode = volumeNode.GetDisplayNode()
+    if petDisplayNode and displayNode:
+      (window, level) = (petDisplayNode.GetWindow(), petDisplayNode.GetLevel())
+      # the resampled voxels are SUV also if the PET volume keeps its stored voxels
+      mapping = self.rwvmPlugin.getStoredValueMapping(petNode)
+      if mapping:
+        (slope, intercept) = mapping
+        (window, level) = (window*slope, level*slope + intercept)
+      displayNode.SetAndObserveColorNodeID(petDisplayNode.GetColorNodeID())
+      displayNode.SetInterpolate(petDisplayNode.GetInterpolate())
+      displayNode.AutoWindowLevelOff()
+      displayNode.SetWindowLevel(window, level)
+
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    petItem = shNode.GetItemByDataNode(petNode)
+    if petItem:
+      shNode.SetItemParent(shNode.GetItemByDataNode(volumeNode), shNode.GetItemParent(petItem))
+    return volumeNode
+
+
+class SUVDisplayRange:
+  """Estimate the display range of a loaded volume from percentiles of a
+  strided sample of its voxels, instead of a fixed window/level per tracer or
+  a histogram of all voxels. Volumes that keep their stored integer voxels
+  are binned in a histogram of the stored values and the percentiles are
+  mapped with the real world value mapping afterwards.
+
+  The range is in real world values (SUV for PET) and cached on the volume
+  node, so configuring the display again, for example when a preview is
+  replaced or for every frame of a 4D series, does not touch the voxels.
+  """
+
+  # at most this many voxels are sampled
+  maximumSamples = 1 << 18
+  # stored value ranges up to this size are binned in a histogram
+  maximumHistogramBins = 1 << 20
+  # (lower, upper) percentiles per units code value, a lower percentile of
+  # None starts the range at 0
+  percentilesByUnits = {
+    '{SUVbw}g/ml': (None, 99.5),
+    '{SUVlbm}g/ml': (None, 99.5),
+    '{SUVbsa}cm2/ml': (None, 99.5),
+    '{SUVibw}g/ml': (None, 99.5),
+    'Bq/ml': (None, 99.5),
+    }
+  defaultPercentiles = (0.5, 99.5)
+  cacheAttribute = "DICOM.PETSUV.DisplayRange"
+
+  def __init__(self, rwvmPlugin=None, maximumSamples=None):
+    self.rwvmPlugin = rwvmPlugin or DICOMRWVMPluginClass()
+    if maximumSamples:
+      self.maximumSamples = maximumSamples
+
+  def displayRange(self, volumeNode, refresh=False):
+    """Return (lower, upper) in real world values, None if the volume has no
+    voxels or all sampled voxels have the same value"""
+    cached = volumeNode.GetAttribute(self.cacheAttribute)
+    if cached and not refresh:
+      (lower, upper) = [float(value) for value in cached.split()]
+      return (lower, upper)
+    if volumeNode.GetImageData() is None:
+      return None
+    voxels = slicer.util.arrayFromVolume(volumeNode)
+    units = volumeNode.GetVoxelValueUnits() if hasattr(volumeNode, 'GetVoxelValueUnits') else None
+    unitsCodeValue = units.GetCodeValue() if units else None
+    (lowerPercentile, upperPercentile) = self.percentilesByUnits.get(unitsCodeValue, self.defaultPercentiles)
+    percentiles = self.samplePercentiles(voxels, [lowerPercentile or 0.0, upperPercentile])
+    if percentiles is None:
+      return None
+    mapping = self.rwvmPlugin.getStoredValueMapping(volumeNode)
+    if mapping:
+      (slope, intercept) = mapping
+      percentiles = sorted(value*slope + intercept for value in percentiles)
+    (lower, upper) = percentiles
+    if lowerPercentile is None:
+      lower = 0.0
+    if not upper > lower:
+      return None
+    volumeNode.SetAttribute(self.cacheAttribute, "%r %r" % (lower, upper))
+    return (lower, upper)
+
+  def windowLevel(self, volumeNode, refresh=False):
+    """Return (window, level) in the units of the voxels of volumeNode (stored
+    values if the volume keeps them), None if no range can be estimated"""
+    displayRange = self.displayRange(volumeNode, refresh)
+    if displayRange is None:
+      return None
+    (lower, upper) = displayRange
+    mapping = self.rwvmPlugin.getStoredValueMapping(volumeNode)
+    if mapping:
+      (slope, intercept) = mapping
+      (lower, upper) = sorted(((lower-intercept)/slope, (upper-intercept)/slope))
+    return (upper-lower, (upper+lower)/2.0)
+
+  def sample(self, voxels):
+    """Return every n-th voxel, at most maximumSamples of them"""
+    flat = voxels.reshape(-1)
+    step = max(1, -(-flat.size // self.maximumSamples))
+    return flat[::step]
+
+  def samplePercentiles(self, voxels, percentiles):
+    """Return the percentiles of a strided sample of voxels, from a histogram
+    for integer voxels. None if there are no voxels."""
+    sample = self.sample(voxels)
+    if sample.size == 0:
+      return None
+    if np.issubdtype(sample.dtype, np.integer):
+      minimum = int(sample.min())
+      bins = int(sample.max()) - minimum + 1
+      if bins <= self.maximumHistogramBins:
+        cumulative = np.cumsum(np.bincount((sample - minimum).astype(np.intp), minlength=bins))
+        ranks = [min(sample.size-1, int(percentile/100.0*sample.size)) for percentile in percentiles]
+        return [float(minimum + np.searchsorted(cumulative, rank, side='right')) for rank in ranks]
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+      return None
+    return [float(value) for value in np.percentile(sample, percentiles)]
+
+
+class ProgressiveFrameLoader:
+  """Read the remaining frames of a dynamic PET series on a worker thread and
+  append them to a volume sequence as they finish.
+
+  The worker only decodes the files with pydicom (dicom before Slicer 4.11),
+  sorts the slices like the first frame (loaded by the scalar volume plugin)
+  and maps them to real world values. All scene changes happen in a timer on
+  the main thread.
+  Frames must have the geometry of the first frame. A non-modal progress
+  dialog allows cancelling; frames read so far stay in the sequence.
+  """
+
+  # keep running loaders alive, they are not referenced by the scene
+  activeLoaders = set()
+
+  def __init__(self, rwvmPlugin, loadable, volumeSequenceNode, ijkToRAS, firstFrameFiles, frameFileLists, frameFactors,
+               firstFrameNumber=1):
+    self.rwvmPlugin = rwvmPlugin
+    self.loadable = loadable
+    self.volumeSequenceNode = volumeSequenceNode
+    self.ijkToRAS = vtk.vtkMatrix4x4()
+    self.ijkToRAS.DeepCopy(ijkToRAS)
+    self.frameFileLists = frameFileLists
+    self.frameFactors = frameFactors
+    self.firstFrameNumber = firstFrameNumber
+    self.derivedItemUID = slicer.dicomDatabase.fileValue(loadable.rwvFile, rwvmPlugin.tags['sopInstanceUID']) \
+      if hasattr(loadable, 'rwvFile') else ""
+
+    # slices of the other frames are sorted in the order of the first frame
+    orientation = [float(v) for v in slicer.dicomDatabase.fileValue(firstFrameFiles[0], rwvmPlugin.tags['orientation']).split('\\')]
+    self.sliceNormal = np.cross(orientation[:3], orientation[3:])
+    positions = [self.slicePosition(slicer.dicomDatabase.fileValue(f, rwvmPlugin.tags['position']).split('\\'))
+                 for f in firstFrameFiles[:2]]
+    self.descending = len(positions) > 1 and positions[1] < positions[0]
+
+    self.frames = queue.Queue(maxsize=2)
+    self.canceled = threading.Event()
+    self.worker = threading.Thread(target=self.readFrames, name='PETFrameLoader')
+    self.worker.daemon = True
+    self.timer = qt.QTimer()
+    self.timer.setInterval(100)
+    self.timer.connect('timeout()', self.appendFrames)
+    self.progressDialog = None
+    self.framesAppended = 0
+
+  def slicePosition(self, imagePositionPatient):
+    return float(np.dot(self.sliceNormal, [float(v) for v in imagePositionPatient]))
+
+  def start(self):
+    ProgressiveFrameLoader.activeLoaders.add(self)
+    self.progressDialog = slicer.util.createProgressDialog(labelText="Loading frames of " + self.volumeSequenceNode.GetName(),
+      value=self.firstFrameNumber, maximum=self.firstFrameNumber + len(self.frameFileLists), windowModality=qt.Qt.NonModal)
+    self.progressDialog.connect('canceled()', self.cancel)
+    self.worker.start()
+    self.timer.start()
+
+  def cancel(self):
+    self.canceled.set()
+
+  def readFrames(self):
+    """Worker thread: decode, sort and map frames and queue them with their frame number"""
+    for index, frameFiles in enumerate(self.frameFileLists):
+      if self.canceled.is_set():
+        break
+      try:
+        frame = self.readFrame(frameFiles, self.frameFactors[index])
+      except Exception as e:
+        frame = e
+      while not self.canceled.is_set():
+        try:
+          self.frames.put((self.firstFrameNumber + index, frame), timeout=0.1)
+          break
+        except queue.Full:
+          pass
+      if isinstance(frame, Exception):
+        break
+
+  def readFrame(self, frameFiles, frameFactor):
+    """Return (voxels, instanceUIDs) of a frame, voxels mapped to real world values"""
+    if slicer.app.majorVersion >= 5 or (slicer.app.majorVersion == 4 and slicer.app.minorVersion >= 11):
+      datasets = [pydicom.dcmread(frameFile) for frameFile in frameFiles]
+    else:
+      datasets = [dicom.read_file(frameFile) for frameFile in frameFiles]
+    datasets.sort(key=lambda ds: self.slicePosition(ds.ImagePositionPatient), reverse=self.descending)
+    voxels = np.empty((len(datasets), datasets[0].Rows, datasets[0].Columns), dtype=np.float32)
+    for sliceIndex, ds in enumerate(datasets):
+      # PET slices usually have individual rescale slopes
+      self.rwvmPlugin.mapSlice(ds.pixel_array, ds, self.loadable, frameFactor, voxels[sliceIndex])
+    return (voxels, " ".join(str(ds.SOPInstanceUID) for ds in datasets))
+
+  def appendFrames(self):
+    """Main thread: add the frames read so far to the sequence"""
+    if self.volumeSequenceNode.GetScene() is None:
+      # sequence was removed from the scene
+      self.cancel()
+    while not self.canceled.is_set():
+      try:
+        (frameNumber, frame) = self.frames.get_nowait()
+      except queue.Empty:
+        break
+      if isinstance(frame, Exception):
+        logging.error(f"Failed to read frame {frameNumber} of {self.volumeSequenceNode.GetName()}: {str(frame)}")
+        self.cancel()
+        break
+      (voxels, instanceUIDs) = frame
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(voxels.shape[2], voxels.shape[1], voxels.shape[0])
+      imageData.GetPointData().SetScalars(vtk.util.numpy_support.numpy_to_vtk(voxels.ravel(), deep=True))
+      frameNode = slicer.vtkMRMLScalarVolumeNode()
+      frameNode.SetIJKToRASMatrix(self.ijkToRAS)
+      frameNode.SetAndObserveImageData(imageData)
+      if self.loadable.quantity:
+        frameNode.SetVoxelValueQuantity(self.loadable.quantity)
+      if self.loadable.units:
+        frameNode.SetVoxelValueUnits(self.loadable.units)
+      frameNode.SetAttribute("DICOM.instanceUIDs", instanceUIDs)
+      frameNode.SetAttribute("DICOM.RWV.instanceUID", self.derivedItemUID)
+      self.rwvmPlugin.addFrameToSequence(self.volumeSequenceNode, frameNode, str(frameNumber))
+      SUVMemoryBudget.trackFrame(self.rwvmPlugin, self.volumeSequenceNode, str(frameNumber), self.loadable,
+                                 self.frameFileLists[frameNumber - self.firstFrameNumber],
+                                 self.frameFactors[frameNumber - self.firstFrameNumber])
+      self.framesAppended += 1
+      self.progressDialog.value = self.firstFrameNumber + self.framesAppended
+      SUVMemoryBudget.enforce()
+
+    if self.canceled.is_set() or (not self.worker.is_alive() and self.frames.empty()):
+      self.finish()
+
+  def finish(self):
+    # the worker stops at the next frame, no need to wait for it
+    self.timer.stop()
+    self.canceled.set()
+    self.progressDialog.close()
+    ProgressiveFrameLoader.activeLoaders.discard(self)
+
+
 #
 # DICOMRWVMPlugin
 #
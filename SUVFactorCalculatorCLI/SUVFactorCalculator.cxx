@@ -17,12 +17,24 @@
 #include <itkShiftScaleImageFilter.h>
 #include "itkGDCMImageIO.h"
 #include "itkNumericTraits.h"
+#include "itkPluginFilterWatcher.h"
 
 #undef HAVE_SSTREAM
 #include "itkDCMTKFileReader.h"
+#include "dcmSeriesDiscoveryHelper.h"
+#include "dcmSeriesReaderHelper.h"
+#include "dcmParametricMapHelper.h"
+#include "nrrdParallelGzipHelper.h"
 #include <iostream>
 #include <sstream>
 #include <math.h>
+#include <algorithm>
+#include <chrono>
+#include <cstring>
+#include <functional>
+#ifndef _WIN32
+#include <sys/resource.h>
+#endif
 
 // DCMTK includes
 #include "dcmtk/config/osconfig.h"    /* make sure OS specific configuration is included first */
@@ -159,13 +171,173 @@ struct tags
     std::string CorrectedImageTag;
 };
 
+//--- tags resolved from their names once per run
+struct tagKeys
+  {
+    DcmTagKey RIS;
+    DcmTagKey RIStime;
+    DcmTagKey RIStdose;
+    DcmTagKey RIShalflife;
+    DcmTagKey RISposfrac;
+    DcmTagKey RISunits;
+    DcmTagKey decaycorr;
+    DcmTagKey StudyDate;
+    DcmTagKey PatientName;
+    DcmTagKey DecayFactor;
+    DcmTagKey FrameReferenceTime;
+    DcmTagKey SeriesTime;
+    DcmTagKey PatientWeight;
+    DcmTagKey PatientSize;
+    DcmTagKey PatientSex;
+    DcmTagKey CorrectedImage;
+};
+
+DcmTagKey ResolveDICOMTag(const std::string& input, const std::string& label)
+{
+  uint16_t group, element;
+  parseDICOMTag(input, group, element, label);
+  return DcmTagKey(group, element);
+}
+
+void ResolveDICOMTags(const tags & taglist, tagKeys & keys)
+{
+  keys.RIS = ResolveDICOMTag(taglist.RISTag, "Radiopharmaceutical Information Sequence");
+  keys.RIStime = ResolveDICOMTag(taglist.RIStimeTag, "Radionuclide Start Time");
+  keys.RIStdose = ResolveDICOMTag(taglist.RIStdoseTag, "Radionuclide Total Dose");
+  keys.RIShalflife = ResolveDICOMTag(taglist.RIShalflifeTag, "Radionuclide Half Life");
+  keys.RISposfrac = ResolveDICOMTag(taglist.RISposfracTag, "Radionuclide Positron Fraction");
+  keys.RISunits = ResolveDICOMTag(taglist.RISunitsTag, "Units");
+  keys.decaycorr = ResolveDICOMTag(taglist.decaycorrTag, "Decay Correction");
+  keys.StudyDate = ResolveDICOMTag(taglist.StudyDateTag, "Study Date");
+  keys.PatientName = ResolveDICOMTag(taglist.PatientNameTag, "Patient Name");
+  keys.DecayFactor = ResolveDICOMTag(taglist.DecayFactorTag, "Decay Factor");
+  keys.FrameReferenceTime = ResolveDICOMTag(taglist.FrameReferenceTimeTag, "Frame Reference Time");
+  keys.SeriesTime = ResolveDICOMTag(taglist.SeriesTimeTag, "Series Time");
+  keys.PatientWeight = ResolveDICOMTag(taglist.PatientWeightTag, "Patient Weight");
+  keys.PatientSize = ResolveDICOMTag(taglist.PatientSizeTag, "Patient Size");
+  keys.PatientSex = ResolveDICOMTag(taglist.PatientSexTag, "Patient Sex");
+  keys.CorrectedImage = ResolveDICOMTag(taglist.CorrectedImageTag, "Corrected Image");
+}
+
 using OutputVolumeType = itk::Image<float, 3>;
 using OutputVolumeType4D = itk::Image<float, 4>;
 
+//--- Wall time of the processing phases, reported with --timingsFile
+struct phaseTimings
+  {
+    std::vector< std::pair<std::string, double> > phases; // name, seconds
+    std::chrono::steady_clock::time_point phaseStart = std::chrono::steady_clock::now();
+
+    void restart()
+      {
+      phaseStart = std::chrono::steady_clock::now();
+      }
+    void stop(const std::string & phase)
+      {
+      std::chrono::steady_clock::time_point now = std::chrono::steady_clock::now();
+      phases.push_back(std::make_pair(phase, std::chrono::duration<double>(now - phaseStart).count()));
+      phaseStart = now;
+      }
+  };
+
+//--- Progress of the processing stages, reported to Slicer as filter events.
+//--- Every stage covers a fraction of the overall progress and starts where the
+//--- previous one ended. ITK filters of a stage are watched with
+//--- itk::PluginFilterWatcher over the range of the stage. Slicer's cancel flag
+//--- is only visible when the module runs as shared library (aborted()), an
+//--- executable module is terminated by Slicer when the user cancels.
+struct progressReporter
+  {
+    ModuleProcessInformation * processInformation = nullptr;
+    std::string stageName;
+    double stageStart = 0.0;
+    double stageFraction = 0.0;
+    double lastStageProgress = -1.0;
+    std::chrono::steady_clock::time_point stageStartTime = std::chrono::steady_clock::now();
+
+    void startStage(const std::string & name, const std::string & comment, double fraction)
+      {
+      stageStart = std::min(1.0, stageStart + stageFraction);
+      stageFraction = std::min(fraction, 1.0 - stageStart);
+      stageName = name;
+      lastStageProgress = -1.0;
+      stageStartTime = std::chrono::steady_clock::now();
+      if (processInformation)
+        {
+        strncpy(processInformation->ProgressMessage, comment.c_str(), 1023);
+        processInformation->ProgressMessage[1023] = '\0';
+        }
+      else
+        {
+        std::cout << "<filter-start>" << std::endl
+                  << "<filter-name>" << name << "</filter-name>" << std::endl
+                  << "<filter-comment> \"" << comment << "\" </filter-comment>" << std::endl
+                  << "</filter-start>" << std::endl;
+        }
+      update(0.0);
+      }
+
+    //--- fraction of the overall progress that is not assigned to a stage yet
+    double remaining() const
+      {
+      return std::max(0.0, 1.0 - stageStart - stageFraction);
+      }
+
+    //--- stageProgress in [0,1], false if the user cancelled the module
+    bool update(double stageProgress)
+      {
+      // percent steps are enough for the progress bar
+      if (stageProgress < 1.0 && stageProgress - lastStageProgress < 0.01)
+        {
+        return !aborted();
+        }
+      lastStageProgress = stageProgress;
+      const double progress = stageStart + stageFraction * stageProgress;
+      if (processInformation)
+        {
+        processInformation->Progress = progress;
+        processInformation->StageProgress = stageProgress;
+        if (processInformation->ProgressCallbackFunction && processInformation->ProgressCallbackClientData)
+          {
+          (*(processInformation->ProgressCallbackFunction))(processInformation->ProgressCallbackClientData);
+          }
+        }
+      else
+        {
+        std::cout << "<filter-progress>" << progress << "</filter-progress>" << std::endl
+                  << "<filter-stage-progress>" << stageProgress << "</filter-stage-progress>" << std::endl;
+        }
+      return !aborted();
+      }
+
+    void endStage()
+      {
+      update(1.0);
+      if (!processInformation)
+        {
+        std::cout << "<filter-end>" << std::endl
+                  << "<filter-name>" << stageName << "</filter-name>" << std::endl
+                  << "<filter-time>"
+                  << std::chrono::duration<double>(std::chrono::steady_clock::now() - stageStartTime).count()
+                  << "</filter-time>" << std::endl
+                  << "</filter-end>" << std::endl;
+        }
+      }
+
+    bool aborted() const
+      {
+      return processInformation && processInformation->Abort;
+      }
+  };
+
 struct parameters
   {
     std::string PETDICOMPath;
     std::string PETSeriesInstanceUID;
+    bool useSeriesIndex;
+    unsigned int numberOfThreads;
+    int compressionLevel;              // 0: uncompressed normalized volumes
+    unsigned int compressionThreads;   // 0: one per core, 1: compression of the ITK writer
     std::string patientName;
     std::string studyDate;
     std::string radioactivityUnits;
@@ -206,12 +378,87 @@ struct parameters
 
     bool multiframe;
     std::string seriesdimension;
+
+    // dynamic (4D) series: one entry per time frame
+    std::vector<double> frameReferenceTimes; // msec, relative to series reference time
+    std::vector<double> frameDecayScales;    // SUV factor of the frame relative to the series factor
+
+    phaseTimings timings;
+    progressReporter progress;
 };
 
 // ...
 // ...............................................................................................
 // ...
-double DecayCorrection(parameters & list, double injectedDose )
+//--- Peak resident memory of the process in kB, -1 where it is not available
+long PeakResidentMemoryKB()
+{
+#ifdef _WIN32
+  return -1;
+#else
+  struct rusage usage;
+  if (getrusage(RUSAGE_SELF, &usage) != 0)
+    {
+    return -1;
+    }
+#ifdef __APPLE__
+  return usage.ru_maxrss / 1024; // bytes on macOS
+#else
+  return usage.ru_maxrss;
+#endif
+#endif
+}
+
+bool WriteTimings(const parameters & list, const std::string & filename)
+{
+  std::ofstream timingsFile(filename.c_str());
+  if (!timingsFile)
+    {
+    std::cerr << "Cannot write timings to " << filename << std::endl;
+    return false;
+    }
+  double totalSeconds = 0.0;
+  timingsFile << "{" << std::endl;
+  timingsFile << "  \"seriesdimension\": \"" << list.seriesdimension << "\"," << std::endl;
+  timingsFile << "  \"numberOfFiles\": " << list.PETFilenames.size() << "," << std::endl;
+  timingsFile << "  \"phases\": {";
+  for (size_t i=0; i<list.timings.phases.size(); i++)
+    {
+    timingsFile << (i ? "," : "") << std::endl << "    \"" << list.timings.phases[i].first << "\": "
+                << list.timings.phases[i].second;
+    totalSeconds += list.timings.phases[i].second;
+    }
+  timingsFile << std::endl << "  }," << std::endl;
+  timingsFile << "  \"totalSeconds\": " << totalSeconds << "," << std::endl;
+  timingsFile << "  \"peakResidentMemoryKB\": " << PeakResidentMemoryKB() << std::endl;
+  timingsFile << "}" << std::endl;
+  return true;
+}
+
+// ...
+// ...............................................................................................
+// ...
+//--- Injected dose decayed to the time the pixel values are decay corrected to:
+//--- START = series reference time, ADMIN = injection time (no decay) and
+//--- NONE = frame reference time (msec offset from the series reference time)
+double DecayedDose(const parameters & list, double injectedDose, double frameReferenceTime = 0.0)
+{
+  if ( list.decayCorrection == "ADMIN" )
+    {
+    return injectedDose;
+    }
+  double scanTimeSeconds = ConvertTimeToSeconds(list.seriesReferenceTime.c_str() );
+  if ( list.decayCorrection == "NONE" )
+    {
+    scanTimeSeconds += frameReferenceTime / 1000.0;
+    }
+  double startTimeSeconds = ConvertTimeToSeconds( list.injectionTime.c_str() );
+  double halfLife = atof( list.radionuclideHalfLife.c_str() );
+  double decayTime = scanTimeSeconds - startTimeSeconds;
+  return injectedDose * (double)pow(2.0, -(decayTime / halfLife) );
+}
+
+double DecayCorrection(parameters & list, double injectedDose, double frameReferenceTime = 0.0 )
 {
 
   double scanTimeSeconds = ConvertTimeToSeconds(list.seriesReferenceTime.c_str() );
@@ -220,9 +467,7 @@ double DecayCorrection(parameters & list, double injectedDose )
   std::cout << "                  RAD. START TIME: " << startTimeSeconds << std::endl;
   std::cout << "                  SERIES TIME: " << scanTimeSeconds << std::endl;
   //double startTimeSeconds = ConvertTimeToSeconds( list.radiopharmStartTime.c_str());
-  double halfLife = atof( list.radionuclideHalfLife.c_str() );
-  double decayTime = scanTimeSeconds - startTimeSeconds;
-  double decayedDose = injectedDose * (double)pow(2.0, -(decayTime / halfLife) );
+  double decayedDose = DecayedDose(list, injectedDose, frameReferenceTime);
   std::cout << "                  DECAYED DOSE: " << decayedDose << std::endl;
 
   return decayedDose;
@@ -231,49 +476,165 @@ double DecayCorrection(parameters & list, double injectedDose )
 // ...
 // ...............................................................................................
 // ...
-bool WriteNormalizedImage(OutputVolumeType::Pointer image, std::string filename, double normalizationFactor, bool useCompression=false)
+//--- Read the frame reference time of every time frame (one file per frame) of a
+//--- dynamic series and compute the SUV factor of each frame relative to the
+//--- factor of the first frame.
+int ComputeFrameDecayScales(parameters & list, const DcmTagKey & frameReferenceTimeKey, double injectedDose)
+{
+  list.frameReferenceTimes.clear();
+  list.frameDecayScales.clear();
+  for (const std::string & fileName : list.PETFilenames)
+    {
+    if (!list.progress.update(static_cast<double>(list.frameReferenceTimes.size()) / list.PETFilenames.size()))
+      {
+      std::cerr << "Aborted while reading frame reference times" << std::endl;
+      return EXIT_FAILURE;
+      }
+    DcmFileFormat fileFormat;
+    if (fileFormat.loadFileUntilTag(fileName.c_str(), EXS_Unknown, EGL_noChange, DCM_MaxReadLength,
+                                    ERM_autoDetect, DCM_PixelData).bad())
+      {
+      std::cerr << "Cannot read metadata of " << fileName << std::endl;
+      return EXIT_FAILURE;
+      }
+    Float64 frameReferenceTime = 0.0;
+    if (fileFormat.getDataset()->findAndGetFloat64(frameReferenceTimeKey, frameReferenceTime).bad()
+        && list.decayCorrection == "NONE")
+      {
+      std::cerr << "Missing frame reference time in " << fileName << std::endl;
+      return EXIT_FAILURE;
+      }
+    list.frameReferenceTimes.push_back(frameReferenceTime);
+    }
+
+  // all frames share the dose, weight, ... so only the decayed dose differs
+  const double referenceDose = DecayedDose(list, injectedDose, list.frameReferenceTimes[0]);
+  for (double frameReferenceTime : list.frameReferenceTimes)
+    {
+    list.frameDecayScales.push_back(referenceDose / DecayedDose(list, injectedDose, frameReferenceTime));
+    }
+  return EXIT_SUCCESS;
+}
+
+//--- True if the frames of a dynamic series need different SUV factors
+bool HasFrameDecayScales(const parameters & list)
+{
+  for (double scale : list.frameDecayScales)
+    {
+    if (fabs(scale - 1.0) > 1e-9)
+      {
+      return true;
+      }
+    }
+  return false;
+}
+
+// ...
+// ...............................................................................................
+// ...
+//--- Write the second half of the current progress stage. Compressed NRRD
+//--- files are written in gzip blocks on compressionThreads threads, other
+//--- formats and a single compression thread use the ITK writer.
+template <typename TImage>
+void WriteVolume(TImage * image, const std::string & filename, int compressionLevel, unsigned int compressionThreads,
+                 progressReporter & progress)
+{
+  const bool nrrd = filename.size() > 5 && filename.compare(filename.size()-5, 5, ".nrrd") == 0;
+  if (compressionLevel > 0 && compressionThreads != 1 && nrrd)
+    {
+    nrrdParallelGzipHelper::write(image, filename, compressionLevel, compressionThreads,
+                                  [&progress](double fraction) { return progress.update(0.5 + 0.5*fraction); });
+    return;
+    }
+  using WriterType = itk::ImageFileWriter<TImage>;
+  auto writer = WriterType::New();
+  writer->SetInput( image );
+  writer->SetFileName( filename );
+  writer->SetUseCompression(compressionLevel > 0);
+  if (compressionLevel > 0)
+    {
+    writer->SetCompressionLevel(compressionLevel);
+    }
+  itk::PluginFilterWatcher writeWatcher(writer, "Write", progress.processInformation,
+                                        0.5*progress.stageFraction, progress.stageStart + 0.5*progress.stageFraction);
+  writer->Update();
+}
+
+bool WriteNormalizedImage(OutputVolumeType::Pointer image, std::string filename, double normalizationFactor,
+                          progressReporter & progress, double progressFraction,
+                          int compressionLevel=0, unsigned int compressionThreads=0)
 {
   std::cout << "Writing normalized image " << filename << std::endl;
+  if (progress.aborted())
+    {
+    return false;
+    }
+  progress.startStage("normalizedVolume", "Writing normalized image " + filename, progressFraction);
   try {
     using NormalizationFilterType = itk::ShiftScaleImageFilter<OutputVolumeType, OutputVolumeType> ;
     auto normalize = NormalizationFilterType::New();
     normalize->SetShift(0.0);
     normalize->SetScale(normalizationFactor);
     normalize->SetInput(image);
+    itk::PluginFilterWatcher normalizeWatcher(normalize, "Normalize", progress.processInformation,
+                                              0.5*progress.stageFraction, progress.stageStart);
+    normalize->Update();
 
-    using WriterType = itk::ImageFileWriter<OutputVolumeType>;
-    auto writer = WriterType::New();
-    writer->SetInput( normalize->GetOutput() );
-    writer->SetFileName( filename );
-    writer->SetUseCompression(useCompression);
-    writer->Update();
+    WriteVolume(normalize->GetOutput(), filename, compressionLevel, compressionThreads, progress);
   } catch (itk::ExceptionObject &ex) {
     std::cout << ex << std::endl;
     return false;
   }
+  progress.endStage();
   return true;
 }
 
-bool WriteNormalizedImage4d(OutputVolumeType4D::Pointer image, std::string filename, double normalizationFactor, bool useCompression=false)
+bool WriteNormalizedImage4d(OutputVolumeType4D::Pointer image, std::string filename, double normalizationFactor,
+                            const std::vector<double> & frameScales,
+                            progressReporter & progress, double progressFraction,
+                            int compressionLevel=0, unsigned int compressionThreads=0)
 {
   std::cout << "Writing normalized image " << filename << std::endl;
+  if (progress.aborted())
+    {
+    return false;
+    }
+  progress.startStage("normalizedVolume", "Writing normalized image " + filename, progressFraction);
   try {
-    using NormalizationFilterType = itk::ShiftScaleImageFilter<OutputVolumeType4D, OutputVolumeType4D> ;
-    auto normalize = NormalizationFilterType::New();
-    normalize->SetShift(0.0);
-    normalize->SetScale(normalizationFactor);
-    normalize->SetInput(image);
+    // scale every time frame by its own factor in a single pass over the buffer
+    auto normalized = OutputVolumeType4D::New();
+    normalized->CopyInformation(image);
+    normalized->SetRegions(image->GetLargestPossibleRegion());
+    normalized->Allocate();
+
+    const OutputVolumeType4D::SizeType size = image->GetLargestPossibleRegion().GetSize();
+    const size_t frameSize = size[0]*size[1]*size[2];
+    const float* input = image->GetBufferPointer();
+    float* output = normalized->GetBufferPointer();
+    for (size_t frame=0; frame<size[3]; ++frame)
+      {
+      // scaling is the first half of the stage, writing the second
+      if (!progress.update(0.5 * frame / size[3]))
+        {
+        std::cerr << "Aborted while normalizing " << filename << std::endl;
+        return false;
+        }
+      const float factor = static_cast<float>(normalizationFactor *
+        (frameScales.size() == size[3] ? frameScales[frame] : 1.0));
+      const float* frameInput = input + frame*frameSize;
+      float* frameOutput = output + frame*frameSize;
+      for (size_t i=0; i<frameSize; ++i)
+        {
+        frameOutput[i] = frameInput[i] * factor;
+        }
+      }
 
-    using WriterType = itk::ImageFileWriter<OutputVolumeType4D>;
-    auto writer = WriterType::New();
-    writer->SetInput( normalize->GetOutput() );
-    writer->SetFileName( filename );
-    writer->SetUseCompression(useCompression);
-    writer->Update();
+    WriteVolume(normalized.GetPointer(), filename, compressionLevel, compressionThreads, progress);
   } catch (itk::ExceptionObject &ex) {
     std::cout << ex << std::endl;
     return false;
   }
+  progress.endStage();
   return true;
 }
 
@@ -911,25 +1272,6 @@ int LoadImagesAndComputeSUV( parameters & list )
 }
 
 
-bool IsMultiFrameDICOM(const std::string& filePath)
-{
-    itk::GDCMImageIO::Pointer dicomIO = itk::GDCMImageIO::New();
-    dicomIO->SetFileName(filePath);
-    dicomIO->ReadImageInformation();
-
-    const auto& dict = dicomIO->GetMetaDataDictionary();
-
-    std::string tag = "0028|0008"; // Number of Frames
-    if (dict.HasKey(tag)) {
-        std::string numFrames;
-        itk::ExposeMetaData<std::string>(dict, tag, numFrames);
-        std::cout << "Number of Frames: " << numFrames << std::endl;
-        return std::stoi(numFrames) > 1;
-    }
-
-    return false; // Single-frame (probably part of 2D slice series)
-}
-
 
 bool str2tag(const std::string& input, uint16_t& group, uint16_t& element) {
     std::string cleaned;
@@ -962,126 +1304,149 @@ bool str2tag(const std::string& input, uint16_t& group, uint16_t& element) {
     return !groupStream.fail() && !elementStream.fail();
 }
 
-int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
+//--- Read the files of a series into a volume of the requested pixel type.
+template <typename TImage>
+typename TImage::Pointer ReadPETSeries(const std::vector<std::string> & filenames, unsigned int,
+                                       progressReporter & progress, TImage *)
 {
-  typedef itk::GDCMSeriesFileNames InputNamesGeneratorType;
+  auto reader = itk::ImageSeriesReader< TImage >::New();
+  reader->SetImageIO( itk::GDCMImageIO::New() );
+  reader->SetFileNames( filenames );
+  itk::PluginFilterWatcher watcher(reader, "Read PET series", progress.processInformation,
+                                   progress.stageFraction, progress.stageStart);
+  reader->Update();
+  return reader->GetOutput();
+}
 
-  if ( !list.PETDICOMPath.compare(""))
+//--- Classic 3D series (one slice per file) are decoded on several threads.
+template <typename TPixel>
+typename itk::Image<TPixel, 3>::Pointer ReadPETSeries(const std::vector<std::string> & filenames,
+                                                      unsigned int numberOfThreads, progressReporter & progress,
+                                                      itk::Image<TPixel, 3> *)
+{
+  if (filenames.size() < 2)
     {
-    std::cerr << "GetParametersFromDicomHeader:Got empty list.PETDICOMPath." << std::endl;
-    return EXIT_FAILURE;
+    auto reader = itk::ImageSeriesReader< itk::Image<TPixel, 3> >::New();
+    reader->SetImageIO( itk::GDCMImageIO::New() );
+    reader->SetFileNames( filenames );
+    itk::PluginFilterWatcher watcher(reader, "Read PET series", progress.processInformation,
+                                     progress.stageFraction, progress.stageStart);
+    reader->Update();
+    return reader->GetOutput();
     }
+  return dcmSeriesReaderHelper::readSlices<TPixel>(filenames, numberOfThreads,
+    [&progress](double sliceProgress) { return progress.update(sliceProgress); });
+}
 
-  //--- catch non-dicom data
-  vtkGlobFileNames* gfn = vtkGlobFileNames::New();
-  gfn->SetDirectory(list.PETDICOMPath.c_str());
-  gfn->AddFileNames("*.nhdr");
-  gfn->AddFileNames("*.nrrd");
-  gfn->AddFileNames("*.hdr");
-  gfn->AddFileNames("*.mha");
-  gfn->AddFileNames("*.img");
-  gfn->AddFileNames("*.nii");
-  gfn->AddFileNames("*.nia");
-
-  int notDICOM = 0;
-  int nFiles = gfn->GetNumberOfFileNames();
-  if (nFiles > 0)
+//--- Read the pixel data of a PET series once. If the output volume is requested
+//--- it is read with the precision of the output volume and the largest stored
+//--- value is derived from it, otherwise the series is read as short.
+template <unsigned int VDimension>
+int ReadPETVolume(const std::vector<std::string> & filenames, bool readOutputVolume, unsigned int numberOfThreads,
+                  progressReporter & progress, short & maxPixelValue,
+                  typename itk::Image<float, VDimension>::Pointer & outputVolume)
+{
+  try
     {
-    notDICOM = 1;
+    if (readOutputVolume)
+      {
+      using FloatVolumeType = itk::Image<float, VDimension>;
+      outputVolume = ReadPETSeries(filenames, numberOfThreads, progress, static_cast<FloatVolumeType *>(nullptr));
+
+      // Determine largest value
+      auto calc = itk::MinimumMaximumImageCalculator<FloatVolumeType>::New();
+      calc->SetImage(outputVolume);
+      calc->Compute();
+      // rescaled values can exceed the range of short, clamp before the cast
+      const float maximum = std::min<float>(std::max<float>(calc->GetMaximum(), itk::NumericTraits<short>::min()),
+                                            itk::NumericTraits<short>::max());
+      maxPixelValue = static_cast<short>(maximum);
+      }
+    else
+      {
+      using VolumeType = itk::Image<short, VDimension>;
+      typename VolumeType::Pointer volume = ReadPETSeries(filenames, numberOfThreads, progress,
+                                                          static_cast<VolumeType *>(nullptr));
+
+      // Determine largest value
+      auto calc = itk::MinimumMaximumImageCalculator<VolumeType>::New();
+      calc->SetImage(volume);
+      calc->Compute();
+      maxPixelValue = calc->GetMaximum();
+      }
     }
-  gfn->Delete();
-  if ( notDICOM )
+  catch (itk::ExceptionObject &ex)
     {
-    std::cerr << "PET Dicom parameter doesn't point to a dicom directory!" << std::endl;
+    std::cout << ex << std::endl;
     return EXIT_FAILURE;
     }
+  return EXIT_SUCCESS;
+}
 
-  InputNamesGeneratorType::Pointer inputNames = InputNamesGeneratorType::New();
-  inputNames->SetUseSeriesDetails(false); // Series details not necessary to distinguish between different PET scans
-  inputNames->SetDirectory(list.PETDICOMPath);
-  itk::SerieUIDContainer seriesUIDs = inputNames->GetSeriesUIDs();
-  std::string selectedSeriesUID = list.PETSeriesInstanceUID.length()>0 ? list.PETSeriesInstanceUID : seriesUIDs[0];
-  if (std::find(seriesUIDs.begin(), seriesUIDs.end(), selectedSeriesUID) == seriesUIDs.end())
+int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
+{
+  if ( !list.PETDICOMPath.compare(""))
+    {
+    std::cerr << "GetParametersFromDicomHeader:Got empty list.PETDICOMPath." << std::endl;
+    return EXIT_FAILURE;
+    }
+
+  //--- header prefix scan (or series index) of the directory, non-dicom data is caught there
+  list.progress.startStage("discovery", "Finding the files of the PET series", 0.05);
+  std::string selectedSeriesUID;
+  if (!dcmSeriesDiscoveryHelper::findSeriesFiles(list.PETDICOMPath, list.PETSeriesInstanceUID, list.useSeriesIndex,
+                                                 selectedSeriesUID, list.PETFilenames))
+    {
+    return EXIT_FAILURE;
+    }
+  list.progress.endStage();
+  if (list.PETFilenames.empty())
   {
     std::cerr << "Selected series instance UID not found in PET dicom path!" << std::endl;
     return EXIT_FAILURE;
   }
-  std::vector<std::string> fns = inputNames->GetFileNames(selectedSeriesUID);
-  list.PETFilenames = inputNames->GetFileNames(selectedSeriesUID);
 
-  std::string FirstFile = fns[0];
-  bool multiframe = IsMultiFrameDICOM(FirstFile);
-  list.multiframe = multiframe;
-  list.seriesdimension = multiframe? "4D" : "3D";
+  std::string FirstFile = list.PETFilenames[0];
 
-  typedef short PixelValueType;
-  if (multiframe) {
-    typedef itk::Image< PixelValueType, 4 > VolumeType;
-    typedef itk::ImageSeriesReader< VolumeType > VolumeReaderType;
-    itk::GDCMImageIO::Pointer dicomIO = itk::GDCMImageIO::New();
-    const VolumeReaderType::FileNamesContainer & filenames = inputNames->GetFileNames(selectedSeriesUID);
-    VolumeReaderType::Pointer volumeReader = VolumeReaderType::New();
-    volumeReader->SetImageIO( dicomIO );
-    volumeReader->SetFileNames( filenames );
-    try{
-        volumeReader->Update();
-      }
-        catch (itk::ExceptionObject &ex)
-      {
-        std::cout << ex << std::endl;
-        return EXIT_FAILURE;
-      }
-
-    // Determine largest value
-    using MinMaxCalculatorType = itk::MinimumMaximumImageCalculator<VolumeType>;
-    auto calc = MinMaxCalculatorType::New();
-    calc->SetImage(volumeReader->GetOutput());
-    calc->Compute();
-    list.maxPixelValue = calc->GetMaximum();
-
-    if (list.outputVolumeRequested){ // read image with precision of output volume
-        auto reader = itk::ImageSeriesReader< OutputVolumeType4D >::New();
-        reader->SetImageIO( dicomIO );
-        reader->SetFileNames( filenames );
-        reader->Update();
-        list.unnormalizedVolume4d = reader->GetOutput();
+  //--- the header of the first file (without pixel data) is the single
+  //--- source of the series metadata
+  tagKeys keys;
+  ResolveDICOMTags(taglist, keys);
+  itk::DCMTKFileReader fileReader;
+  fileReader.SetFileName(FirstFile);
+  try
+    {
+    fileReader.LoadFileHeader();
+    }
+  catch (itk::ExceptionObject &ex)
+    {
+    std::cerr << "Cannot read metadata! " << ex << std::endl;
+    return EXIT_FAILURE;
     }
 
+  bool multiframe = fileReader.GetFrameCount() > 1;
+  std::cout << "Number of Frames: " << fileReader.GetFrameCount() << std::endl;
+  list.multiframe = multiframe;
+  list.seriesdimension = multiframe? "4D" : "3D";
+  list.timings.stop("metadata");
 
-  } else {
-    typedef itk::Image< PixelValueType, 3 > VolumeType;
-    typedef itk::ImageSeriesReader< VolumeType > VolumeReaderType;
-    itk::GDCMImageIO::Pointer dicomIO = itk::GDCMImageIO::New();
-    const VolumeReaderType::FileNamesContainer & filenames = inputNames->GetFileNames(selectedSeriesUID);
-    VolumeReaderType::Pointer volumeReader = VolumeReaderType::New();
-    volumeReader->SetImageIO( dicomIO );
-    volumeReader->SetFileNames( filenames );
-    try{
-        volumeReader->Update();
-      }
-        catch (itk::ExceptionObject &ex)
-      {
-        std::cout << ex << std::endl;
-        return EXIT_FAILURE;
-      }
-
-
-    // Determine largest value
-    using MinMaxCalculatorType = itk::MinimumMaximumImageCalculator<VolumeType>;
-    auto calc = MinMaxCalculatorType::New();
-    calc->SetImage(volumeReader->GetOutput());
-    calc->Compute();
-    list.maxPixelValue = calc->GetMaximum();
-
-    if (list.outputVolumeRequested){ // read image with precision of output volume
-        auto reader = itk::ImageSeriesReader< OutputVolumeType >::New();
-        reader->SetImageIO( dicomIO );
-        reader->SetFileNames( filenames );
-        reader->Update();
-        list.unnormalizedVolume = reader->GetOutput();
+  if (list.progress.aborted())
+    {
+    return EXIT_FAILURE;
     }
-
-  }
+  list.progress.startStage("read", "Reading the PET series", 0.5);
+  int readStatus = multiframe ?
+    ReadPETVolume<4>(list.PETFilenames, list.outputVolumeRequested, list.numberOfThreads, list.progress,
+                     list.maxPixelValue, list.unnormalizedVolume4d) :
+    ReadPETVolume<3>(list.PETFilenames, list.outputVolumeRequested, list.numberOfThreads, list.progress,
+                     list.maxPixelValue, list.unnormalizedVolume);
+  if (readStatus != EXIT_SUCCESS)
+    {
+    return EXIT_FAILURE;
+    }
+  list.progress.endStage();
+  list.timings.stop("read");
+  list.progress.startStage("factor", "Computing the SUV factors", 0.05);
 
   std::string tag;
   std::string yearstr;
@@ -1101,21 +1466,9 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
     0018,1076  Radionuclide Positron Fraction: 0
 */
   int parsingDICOM = 0;
-  itk::DCMTKFileReader fileReader;
-  fileReader.SetFileName(FirstFile);
-  fileReader.LoadFile();
-
   uint16_t grouptag, elementtag;
-  DcmFileFormat fileFormat;
-  DcmDataset* petDataset = NULL;
-  if(fileFormat.loadFile(FirstFile.c_str()).bad()){
-    std::cerr << "Cannot read metadata!" << std::endl;
-    return EXIT_FAILURE;
-  }
-  petDataset = fileFormat.getAndRemoveDataset();
-  std :: string tagvalue;
 
-  parseDICOMTag(taglist.RISTag, grouptag, elementtag, "Radiopharmaceutical Information Sequence");
+  grouptag = keys.RIS.getGroup(); elementtag = keys.RIS.getElement();
 
   itk::DCMTKSequence seq;
   if(fileReader.GetElementSQ(grouptag,elementtag,seq,false) == EXIT_SUCCESS)
@@ -1124,7 +1477,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
           //---
           //--- Radiopharmaceutical Start Time
 
-      parseDICOMTag(taglist.RIStimeTag, grouptag, elementtag, "Radionuclide Start Time");
+      grouptag = keys.RIStime.getGroup(); elementtag = keys.RIStime.getElement();
 
       seq.GetElementTM(grouptag,elementtag,tag);
           //--- expect A string of characters of the format hhmmss.frac;
@@ -1189,7 +1542,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
 
         //---
         //--- Radionuclide Total Dose
-      parseDICOMTag(taglist.RIStdoseTag, grouptag, elementtag, "Radionuclide Total Dose");
+      grouptag = keys.RIStdose.getGroup(); elementtag = keys.RIStdose.getElement();
       if(seq.GetElementDS(grouptag,elementtag,1,&list.injectedDose,false) != EXIT_SUCCESS)
         {
           list.injectedDose = 0.0;
@@ -1206,7 +1559,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
           //--- as defined in ANSI X3.9, with an "E" or "e" to indicate the start
           //--- of the exponent. Decimal Strings may be padded with leading
           //--- or trailing spaces. Embedded spaces are not allowed.
-      parseDICOMTag(taglist.RIShalflifeTag, grouptag, elementtag, "Radionuclide Half Life");
+      grouptag = keys.RIShalflife.getGroup(); elementtag = keys.RIShalflife.getElement();
       if(seq.GetElementDS(grouptag,elementtag,list.radionuclideHalfLife,false) != EXIT_SUCCESS)
         {
           list.radionuclideHalfLife = "MODULE_INIT_NO_VALUE";
@@ -1215,7 +1568,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
           //---Radionuclide Positron Fraction
           //--- not currently using this one?
       std::string radioNuclidePositronFraction;
-      parseDICOMTag(taglist.RISposfracTag, grouptag, elementtag, "Radionuclide Positron Fraction");
+      grouptag = keys.RISposfrac.getGroup(); elementtag = keys.RISposfrac.getElement();
       if(seq.GetElementDS(grouptag,elementtag,radioNuclidePositronFraction,false) != EXIT_SUCCESS)
         {
           radioNuclidePositronFraction = "MODULE_INIT_NO_VALUE";
@@ -1228,7 +1581,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
         //--- 1CM, UMOLML, PROPCNTS, PROPCPS,
         //--- MLMINML, MLML, GML, STDDEV
         //---
-      parseDICOMTag(taglist.RISunitsTag, grouptag, elementtag, "Units");
+      grouptag = keys.RISunits.getGroup(); elementtag = keys.RISunits.getElement();
       if(fileReader.GetElementCS(grouptag,elementtag,tag,false) == EXIT_SUCCESS)
         {
           //--- I think these are piled together. MBq ml... search for all.
@@ -1312,7 +1665,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
         //--- Series Date (0008,0021) and
         //--- Series Time (0008,0031).
         //--- We don't pull these out now, but can if we have to.
-      parseDICOMTag(taglist.decaycorrTag, grouptag, elementtag, "Decay Correction");
+      grouptag = keys.decaycorr.getGroup(); elementtag = keys.decaycorr.getElement();
       if(fileReader.GetElementCS(grouptag,elementtag,tag,false) == EXIT_SUCCESS)
         {
           //---A string of characters with leading or trailing spaces (20H) being non-significant.
@@ -1325,7 +1678,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
 
       //---
       //--- StudyDate
-      parseDICOMTag(taglist.StudyDateTag, grouptag, elementtag, "Study Date");
+      grouptag = keys.StudyDate.getGroup(); elementtag = keys.StudyDate.getElement();
       if(fileReader.GetElementDA(grouptag,elementtag,tag,false) == EXIT_SUCCESS)
         {
           //--- YYYYMMDD
@@ -1372,7 +1725,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
 
       //---
       //--- PatientName
-      parseDICOMTag(taglist.PatientNameTag, grouptag, elementtag, "Patient Name");
+      grouptag = keys.PatientName.getGroup(); elementtag = keys.PatientName.getElement();
       if(fileReader.GetElementPN(grouptag,elementtag,tag,false) == EXIT_SUCCESS)
         {
           list.patientName = tag.c_str();
@@ -1384,7 +1737,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
 
       //---
       //--- DecayFactor
-      parseDICOMTag(taglist.DecayFactorTag, grouptag, elementtag, "Decay Factor");
+      grouptag = keys.DecayFactor.getGroup(); elementtag = keys.DecayFactor.getElement();
       if(fileReader.GetElementDS(grouptag,elementtag,tag,false) == EXIT_SUCCESS)
         {
           //--- have to parse this out. what we have is
@@ -1405,7 +1758,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
 
       //---
       //--- FrameReferenceTime
-      parseDICOMTag(taglist.FrameReferenceTimeTag, grouptag, elementtag, "Frame Reference Time");
+      grouptag = keys.FrameReferenceTime.getGroup(); elementtag = keys.FrameReferenceTime.getElement();
       if(fileReader.GetElementDS(grouptag,elementtag,tag,false) == EXIT_SUCCESS)
         {
           //--- The time that the pixel values in the image
@@ -1422,7 +1775,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
 
       //---
       //--- SeriesTime
-      parseDICOMTag(taglist.SeriesTimeTag, grouptag, elementtag, "Series Time");
+      grouptag = keys.SeriesTime.getGroup(); elementtag = keys.SeriesTime.getElement();
       if(fileReader.GetElementTM(grouptag,elementtag,tag,false) == EXIT_SUCCESS)
         {
           hourstr.clear();
@@ -1469,7 +1822,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
 
       //---
       //--- PatientWeight
-      parseDICOMTag(taglist.PatientWeightTag, grouptag, elementtag, "Patient Weight");
+      grouptag = keys.PatientWeight.getGroup(); elementtag = keys.PatientWeight.getElement();
       if(fileReader.GetElementDS(grouptag,elementtag,1,&list.patientWeight,false) == EXIT_SUCCESS)
         {
           //--- Expect same format as RadionuclideHalfLife
@@ -1483,7 +1836,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
 
       //---
       //--- PatientSize
-      parseDICOMTag(taglist.PatientSizeTag, grouptag, elementtag, "Patient Size");
+      grouptag = keys.PatientSize.getGroup(); elementtag = keys.PatientSize.getElement();
       if(fileReader.GetElementDS(grouptag,elementtag,1,&list.patientHeight,false) == EXIT_SUCCESS)
         {
           //--- Assumed to be in meters?
@@ -1497,7 +1850,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
 
       //---
       //--- PatientSex
-      parseDICOMTag(taglist.PatientSexTag, grouptag, elementtag, "Patient Sex");
+      grouptag = keys.PatientSex.getGroup(); elementtag = keys.PatientSex.getElement();
       if(fileReader.GetElementCS(grouptag,elementtag,tag,false) == EXIT_SUCCESS)
         {
           list.patientSex = tag.c_str();
@@ -1514,7 +1867,7 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
       //---
       //--- CorrectedImage
       std::string correctedImage;
-      parseDICOMTag(taglist.CorrectedImageTag, grouptag, elementtag, "Corrected Image");
+      grouptag = keys.CorrectedImage.getGroup(); elementtag = keys.CorrectedImage.getElement();
       if(fileReader.GetElementCS(grouptag,elementtag,correctedImage,false) == EXIT_SUCCESS)
         {
           list.correctedImage = correctedImage;
@@ -1569,13 +1922,17 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
   if(list.correctedImage.compare("MODULE_INIT_NO_VALUE") != 0)
     {
       std::string correctedImage = list.correctedImage;
-      if(correctedImage.find("ATTN")!=std::string::npos &&
-         (correctedImage.find("DECAY")!=std::string::npos || correctedImage.find("DECY")!=std::string::npos))
+      const bool decayCorrected = correctedImage.find("DECAY")!=std::string::npos ||
+                                  correctedImage.find("DECY")!=std::string::npos;
+      if(correctedImage.find("ATTN")!=std::string::npos)
         {
-          std::cout << "ATTN/DECAY correction detected." << std::endl;
-          if(list.decayCorrection=="START")
+          std::cout << "ATTN correction detected." << std::endl;
+          // START and ADMIN pixel values are decay corrected (DECY), NONE pixel values
+          // are not and their decay to the frame reference time is part of the factor
+          if(decayCorrected ? (list.decayCorrection=="START" || list.decayCorrection=="ADMIN")
+                            : list.decayCorrection=="NONE")
             {
-              std::cout << "Decay correction START detected." << std::endl;
+              std::cout << "Decay correction " << list.decayCorrection << " detected." << std::endl;
               std::string halfLife = list.radionuclideHalfLife;
               double weight = list.patientWeight;
               double height = list.patientHeight*100; //convert to centimeters
@@ -1592,7 +1949,14 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
                   return EXIT_FAILURE;
                 }
               dose  = ConvertRadioactivityUnits( dose, list.radioactivityUnits.c_str(), "kBq");  // kBq/mL
-              double decayedDose = DecayCorrection(list, dose);
+              double decayedDose = DecayCorrection(list, dose, atof(list.frameReferenceTime.c_str()));
+              if(list.multiframe)
+                {
+                  if(ComputeFrameDecayScales(list, keys.FrameReferenceTime, dose) != EXIT_SUCCESS)
+                    {
+                      return EXIT_FAILURE;
+                    }
+                }
               weight = ConvertWeightUnits( weight, list.weightUnits.c_str(), "kg");
               if( decayedDose == 0.0 )
                 {
@@ -1639,13 +2003,14 @@ int LoadImagesAndComputeSUV( parameters & list, tags & taglist)
             }
           else
             {
-              std::cout << "Decay correction is not START." << std::endl;
+              std::cout << "Decay correction " << list.decayCorrection << " does not match corrected image "
+                        << correctedImage << ": START and ADMIN require DECY, NONE requires its absence." << std::endl;
               return EXIT_FAILURE;
             }
         }
       else
         {
-          std::cout << "No attenuation/decay correction detected." << std::endl;
+          std::cout << "No attenuation correction detected." << std::endl;
           return EXIT_FAILURE;
         }
     }
@@ -1676,7 +2041,7 @@ void InsertCodeSequence(DcmItem* item, const DcmTag tag, const DSRCodedEntryValu
 
 bool ExportRWV(parameters & list,
     std::vector<DSRCodedEntryValue> measurementUnitsList,
-    std::vector<std::string> measurementsList,
+    std::vector<double> measurementsList,
     std::string outputDir,
     std::string outputFileName = ""){
   unsigned int numFiles = list.PETFilenames.size();
@@ -1684,8 +2049,15 @@ bool ExportRWV(parameters & list,
   DcmFileFormat fileFormat;
   DcmDataset* petDataset = NULL;
   std::vector<OFString> instanceUIDs;
+  std::vector<unsigned int> instanceFrames; // time frame (file index) of every instance
   for(unsigned int i=0;i<numFiles;i++){
-    if(fileFormat.loadFile(list.PETFilenames[i].c_str()).bad()){
+    if(!list.progress.update(static_cast<double>(i) / numFiles)){
+      std::cerr << "Aborted while reading the PET instances" << std::endl;
+      return false;
+    }
+    // only the header is needed
+    if(fileFormat.loadFileUntilTag(list.PETFilenames[i].c_str(), EXS_Unknown, EGL_noChange, DCM_MaxReadLength,
+                                   ERM_autoDetect, DCM_PixelData).bad()){
       continue;
     }
 
@@ -1697,9 +2069,16 @@ bool ExportRWV(parameters & list,
     }
     petDataset->findAndGetOFString(DCM_SOPInstanceUID, instanceUID);
     instanceUIDs.push_back(instanceUID);
+    instanceFrames.push_back(i);
 
   }
 
+  // dynamic series with frame dependent decay get one mapping item per
+  // measurement and time frame, each referencing the instance of its frame
+  const bool perFrameMapping = list.multiframe && HasFrameDecayScales(list)
+    && list.frameDecayScales.size() == numFiles;
+  const unsigned int numMappingFrames = perFrameMapping ? numFiles : 1;
+
   DcmFileFormat rwvmFileFormat;
   DcmDataset* rwvDataset = rwvmFileFormat.getDataset();
   dcmHelpersCommon::copyPatientModule(petDataset, rwvDataset);
@@ -1746,17 +2125,22 @@ bool ExportRWV(parameters & list,
   rwvDataset->putAndInsertString(DCM_SeriesTime, contentTime.c_str());
   rwvDataset->putAndInsertString(DCM_SeriesDescription, list.seriesDescription.c_str());
 
-  for(unsigned int measurementId=0;measurementId<measurementUnitsList.size();measurementId++){
+  for(unsigned int mappingId=0;mappingId<measurementUnitsList.size()*numMappingFrames;mappingId++){
+    const unsigned int measurementId = mappingId / numMappingFrames;
+    const unsigned int frameId = mappingId % numMappingFrames;
+    std::stringstream slopeSStream;
+    slopeSStream << measurementsList[measurementId] * (perFrameMapping ? list.frameDecayScales[frameId] : 1.0);
+
     DcmItem *referencedImageRWVSeqItem, *rwvSeqItem;//, *rwvUnits;
     rwvDataset->findOrCreateSequenceItem(DCM_ReferencedImageRealWorldValueMappingSequence,
-                                         referencedImageRWVSeqItem, measurementId);
+                                         referencedImageRWVSeqItem, mappingId);
     referencedImageRWVSeqItem->findOrCreateSequenceItem(DCM_RealWorldValueMappingSequence, rwvSeqItem);
     rwvSeqItem->putAndInsertString(DCM_LUTExplanation,measurementUnitsList[measurementId].getCodeMeaning().c_str());
     rwvSeqItem->putAndInsertString(DCM_LUTLabel,measurementUnitsList[measurementId].getCodeValue().c_str());
     rwvSeqItem->putAndInsertSint16(DCM_RealWorldValueFirstValueMapped,0);
     rwvSeqItem->putAndInsertUint16(DCM_RealWorldValueLastValueMapped,list.maxPixelValue);
     rwvSeqItem->putAndInsertString(DCM_RealWorldValueIntercept,"0");
-    rwvSeqItem->putAndInsertString(DCM_RealWorldValueSlope, measurementsList[measurementId].c_str());
+    rwvSeqItem->putAndInsertString(DCM_RealWorldValueSlope, slopeSStream.str().c_str());
 
     DSRCodedEntryValue measurement = measurementUnitsList[measurementId];
     InsertCodeSequence(rwvSeqItem, DCM_MeasurementUnitsCodeSequence,
@@ -1802,9 +2186,13 @@ bool ExportRWV(parameters & list,
                          DSRCodedEntryValue("126413","DCM","SUV ideal body weight calculation method"));
     };
 
+    int referencedImageId = 0;
     for(unsigned int imageId=0;imageId<instanceUIDs.size();imageId++){
+      if(perFrameMapping && instanceFrames[imageId] != frameId){
+        continue;
+      }
       DcmItem* referencedSOPItem;
-      referencedImageRWVSeqItem->findOrCreateSequenceItem(DCM_ReferencedImageSequence, referencedSOPItem, imageId);
+      referencedImageRWVSeqItem->findOrCreateSequenceItem(DCM_ReferencedImageSequence, referencedSOPItem, referencedImageId++);
       referencedSOPItem->putAndInsertString(DCM_ReferencedSOPClassUID, UID_PositronEmissionTomographyImageStorage);
       referencedSOPItem->putAndInsertString(DCM_ReferencedSOPInstanceUID, instanceUIDs[imageId].c_str());
     }
@@ -1837,6 +2225,107 @@ bool ExportRWV(parameters & list,
   return true;
 }
 
+//--- Geometry of the voxel buffer of a 3D or 4D volume for the parametric map
+template <typename TImage>
+dcmParametricMapHelper::Geometry ParametricMapGeometry(const TImage * image)
+{
+  dcmParametricMapHelper::Geometry geometry;
+  const typename TImage::SizeType size = image->GetLargestPossibleRegion().GetSize();
+  geometry.columns = size[0];
+  geometry.rows = size[1];
+  geometry.slices = size[2];
+  geometry.timeFrames = 1;
+  for (unsigned int d=3; d<TImage::ImageDimension; d++)
+    {
+    geometry.timeFrames *= size[d];
+    }
+  for (unsigned int i=0; i<3; i++)
+    {
+    geometry.origin[i] = image->GetOrigin()[i];
+    geometry.spacing[i] = image->GetSpacing()[i];
+    geometry.rowDirection[i] = image->GetDirection()[i][0];
+    geometry.columnDirection[i] = image->GetDirection()[i][1];
+    geometry.sliceDirection[i] = image->GetDirection()[i][2];
+    }
+  return geometry;
+}
+
+//--- Write every SUV volume as a DICOM Parametric Map into outputDir,
+//--- named after the PET series and the SUV type
+bool ExportParametricMaps(parameters & list,
+    const std::vector<DSRCodedEntryValue> & measurementUnitsList,
+    const std::vector<double> & measurementsList,
+    const std::string & outputDir,
+    double progressFraction)
+{
+  list.progress.startStage("parametricMap", "Writing parametric maps", progressFraction);
+  DcmFileFormat sourceFormat;
+  if (list.PETFilenames.empty() ||
+      sourceFormat.loadFileUntilTag(list.PETFilenames[0].c_str(), EXS_Unknown, EGL_noChange, DCM_MaxReadLength,
+                                    ERM_autoDetect, DCM_PixelData).bad())
+    {
+    std::cerr << "Cannot read the header of the PET series" << std::endl;
+    return false;
+    }
+  std::vector<std::string> instanceUIDs;
+  for (size_t i=0; i<list.PETFilenames.size(); i++)
+    {
+    // reading the references is a small part of the stage
+    if (!list.progress.update(0.1 * i / list.PETFilenames.size()))
+      {
+      return false;
+      }
+    DcmFileFormat fileFormat;
+    if (fileFormat.loadFileUntilTag(list.PETFilenames[i].c_str(), EXS_Unknown, EGL_noChange, DCM_MaxReadLength,
+                                    ERM_autoDetect, DCM_PixelData).bad())
+      {
+      continue;
+      }
+    OFString instanceUID;
+    if (fileFormat.getDataset()->findAndGetOFString(DCM_SOPInstanceUID, instanceUID).good())
+      {
+      instanceUIDs.push_back(instanceUID.c_str());
+      }
+    }
+
+  const float * voxels = list.multiframe ? list.unnormalizedVolume4d->GetBufferPointer()
+                                         : list.unnormalizedVolume->GetBufferPointer();
+  const dcmParametricMapHelper::Geometry geometry = list.multiframe ?
+    ParametricMapGeometry(list.unnormalizedVolume4d.GetPointer()) :
+    ParametricMapGeometry(list.unnormalizedVolume.GetPointer());
+  std::vector<double> frameScales;
+  if (list.multiframe && HasFrameDecayScales(list) && list.frameDecayScales.size() == geometry.timeFrames)
+    {
+    frameScales = list.frameDecayScales;
+    }
+
+  OFString petSeriesInstanceUID;
+  sourceFormat.getDataset()->findAndGetOFString(DCM_SeriesInstanceUID, petSeriesInstanceUID);
+  for (size_t m=0; m<measurementUnitsList.size(); m++)
+    {
+    if (!list.progress.update(0.1 + 0.9 * m / measurementUnitsList.size()))
+      {
+      return false;
+      }
+    // {SUVbw}g/ml -> SUVbw
+    std::string label = measurementUnitsList[m].getCodeValue().c_str();
+    label = label.substr(1, label.find('}') - 1);
+    std::stringstream seriesNumber;
+    seriesNumber << atoi(list.seriesNumber.c_str()) + 1 + m;
+    std::string sopInstanceUID;
+    if (!dcmParametricMapHelper::write(sourceFormat.getDataset(), voxels, geometry, measurementsList[m], frameScales,
+                                       instanceUIDs, measurementUnitsList[m],
+                                       measurementUnitsList[m].getCodeMeaning().c_str(), seriesNumber.str(),
+                                       outputDir + "/" + petSeriesInstanceUID.c_str() + "_" + label + ".dcm",
+                                       sopInstanceUID))
+      {
+      return false;
+      }
+    }
+  list.progress.endStage();
+  return true;
+}
+
 // ...
 // ...............................................................................................
 // ...
@@ -1876,7 +2365,8 @@ int main( int argc, char * argv[] )
   list.correctedImage = "MODULE_INIT_NO_VALUE";
   list.maxPixelValue = itk::NumericTraits< short >::min();
   list.seriesdimension = "";
-  list.outputVolumeRequested = (SUVBWName!="" || SUVBSAName!="" || SUVLBMName!="" || SUVIBWName!="");
+  list.outputVolumeRequested = (SUVBWName!="" || SUVBSAName!="" || SUVLBMName!="" || SUVIBWName!=""
+                                || parametricMapDICOMPath!="");
 
   try
     {
@@ -1900,53 +2390,67 @@ int main( int argc, char * argv[] )
     // pass the input parameters to the helper method
     list.PETDICOMPath = PETDICOMPath;
     list.PETSeriesInstanceUID = PETSeriesInstanceUID;
+    list.useSeriesIndex = useSeriesIndex;
+    list.numberOfThreads = numberOfThreads > 0 ? numberOfThreads : 0;
+    list.compressionLevel = std::max(0, std::min(compressionLevel, 9));
+    list.compressionThreads = compressionThreads > 0 ? compressionThreads : 0;
     list.seriesDescription = seriesDescription;
     list.seriesNumber = seriesNumber;
     list.instanceNumber = instanceNumber;
     // GenerateCLP makes a temporary file with the path saved to
     // returnParameterFile, write the output strings in there as key = value pairs
     list.returnParameterFile = returnParameterFile;
+    list.progress.processInformation = CLPProcessInformation;
 
+    list.timings.restart();
     if(LoadImagesAndComputeSUV( list, taglist ) != EXIT_FAILURE){
+      list.progress.endStage();
+      list.timings.stop("factor");
 
-      if (RWVDICOMPath!="" || RWVMFile!="")
-      {
-         // produce RWVM file
-        std::vector<DSRCodedEntryValue> measurementsUnitsList;
-        std::vector<std::string> measurementsList;
+      // SUV factors of the RWVM and the parametric maps
+      std::vector<DSRCodedEntryValue> measurementsUnitsList;
+      std::vector<double> measurementsList;
 
-        std::stringstream SUVbwSStream, SUVlbmSStream, SUVbsaSStream, SUVibwSStream;
+      if(list.SUVbwConversionFactor!=0.0)
+        {
+          measurementsUnitsList.push_back(DSRCodedEntryValue("{SUVbw}g/ml","UCUM","Standardized Uptake Value body weight"));
+          measurementsList.push_back(list.SUVbwConversionFactor);
+        }
+      if(list.SUVlbmConversionFactor!=0.0)
+        {
+          measurementsUnitsList.push_back(DSRCodedEntryValue("{SUVlbm}g/ml","UCUM","Standardized Uptake Value lean body mass"));
+          measurementsList.push_back(list.SUVlbmConversionFactor);
+        }
+      if(list.SUVbsaConversionFactor!=0.0)
+        {
+          measurementsUnitsList.push_back(DSRCodedEntryValue("{SUVbsa}cm2/ml","UCUM","Standardized Uptake Value body surface area"));
+          measurementsList.push_back(list.SUVbsaConversionFactor);
+        }
+      if(list.SUVibwConversionFactor!=0.0)
+        {
+          measurementsUnitsList.push_back(DSRCodedEntryValue("{SUVibw}g/ml","UCUM","Standardized Uptake Value ideal body weight"));
+          measurementsList.push_back(list.SUVibwConversionFactor);
+        }
 
-        if(list.SUVbwConversionFactor!=0.0)
-          {
-            SUVbwSStream << list.SUVbwConversionFactor;
-            measurementsUnitsList.push_back(DSRCodedEntryValue("{SUVbw}g/ml","UCUM","Standardized Uptake Value body weight"));
-            measurementsList.push_back(SUVbwSStream.str());
-          }
-        if(list.SUVlbmConversionFactor!=0.0)
-          {
-            SUVlbmSStream << list.SUVlbmConversionFactor;
-            measurementsUnitsList.push_back(DSRCodedEntryValue("{SUVlbm}g/ml","UCUM","Standardized Uptake Value lean body mass"));
-            measurementsList.push_back(SUVlbmSStream.str());
-          }
-        if(list.SUVbsaConversionFactor!=0.0)
-          {
-            SUVbsaSStream << list.SUVbsaConversionFactor;
-            measurementsUnitsList.push_back(DSRCodedEntryValue("{SUVbsa}cm2/ml","UCUM","Standardized Uptake Value body surface area"));
-            measurementsList.push_back(SUVbsaSStream.str());
-          }
-        if(list.SUVibwConversionFactor!=0.0)
+      if (RWVDICOMPath!="" || RWVMFile!="")
+      {
+        // produce RWVM file
+        list.progress.startStage("rwvm", "Writing the real world value mapping", 0.1);
+        if (!ExportRWV(list, measurementsUnitsList, measurementsList, RWVDICOMPath.c_str(), RWVMFile))
           {
-            SUVibwSStream << list.SUVibwConversionFactor;
-            measurementsUnitsList.push_back(DSRCodedEntryValue("{SUVibw}g/ml","UCUM","Standardized Uptake Value ideal body weight"));
-            measurementsList.push_back(SUVibwSStream.str());
+          std::cerr << "ERROR: Failed to write the real world value mapping" << std::endl;
+          return EXIT_FAILURE;
           }
-
-        ExportRWV(list, measurementsUnitsList, measurementsList, RWVDICOMPath.c_str(), RWVMFile);
+        list.progress.endStage();
+        list.timings.stop("rwvm");
       }
 
       if (list.outputVolumeRequested)
       {
+        // the normalized volumes and the parametric maps share the rest of the progress
+        const int numberOfVolumes = (SUVBWName!="") + (SUVLBMName!="") + (SUVBSAName!="") + (SUVIBWName!="")
+                                    + (parametricMapDICOMPath!="");
+        const double volumeFraction = list.progress.remaining() / numberOfVolumes;
         // write SUV normalized volume(s)
         if (SUVBWName!="")
         {
@@ -1954,9 +2458,12 @@ int main( int argc, char * argv[] )
             std::cerr << "WARNING: Can't compute SUV body weight and produce normalized volume." << std::endl;
           else {
             if (list.multiframe)
-              WriteNormalizedImage4d(list.unnormalizedVolume4d, SUVBWName, list.SUVbwConversionFactor);
+              WriteNormalizedImage4d(list.unnormalizedVolume4d, SUVBWName, list.SUVbwConversionFactor, list.frameDecayScales,
+                                     list.progress, volumeFraction,
+                                     list.compressionLevel, list.compressionThreads);
             else
-              WriteNormalizedImage(list.unnormalizedVolume, SUVBWName, list.SUVbwConversionFactor);
+              WriteNormalizedImage(list.unnormalizedVolume, SUVBWName, list.SUVbwConversionFactor, list.progress, volumeFraction,
+                                   list.compressionLevel, list.compressionThreads);
 
           }
         }
@@ -1966,9 +2473,12 @@ int main( int argc, char * argv[] )
             std::cerr << "WARNING: Can't compute SUV lean body mass and produce normalized volume." << std::endl;
           else {
             if (list.multiframe)
-              WriteNormalizedImage4d(list.unnormalizedVolume4d, SUVLBMName, list.SUVbwConversionFactor);
+              WriteNormalizedImage4d(list.unnormalizedVolume4d, SUVLBMName, list.SUVlbmConversionFactor, list.frameDecayScales,
+                                     list.progress, volumeFraction,
+                                     list.compressionLevel, list.compressionThreads);
             else
-              WriteNormalizedImage(list.unnormalizedVolume, SUVLBMName, list.SUVlbmConversionFactor);
+              WriteNormalizedImage(list.unnormalizedVolume, SUVLBMName, list.SUVlbmConversionFactor, list.progress, volumeFraction,
+                                   list.compressionLevel, list.compressionThreads);
           }
         }
         if (SUVBSAName!="")
@@ -1977,9 +2487,12 @@ int main( int argc, char * argv[] )
             std::cerr << "WARNING: Can't compute SUV body surface area and produce normalized volume." << std::endl;
           else {
             if (list.multiframe)
-              WriteNormalizedImage4d(list.unnormalizedVolume4d, SUVBSAName, list.SUVbwConversionFactor);
+              WriteNormalizedImage4d(list.unnormalizedVolume4d, SUVBSAName, list.SUVbsaConversionFactor, list.frameDecayScales,
+                                     list.progress, volumeFraction,
+                                     list.compressionLevel, list.compressionThreads);
             else
-              WriteNormalizedImage(list.unnormalizedVolume, SUVBSAName, list.SUVlbmConversionFactor);
+              WriteNormalizedImage(list.unnormalizedVolume, SUVBSAName, list.SUVbsaConversionFactor, list.progress, volumeFraction,
+                                   list.compressionLevel, list.compressionThreads);
           }
         }
         if (SUVIBWName!="")
@@ -1988,11 +2501,31 @@ int main( int argc, char * argv[] )
             std::cerr << "WARNING: Can't compute SUV ideal body weight and produce normalized volume." << std::endl;
           else {
             if (list.multiframe)
-              WriteNormalizedImage4d(list.unnormalizedVolume4d, SUVIBWName, list.SUVbwConversionFactor);
+              WriteNormalizedImage4d(list.unnormalizedVolume4d, SUVIBWName, list.SUVibwConversionFactor, list.frameDecayScales,
+                                     list.progress, volumeFraction,
+                                     list.compressionLevel, list.compressionThreads);
             else
-              WriteNormalizedImage(list.unnormalizedVolume, SUVIBWName, list.SUVlbmConversionFactor);
+              WriteNormalizedImage(list.unnormalizedVolume, SUVIBWName, list.SUVibwConversionFactor, list.progress, volumeFraction,
+                                   list.compressionLevel, list.compressionThreads);
           }
         }
+        list.timings.stop("normalizedVolume");
+
+        if (parametricMapDICOMPath!="")
+        {
+          if (!ExportParametricMaps(list, measurementsUnitsList, measurementsList, parametricMapDICOMPath, volumeFraction))
+            {
+            std::cerr << "ERROR: Failed to write the parametric maps" << std::endl;
+            return EXIT_FAILURE;
+            }
+          list.timings.stop("parametricMap");
+        }
+      }
+
+      if (list.progress.aborted())
+      {
+        std::cerr << "ERROR: Aborted" << std::endl;
+        return EXIT_FAILURE;
       }
 
       if (list.returnParameterFile!="")
@@ -2031,6 +2564,11 @@ int main( int argc, char * argv[] )
       std::cout << "SUVbsaConversionFactor = " << list.SUVbsaConversionFactor << std::endl;
       std::cout << "SUVibwConversionFactor = " << list.SUVibwConversionFactor << std::endl;
 
+      if (timingsFile!="")
+      {
+        WriteTimings(list, timingsFile);
+      }
+
     } else {
       std::cerr << "ERROR: Failed to compute SUV" << std::endl;
       return EXIT_FAILURE;
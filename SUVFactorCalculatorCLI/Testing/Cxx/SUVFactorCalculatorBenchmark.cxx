@@ -0,0 +1,278 @@
+// Performance benchmark of the SUVFactorCalculator CLI on a synthetic PET series.
+//
+// The series is written with DCMTK, either as one file per slice (classic) or as a
+// single multiframe file, then the CLI is run on it with RWVM export and a SUVbw
+// volume requested. The phase timings and the peak resident memory reported by the
+// CLI (--timingsFile) are written as JSON, together with the benchmark settings and
+// the size of the SUVbw volume. The compression options are passed on to the CLI, to
+// compare the normalizedVolume phase of uncompressed, single stream (1 thread) and
+// block parallel compression.
+//
+//   SUVFactorCalculatorBenchmark --cli <SUVFactorCalculator executable> --workdir <directory>
+//     [--layout classic|multiframe] [--slices 128] [--matrix 128] [--output timings.json]
+//     [--maxSeconds 0] [--compressionLevel 0] [--compressionThreads 0]
+
+#include "dcmtk/config/osconfig.h"
+#include "dcmtk/dcmdata/dcfilefo.h"
+#include "dcmtk/dcmdata/dcdeftag.h"
+#include "dcmtk/dcmdata/dcuid.h"
+
+#include <itksys/SystemTools.hxx>
+
+#include <chrono>
+#include <cstdlib>
+#include <fstream>
+#include <iostream>
+#include <sstream>
+#include <string>
+#include <vector>
+
+namespace
+{
+
+struct benchmarkSettings
+  {
+    std::string cli;
+    std::string workDirectory;
+    std::string layout = "classic";
+    unsigned int slices = 128;
+    unsigned int matrix = 128;
+    std::string output;
+    double maxSeconds = 0.0;
+    int compressionLevel = 0;
+    unsigned int compressionThreads = 0;
+  };
+
+void PutPETModules(DcmDataset* dataset, const std::string & studyUID, const std::string & seriesUID,
+                   const std::string & frameOfReferenceUID, unsigned int matrix)
+{
+  char uid[100];
+  dataset->putAndInsertString(DCM_SOPClassUID, UID_PositronEmissionTomographyImageStorage);
+  dataset->putAndInsertString(DCM_SOPInstanceUID, dcmGenerateUniqueIdentifier(uid, SITE_INSTANCE_UID_ROOT));
+  dataset->putAndInsertString(DCM_StudyInstanceUID, studyUID.c_str());
+  dataset->putAndInsertString(DCM_SeriesInstanceUID, seriesUID.c_str());
+  dataset->putAndInsertString(DCM_FrameOfReferenceUID, frameOfReferenceUID.c_str());
+  dataset->putAndInsertString(DCM_Modality, "PT");
+  dataset->putAndInsertString(DCM_PatientName, "Benchmark^PET");
+  dataset->putAndInsertString(DCM_PatientID, "SUVBENCHMARK");
+  dataset->putAndInsertString(DCM_PatientSex, "M");
+  dataset->putAndInsertString(DCM_PatientWeight, "75");
+  dataset->putAndInsertString(DCM_PatientSize, "1.8");
+  dataset->putAndInsertString(DCM_StudyDate, "20200101");
+  dataset->putAndInsertString(DCM_SeriesDate, "20200101");
+  dataset->putAndInsertString(DCM_SeriesTime, "090000");
+  dataset->putAndInsertString(DCM_AcquisitionDate, "20200101");
+  dataset->putAndInsertString(DCM_AcquisitionTime, "090000");
+  dataset->putAndInsertString(DCM_SeriesNumber, "1");
+  dataset->putAndInsertString(DCM_ImageType, "ORIGINAL\\PRIMARY");
+  dataset->putAndInsertString(DCM_Units, "BQML");
+  dataset->putAndInsertString(DCM_DecayCorrection, "START");
+  dataset->putAndInsertString(DCM_CorrectedImage, "DECY\\ATTN");
+  dataset->putAndInsertString(DCM_DecayFactor, "1");
+  dataset->putAndInsertString(DCM_FrameReferenceTime, "0");
+  dataset->putAndInsertString(DCM_ActualFrameDuration, "300000");
+
+  DcmItem* radiopharmaceutical = NULL;
+  dataset->findOrCreateSequenceItem(DCM_RadiopharmaceuticalInformationSequence, radiopharmaceutical);
+  radiopharmaceutical->putAndInsertString(DCM_RadiopharmaceuticalStartTime, "080000");
+  radiopharmaceutical->putAndInsertString(DCM_RadionuclideTotalDose, "370000000");
+  radiopharmaceutical->putAndInsertString(DCM_RadionuclideHalfLife, "6586.2");
+  radiopharmaceutical->putAndInsertString(DCM_RadionuclidePositronFraction, "0.97");
+
+  dataset->putAndInsertString(DCM_ImageOrientationPatient, "1\\0\\0\\0\\1\\0");
+  dataset->putAndInsertString(DCM_PixelSpacing, "4\\4");
+  dataset->putAndInsertString(DCM_SliceThickness, "3");
+  dataset->putAndInsertUint16(DCM_SamplesPerPixel, 1);
+  dataset->putAndInsertString(DCM_PhotometricInterpretation, "MONOCHROME2");
+  dataset->putAndInsertUint16(DCM_Rows, matrix);
+  dataset->putAndInsertUint16(DCM_Columns, matrix);
+  dataset->putAndInsertUint16(DCM_BitsAllocated, 16);
+  dataset->putAndInsertUint16(DCM_BitsStored, 16);
+  dataset->putAndInsertUint16(DCM_HighBit, 15);
+  dataset->putAndInsertUint16(DCM_PixelRepresentation, 0);
+  dataset->putAndInsertString(DCM_RescaleIntercept, "0");
+  dataset->putAndInsertString(DCM_RescaleSlope, "0.5");
+}
+
+// smooth activity pattern, so that the pixel data is not trivially compressible
+void FillSlice(Uint16* pixels, unsigned int matrix, unsigned int z)
+{
+  for (unsigned int y=0; y<matrix; y++)
+    {
+    for (unsigned int x=0; x<matrix; x++)
+      {
+      pixels[y*matrix+x] = static_cast<Uint16>((x*7 + y*13 + z*31) % 4096);
+      }
+    }
+}
+
+bool SynthesizeSeries(const benchmarkSettings & settings, const std::string & directory)
+{
+  char uid[100];
+  std::string studyUID = dcmGenerateUniqueIdentifier(uid, SITE_STUDY_UID_ROOT);
+  std::string seriesUID = dcmGenerateUniqueIdentifier(uid, SITE_SERIES_UID_ROOT);
+  std::string frameOfReferenceUID = dcmGenerateUniqueIdentifier(uid, SITE_INSTANCE_UID_ROOT);
+  const size_t sliceSize = settings.matrix*settings.matrix;
+
+  if (settings.layout == "multiframe")
+    {
+    DcmFileFormat fileFormat;
+    DcmDataset* dataset = fileFormat.getDataset();
+    PutPETModules(dataset, studyUID, seriesUID, frameOfReferenceUID, settings.matrix);
+    dataset->putAndInsertString(DCM_InstanceNumber, "1");
+    dataset->putAndInsertString(DCM_ImagePositionPatient, "0\\0\\0");
+    std::ostringstream numberOfFrames;
+    numberOfFrames << settings.slices;
+    dataset->putAndInsertString(DCM_NumberOfFrames, numberOfFrames.str().c_str());
+    std::vector<Uint16> pixels(sliceSize*settings.slices);
+    for (unsigned int z=0; z<settings.slices; z++)
+      {
+      FillSlice(&pixels[z*sliceSize], settings.matrix, z);
+      }
+    dataset->putAndInsertUint16Array(DCM_PixelData, &pixels[0], pixels.size());
+    std::string fileName = directory + "/frames.dcm";
+    return fileFormat.saveFile(fileName.c_str(), EXS_LittleEndianExplicit).good();
+    }
+
+  std::vector<Uint16> pixels(sliceSize);
+  for (unsigned int z=0; z<settings.slices; z++)
+    {
+    DcmFileFormat fileFormat;
+    DcmDataset* dataset = fileFormat.getDataset();
+    PutPETModules(dataset, studyUID, seriesUID, frameOfReferenceUID, settings.matrix);
+    std::ostringstream instanceNumber, position, fileName;
+    instanceNumber << z+1;
+    position << "0\\0\\" << z*3;
+    fileName << directory << "/slice" << z << ".dcm";
+    dataset->putAndInsertString(DCM_InstanceNumber, instanceNumber.str().c_str());
+    dataset->putAndInsertString(DCM_ImagePositionPatient, position.str().c_str());
+    FillSlice(&pixels[0], settings.matrix, z);
+    dataset->putAndInsertUint16Array(DCM_PixelData, &pixels[0], pixels.size());
+    if (fileFormat.saveFile(fileName.str().c_str(), EXS_LittleEndianExplicit).bad())
+      {
+      return false;
+      }
+    }
+  return true;
+}
+
+std::string Quote(const std::string & s)
+{
+  return "\"" + s + "\"";
+}
+
+bool ParseArguments(int argc, char * argv[], benchmarkSettings & settings)
+{
+  for (int i=1; i+1<argc; i+=2)
+    {
+    std::string option = argv[i];
+    std::string value = argv[i+1];
+    if (option == "--cli") settings.cli = value;
+    else if (option == "--workdir") settings.workDirectory = value;
+    else if (option == "--layout") settings.layout = value;
+    else if (option == "--slices") settings.slices = atoi(value.c_str());
+    else if (option == "--matrix") settings.matrix = atoi(value.c_str());
+    else if (option == "--output") settings.output = value;
+    else if (option == "--maxSeconds") settings.maxSeconds = atof(value.c_str());
+    else if (option == "--compressionLevel") settings.compressionLevel = atoi(value.c_str());
+    else if (option == "--compressionThreads") settings.compressionThreads = atoi(value.c_str());
+    else
+      {
+      std::cerr << "Unknown option " << option << std::endl;
+      return false;
+      }
+    }
+  return settings.cli != "" && settings.workDirectory != "" && settings.slices > 0 && settings.matrix > 0 &&
+         (settings.layout == "classic" || settings.layout == "multiframe");
+}
+
+} // end of anonymous namespace
+
+int main(int argc, char * argv[])
+{
+  benchmarkSettings settings;
+  if ((argc-1) % 2 != 0 || !ParseArguments(argc, argv, settings))
+    {
+    std::cerr << "Usage: " << argv[0] << " --cli <SUVFactorCalculator executable> --workdir <directory>"
+              << " [--layout classic|multiframe] [--slices N] [--matrix N] [--output file.json] [--maxSeconds S]"
+              << " [--compressionLevel 0-9] [--compressionThreads N]"
+              << std::endl;
+    return EXIT_FAILURE;
+    }
+
+  std::string dicomDirectory = settings.workDirectory + "/" + settings.layout + "/dicom";
+  std::string outputDirectory = settings.workDirectory + "/" + settings.layout + "/output";
+  itksys::SystemTools::RemoveADirectory(dicomDirectory);
+  itksys::SystemTools::MakeDirectory(dicomDirectory);
+  itksys::SystemTools::MakeDirectory(outputDirectory);
+
+  std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+  if (!SynthesizeSeries(settings, dicomDirectory))
+    {
+    std::cerr << "Cannot write the synthetic PET series to " << dicomDirectory << std::endl;
+    return EXIT_FAILURE;
+    }
+  double synthesisSeconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+
+  std::string timingsFileName = outputDirectory + "/cli-timings.json";
+  std::string volumeFileName = outputDirectory + "/SUVbw.nrrd";
+  itksys::SystemTools::RemoveFile(timingsFileName);
+  itksys::SystemTools::RemoveFile(volumeFileName);
+  std::string command = Quote(settings.cli) +
+    " --petDICOMPath " + Quote(dicomDirectory) +
+    " --rwvmDICOMPath " + Quote(outputDirectory) +
+    " --SUVbw " + Quote(volumeFileName) +
+    " --compressionLevel " + std::to_string(settings.compressionLevel) +
+    " --compressionThreads " + std::to_string(settings.compressionThreads) +
+    " --timingsFile " + Quote(timingsFileName);
+#ifdef _WIN32
+  command = "\"" + command + "\""; // cmd.exe strips the outer quotes
+#endif
+  std::cout << command << std::endl;
+  if (std::system(command.c_str()) != 0)
+    {
+    std::cerr << "SUVFactorCalculator failed" << std::endl;
+    return EXIT_FAILURE;
+    }
+
+  std::ifstream timingsFile(timingsFileName.c_str());
+  std::stringstream cliTimings;
+  cliTimings << timingsFile.rdbuf();
+  if (cliTimings.str().empty())
+    {
+    std::cerr << "SUVFactorCalculator did not write " << timingsFileName << std::endl;
+    return EXIT_FAILURE;
+    }
+
+  std::ostringstream report;
+  report << "{" << std::endl
+         << "\"layout\": \"" << settings.layout << "\"," << std::endl
+         << "\"slices\": " << settings.slices << "," << std::endl
+         << "\"matrix\": " << settings.matrix << "," << std::endl
+         << "\"compressionLevel\": " << settings.compressionLevel << "," << std::endl
+         << "\"compressionThreads\": " << settings.compressionThreads << "," << std::endl
+         << "\"volumeBytes\": " << itksys::SystemTools::FileLength(volumeFileName) << "," << std::endl
+         << "\"synthesisSeconds\": " << synthesisSeconds << "," << std::endl
+         << "\"cli\": " << cliTimings.str()
+         << "}" << std::endl;
+  std::cout << report.str();
+  if (settings.output != "")
+    {
+    std::ofstream output(settings.output.c_str());
+    output << report.str();
+    }
+
+  if (settings.maxSeconds > 0.0)
+    {
+    std::string text = cliTimings.str();
+    size_t position = text.find("\"totalSeconds\":");
+    double totalSeconds = position == std::string::npos ? 0.0 : atof(text.c_str() + position + 15);
+    if (totalSeconds > settings.maxSeconds)
+      {
+      std::cerr << "SUVFactorCalculator took " << totalSeconds << " s, more than the allowed "
+                << settings.maxSeconds << " s" << std::endl;
+      return EXIT_FAILURE;
+      }
+    }
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,94 @@
+// Compares the wall time of reading a classic PET series with
+// itk::ImageSeriesReader and with dcmSeriesReaderHelper at 1, 4 and 16 threads.
+//
+//   dcmSeriesReaderBenchmark <dicom directory> [series instance UID] [repetitions]
+
+#include "dcmSeriesDiscoveryHelper.h"
+#include "dcmSeriesReaderHelper.h"
+
+#include <itkImageSeriesReader.h>
+
+#include <chrono>
+#include <cstdlib>
+#include <cstring>
+#include <iostream>
+
+namespace
+{
+
+typedef itk::Image<float, 3> VolumeType;
+
+double elapsedSeconds(const std::chrono::steady_clock::time_point & start)
+{
+  return std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+}
+
+} // end of anonymous namespace
+
+int main(int argc, char * argv[])
+{
+  if (argc < 2)
+    {
+    std::cerr << "Usage: " << argv[0] << " <dicom directory> [series instance UID] [repetitions]" << std::endl;
+    return EXIT_FAILURE;
+    }
+  std::string seriesInstanceUID = argc > 2 ? argv[2] : "";
+  int repetitions = argc > 3 ? std::max(1, atoi(argv[3])) : 3;
+
+  std::string selectedSeriesUID;
+  std::vector<std::string> fileNames;
+  if (!dcmSeriesDiscoveryHelper::findSeriesFiles(argv[1], seriesInstanceUID, false, selectedSeriesUID, fileNames) ||
+      fileNames.empty())
+    {
+    std::cerr << "No series found in " << argv[1] << std::endl;
+    return EXIT_FAILURE;
+    }
+  std::cout << "Series " << selectedSeriesUID << ": " << fileNames.size() << " files" << std::endl;
+
+  try
+    {
+    // reference: the single threaded ITK series reader
+    VolumeType::Pointer reference;
+    double best = 0.0;
+    for (int r=0; r<repetitions; r++)
+      {
+      auto start = std::chrono::steady_clock::now();
+      auto reader = itk::ImageSeriesReader<VolumeType>::New();
+      reader->SetImageIO(itk::GDCMImageIO::New());
+      reader->SetFileNames(fileNames);
+      reader->Update();
+      double seconds = elapsedSeconds(start);
+      best = r == 0 ? seconds : std::min(best, seconds);
+      reference = reader->GetOutput();
+      }
+    std::cout << "ImageSeriesReader: " << best << " s" << std::endl;
+
+    const size_t numberOfPixels = reference->GetLargestPossibleRegion().GetNumberOfPixels();
+    const unsigned int threadCounts[] = {1, 4, 16};
+    for (unsigned int numberOfThreads : threadCounts)
+      {
+      VolumeType::Pointer volume;
+      for (int r=0; r<repetitions; r++)
+        {
+        auto start = std::chrono::steady_clock::now();
+        volume = dcmSeriesReaderHelper::readSlices<float>(fileNames, numberOfThreads);
+        double seconds = elapsedSeconds(start);
+        best = r == 0 ? seconds : std::min(best, seconds);
+        }
+      bool identical = volume->GetLargestPossibleRegion() == reference->GetLargestPossibleRegion() &&
+        std::memcmp(volume->GetBufferPointer(), reference->GetBufferPointer(), numberOfPixels*sizeof(float)) == 0;
+      std::cout << "dcmSeriesReaderHelper, " << numberOfThreads << " threads: " << best << " s"
+                << (identical ? "" : " (voxels differ from ImageSeriesReader!)") << std::endl;
+      if (!identical)
+        {
+        return EXIT_FAILURE;
+        }
+      }
+    }
+  catch (itk::ExceptionObject &ex)
+    {
+    std::cerr << ex << std::endl;
+    return EXIT_FAILURE;
+    }
+  return EXIT_SUCCESS;
+}
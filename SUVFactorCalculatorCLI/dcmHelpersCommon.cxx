@@ -211,6 +211,11 @@ void dcmHelpersCommon::copyClinicalTrialSubjectModule(DcmDataset *src, DcmDatase
     dcmHelpersCommon::copyElement(clinicalTrialSubjectModuleTags[i], src, dest);
 }
 
+void dcmHelpersCommon::copyFrameOfReferenceModule(DcmDataset *src, DcmDataset *dest){
+  for(unsigned int i=0;i<sizeof(frameOfReferenceModuleTags)/sizeof(DcmTagKey);i++)
+    dcmHelpersCommon::copyElement(frameOfReferenceModuleTags[i], src, dest);
+}
+
 /*
 void dcmHelpersCommon::findAndGetCodedValueFromSequenceItem(DcmItem *seq,
                                                             DSRCodedEntryValue &codedEntry){
@@ -0,0 +1,289 @@
+#include "dcmParametricMapHelper.h"
+#include "dcmHelpersCommon.h"
+
+#include "dcmtk/config/osconfig.h"
+#include "dcmtk/dcmdata/dctk.h"
+#include "dcmtk/dcmdata/dcvrof.h"
+#include "dcmtk/dcmsr/dsrcodvl.h"
+
+// versioning info
+#include "vtkSUVFactorCalculatorVersionConfigure.h"
+
+#include <algorithm>
+#include <cstdio>
+#include <iostream>
+#include <limits>
+
+const char* dcmParametricMapHelper::parametricMapStorageUID = "1.2.840.10008.5.1.4.1.1.30";
+
+bool dcmParametricMapHelper::write(DcmDataset* sourceDataset,
+                                   const float* voxels,
+                                   const Geometry& geometry,
+                                   double scale,
+                                   const std::vector<double>& frameScales,
+                                   const std::vector<std::string>& referencedInstanceUIDs,
+                                   const DSRCodedEntryValue& units,
+                                   const std::string& seriesDescription,
+                                   const std::string& seriesNumber,
+                                   const std::string& fileName,
+                                   std::string& sopInstanceUID)
+{
+  const size_t frameSize = static_cast<size_t>(geometry.columns) * geometry.rows;
+  const size_t numberOfFrames = static_cast<size_t>(geometry.slices) * geometry.timeFrames;
+  const size_t numberOfValues = frameSize * numberOfFrames;
+  if (numberOfValues == 0)
+    {
+    std::cerr << "Parametric map without voxels" << std::endl;
+    return false;
+    }
+  if (!frameScales.empty() && frameScales.size() != geometry.timeFrames)
+    {
+    std::cerr << "Parametric map needs one scale per time frame" << std::endl;
+    return false;
+    }
+  // Float Pixel Data has a 32 bit length
+  if (numberOfValues > (std::numeric_limits<Uint32>::max() - 1) / sizeof(Float32))
+    {
+    std::cerr << "Volume is too large for a parametric map" << std::endl;
+    return false;
+    }
+
+  DcmFileFormat fileFormat;
+  DcmDataset* dataset = fileFormat.getDataset();
+  dcmHelpersCommon::copyPatientModule(sourceDataset, dataset);
+  dcmHelpersCommon::copyClinicalTrialSubjectModule(sourceDataset, dataset);
+  dcmHelpersCommon::copyGeneralStudyModule(sourceDataset, dataset);
+  dcmHelpersCommon::copyPatientStudyModule(sourceDataset, dataset);
+  dcmHelpersCommon::copyFrameOfReferenceModule(sourceDataset, dataset);
+  dcmHelpersCommon::copyElement(DCM_Modality, sourceDataset, dataset);
+
+  char uid[128];
+  OFString contentDate, contentTime;
+  DcmDate::getCurrentDate(contentDate);
+  DcmTime::getCurrentTime(contentTime);
+
+  // General Series Module
+  dcmGenerateUniqueIdentifier(uid, SITE_SERIES_UID_ROOT);
+  dataset->putAndInsertString(DCM_SeriesInstanceUID, uid);
+  dataset->putAndInsertString(DCM_SeriesNumber, seriesNumber.c_str());
+  dataset->putAndInsertString(DCM_SeriesDescription, seriesDescription.c_str());
+  dataset->putAndInsertString(DCM_SeriesDate, contentDate.c_str());
+  dataset->putAndInsertString(DCM_SeriesTime, contentTime.c_str());
+
+  // Enhanced General Equipment Module
+  dataset->putAndInsertString(DCM_Manufacturer, "https://github.com/QIICR/Slicer-SUVFactorCalculator");
+  dataset->putAndInsertString(DCM_ManufacturerModelName, "SUVFactorCalculator");
+  dataset->putAndInsertString(DCM_DeviceSerialNumber, "1");
+  dataset->putAndInsertString(DCM_SoftwareVersions, SUVFactorCalculator_WC_REVISION);
+
+  // Parametric Map Image Module
+  dataset->putAndInsertString(DCM_ImageType, "DERIVED\\PRIMARY\\QUANTITY");
+  dataset->putAndInsertString(DCM_ContentQualification, "RESEARCH");
+  dataset->putAndInsertUint16(DCM_SamplesPerPixel, 1);
+  dataset->putAndInsertString(DCM_PhotometricInterpretation, "MONOCHROME2");
+  dataset->putAndInsertUint16(DCM_Rows, geometry.rows);
+  dataset->putAndInsertUint16(DCM_Columns, geometry.columns);
+  dataset->putAndInsertUint16(DCM_BitsAllocated, 32);
+  dataset->putAndInsertString(DCM_PresentationLUTShape, "IDENTITY");
+  dataset->putAndInsertString(DCM_LossyImageCompression, "00");
+  dataset->putAndInsertString(DCM_BurnedInAnnotation, "NO");
+  dataset->putAndInsertString(DCM_RecognizableVisualFeatures, "NO");
+  dataset->putAndInsertString(DCM_InstanceNumber, "1");
+  dataset->putAndInsertString(DCM_ContentLabel, "SUV");
+  dataset->putAndInsertString(DCM_ContentDescription, units.getCodeMeaning().c_str());
+  dataset->putAndInsertString(DCM_ContentCreatorName, "QIICR");
+  dataset->putAndInsertString(DCM_ContentDate, contentDate.c_str());
+  dataset->putAndInsertString(DCM_ContentTime, contentTime.c_str());
+
+  // Multi-frame Functional Groups Module
+  char numberOfFramesString[32];
+  sprintf(numberOfFramesString, "%lu", static_cast<unsigned long>(numberOfFrames));
+  dataset->putAndInsertString(DCM_NumberOfFrames, numberOfFramesString);
+  addDimensions(dataset, geometry);
+  addPerFrameFunctionalGroups(dataset, geometry);
+
+  // Common Instance Reference Module
+  OFString sourceSeriesInstanceUID;
+  sourceDataset->findAndGetOFString(DCM_SeriesInstanceUID, sourceSeriesInstanceUID);
+  DcmItem* referencedSeriesItem;
+  dataset->findOrCreateSequenceItem(DCM_ReferencedSeriesSequence, referencedSeriesItem);
+  referencedSeriesItem->putAndInsertString(DCM_SeriesInstanceUID, sourceSeriesInstanceUID.c_str());
+  for (const std::string& instanceUID : referencedInstanceUIDs)
+    {
+    DcmItem* referencedInstanceItem;
+    referencedSeriesItem->findOrCreateSequenceItem(DCM_ReferencedInstanceSequence, referencedInstanceItem, -2);
+    referencedInstanceItem->putAndInsertString(DCM_ReferencedSOPClassUID, UID_PositronEmissionTomographyImageStorage);
+    referencedInstanceItem->putAndInsertString(DCM_ReferencedSOPInstanceUID, instanceUID.c_str());
+    }
+
+  // SOP Common Module
+  dcmGenerateUniqueIdentifier(uid, SITE_INSTANCE_UID_ROOT);
+  sopInstanceUID = uid;
+  dataset->putAndInsertString(DCM_SOPClassUID, parametricMapStorageUID);
+  dataset->putAndInsertString(DCM_SOPInstanceUID, uid);
+
+  // scale the voxels straight into the pixel data element, frame by frame in buffer order
+  DcmOtherFloat* pixelData = new DcmOtherFloat(DcmTag(DCM_FloatPixelData, EVR_OF));
+  Float32* values = NULL;
+  if (pixelData->createFloat32Array(static_cast<Uint32>(numberOfValues), values).bad() || values == NULL)
+    {
+    delete pixelData;
+    std::cerr << "Cannot allocate the pixel data of the parametric map" << std::endl;
+    return false;
+    }
+  float minimum = std::numeric_limits<float>::max();
+  float maximum = std::numeric_limits<float>::lowest();
+  for (size_t frame=0; frame<numberOfFrames; frame++)
+    {
+    const float factor = static_cast<float>(scale * (frameScales.empty() ? 1.0 : frameScales[frame / geometry.slices]));
+    const float* frameVoxels = voxels + frame*frameSize;
+    Float32* frameValues = values + frame*frameSize;
+    for (size_t i=0; i<frameSize; i++)
+      {
+      frameValues[i] = frameVoxels[i] * factor;
+      minimum = std::min(minimum, frameValues[i]);
+      maximum = std::max(maximum, frameValues[i]);
+      }
+    }
+  dataset->insert(pixelData, OFTrue);
+
+  addSharedFunctionalGroups(dataset, geometry, units);
+  DcmItem* sharedItem;
+  DcmItem* mappingItem;
+  dataset->findOrCreateSequenceItem(DCM_SharedFunctionalGroupsSequence, sharedItem);
+  sharedItem->findOrCreateSequenceItem(DCM_RealWorldValueMappingSequence, mappingItem);
+  mappingItem->putAndInsertFloat64(DCM_DoubleFloatRealWorldValueFirstValueMapped, minimum);
+  mappingItem->putAndInsertFloat64(DCM_DoubleFloatRealWorldValueLastValueMapped, maximum);
+
+  std::cout << "saving parametric map to " << fileName << std::endl;
+  OFCondition cond = fileFormat.saveFile(fileName.c_str(), EXS_LittleEndianExplicit);
+  if (cond.bad())
+    {
+    std::cerr << "Failed to save the parametric map: " << cond.text() << std::endl;
+    return false;
+    }
+  return true;
+}
+
+void dcmParametricMapHelper::addSharedFunctionalGroups(DcmDataset* dataset, const Geometry& geometry,
+                                                       const DSRCodedEntryValue& units)
+{
+  DcmItem* sharedItem;
+  dataset->findOrCreateSequenceItem(DCM_SharedFunctionalGroupsSequence, sharedItem);
+
+  char value[256];
+  DcmItem* pixelMeasuresItem;
+  sharedItem->findOrCreateSequenceItem(DCM_PixelMeasuresSequence, pixelMeasuresItem);
+  sprintf(value, "%.6g\\%.6g", geometry.spacing[1], geometry.spacing[0]);
+  pixelMeasuresItem->putAndInsertString(DCM_PixelSpacing, value);
+  sprintf(value, "%.6g", geometry.spacing[2]);
+  pixelMeasuresItem->putAndInsertString(DCM_SliceThickness, value);
+  pixelMeasuresItem->putAndInsertString(DCM_SpacingBetweenSlices, value);
+
+  DcmItem* planeOrientationItem;
+  sharedItem->findOrCreateSequenceItem(DCM_PlaneOrientationSequence, planeOrientationItem);
+  sprintf(value, "%.6f\\%.6f\\%.6f\\%.6f\\%.6f\\%.6f",
+          geometry.rowDirection[0], geometry.rowDirection[1], geometry.rowDirection[2],
+          geometry.columnDirection[0], geometry.columnDirection[1], geometry.columnDirection[2]);
+  planeOrientationItem->putAndInsertString(DCM_ImageOrientationPatient, value);
+
+  DcmItem* frameAnatomyItem;
+  sharedItem->findOrCreateSequenceItem(DCM_FrameAnatomySequence, frameAnatomyItem);
+  frameAnatomyItem->putAndInsertString(DCM_FrameLaterality, "U");
+  insertCode(frameAnatomyItem, DCM_AnatomicRegionSequence, DSRCodedEntryValue("38266002", "SCT", "Entire body"));
+
+  DcmItem* frameTypeItem;
+  sharedItem->findOrCreateSequenceItem(DCM_ParametricMapFrameTypeSequence, frameTypeItem);
+  frameTypeItem->putAndInsertString(DCM_FrameType, "DERIVED\\PRIMARY\\QUANTITY\\NONE");
+
+  // the voxels are real world values already: identity mapping to the units
+  DcmItem* mappingItem;
+  sharedItem->findOrCreateSequenceItem(DCM_RealWorldValueMappingSequence, mappingItem);
+  mappingItem->putAndInsertString(DCM_LUTExplanation, units.getCodeMeaning().c_str());
+  mappingItem->putAndInsertString(DCM_LUTLabel, units.getCodeValue().c_str());
+  mappingItem->putAndInsertString(DCM_RealWorldValueIntercept, "0");
+  mappingItem->putAndInsertString(DCM_RealWorldValueSlope, "1");
+  insertCode(mappingItem, DCM_MeasurementUnitsCodeSequence, units);
+
+  DcmItem* quantityItem;
+  mappingItem->findOrCreateSequenceItem(DcmTag(0x0040,0x9220, EVR_SQ), quantityItem);
+  quantityItem->putAndInsertString(DCM_ValueType, "CODE");
+  insertCode(quantityItem, DCM_ConceptNameCodeSequence, DSRCodedEntryValue("G-C1C6", "SRT", "Quantity"));
+  insertCode(quantityItem, DCM_ConceptCodeSequence,
+             DSRCodedEntryValue("126400", "DCM", "Standardized Uptake Value"));
+}
+
+void dcmParametricMapHelper::addPerFrameFunctionalGroups(DcmDataset* dataset, const Geometry& geometry)
+{
+  // the slice positions are the same in every time frame
+  std::vector<std::string> positions;
+  for (unsigned int slice=0; slice<geometry.slices; slice++)
+    {
+    double position[3];
+    for (unsigned int i=0; i<3; i++)
+      {
+      position[i] = geometry.origin[i] + slice*geometry.spacing[2]*geometry.sliceDirection[i];
+      }
+    char value[128];
+    sprintf(value, "%.6f\\%.6f\\%.6f", position[0], position[1], position[2]);
+    positions.push_back(value);
+    }
+
+  const bool dynamic = geometry.timeFrames > 1;
+  for (unsigned int timeFrame=0; timeFrame<geometry.timeFrames; timeFrame++)
+    {
+    for (unsigned int slice=0; slice<geometry.slices; slice++)
+      {
+      DcmItem* frameItem;
+      DcmItem* planePositionItem;
+      DcmItem* frameContentItem;
+      dataset->findOrCreateSequenceItem(DCM_PerFrameFunctionalGroupsSequence, frameItem, -2);
+      frameItem->findOrCreateSequenceItem(DCM_PlanePositionSequence, planePositionItem);
+      planePositionItem->putAndInsertString(DCM_ImagePositionPatient, positions[slice].c_str());
+      frameItem->findOrCreateSequenceItem(DCM_FrameContentSequence, frameContentItem);
+      if (dynamic)
+        {
+        const Uint32 indexValues[2] = {timeFrame+1, slice+1};
+        frameContentItem->putAndInsertUint32Array(DCM_DimensionIndexValues, indexValues, 2);
+        frameContentItem->putAndInsertUint32(DCM_TemporalPositionIndex, timeFrame+1);
+        }
+      else
+        {
+        frameContentItem->putAndInsertUint32(DCM_DimensionIndexValues, slice+1);
+        }
+      }
+    }
+}
+
+void dcmParametricMapHelper::addDimensions(DcmDataset* dataset, const Geometry& geometry)
+{
+  char dimensionOrganizationUID[128];
+  dcmGenerateUniqueIdentifier(dimensionOrganizationUID);
+  DcmItem* organizationItem;
+  dataset->findOrCreateSequenceItem(DCM_DimensionOrganizationSequence, organizationItem);
+  organizationItem->putAndInsertString(DCM_DimensionOrganizationUID, dimensionOrganizationUID);
+
+  DcmItem* indexItem;
+  if (geometry.timeFrames > 1)
+    {
+    dataset->findOrCreateSequenceItem(DCM_DimensionIndexSequence, indexItem, -2);
+    indexItem->putAndInsertString(DCM_DimensionOrganizationUID, dimensionOrganizationUID);
+    indexItem->putAndInsertTagKey(DCM_DimensionIndexPointer, DCM_TemporalPositionIndex);
+    indexItem->putAndInsertTagKey(DCM_FunctionalGroupPointer, DCM_FrameContentSequence);
+    indexItem->putAndInsertString(DCM_DimensionDescriptionLabel, "Temporal Position Index");
+    }
+  dataset->findOrCreateSequenceItem(DCM_DimensionIndexSequence, indexItem, -2);
+  indexItem->putAndInsertString(DCM_DimensionOrganizationUID, dimensionOrganizationUID);
+  indexItem->putAndInsertTagKey(DCM_DimensionIndexPointer, DCM_ImagePositionPatient);
+  indexItem->putAndInsertTagKey(DCM_FunctionalGroupPointer, DCM_PlanePositionSequence);
+  indexItem->putAndInsertString(DCM_DimensionDescriptionLabel, "Image Position Patient");
+}
+
+void dcmParametricMapHelper::insertCode(DcmItem* item, const DcmTagKey& sequence, const DSRCodedEntryValue& code)
+{
+  DcmItem* codeItem;
+  item->findOrCreateSequenceItem(sequence, codeItem);
+  codeItem->putAndInsertString(DCM_CodeValue, code.getCodeValue().c_str());
+  codeItem->putAndInsertString(DCM_CodeMeaning, code.getCodeMeaning().c_str());
+  codeItem->putAndInsertString(DCM_CodingSchemeDesignator, code.getCodingSchemeDesignator().c_str());
+}
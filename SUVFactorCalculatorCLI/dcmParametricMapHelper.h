@@ -0,0 +1,61 @@
+#ifndef __dcmParametricMapHelper_h
+#define __dcmParametricMapHelper_h
+
+#include <string>
+#include <vector>
+
+class DcmItem;
+class DcmTagKey;
+class DcmDataset;
+class DSRCodedEntryValue;
+
+// Writes a volume of real world values (SUV) as a DICOM Parametric Map with
+// 32 bit float pixel data (Float Pixel Data), one frame per slice of every
+// time frame. Patient, study and frame of reference are copied from a source
+// PET dataset. The scaled voxels are written into the pixel data element of
+// the dataset in a single pass over the buffer, the per-frame functional
+// groups only hold the plane position and the dimension index of the frame.
+class dcmParametricMapHelper {
+  public:
+
+    // The voxels are stored column index fastest, then row, slice and time
+    // frame (the buffer layout of an ITK image). Directions and origin are in
+    // LPS patient coordinates.
+    struct Geometry {
+      unsigned int columns;
+      unsigned int rows;
+      unsigned int slices;
+      unsigned int timeFrames;
+      double origin[3];          // center of the first voxel
+      double rowDirection[3];    // direction of increasing column index
+      double columnDirection[3]; // direction of increasing row index
+      double sliceDirection[3];
+      double spacing[3];         // between columns, rows and slices (mm)
+    };
+
+    static const char* parametricMapStorageUID;
+
+    // Every voxel is multiplied with scale and, if given, the scale of its time
+    // frame (one per time frame). The SOP instance UID of the written object is
+    // returned in sopInstanceUID. Returns false if the file could not be written.
+    static bool write(DcmDataset* sourceDataset,
+                      const float* voxels,
+                      const Geometry& geometry,
+                      double scale,
+                      const std::vector<double>& frameScales,
+                      const std::vector<std::string>& referencedInstanceUIDs,
+                      const DSRCodedEntryValue& units,
+                      const std::string& seriesDescription,
+                      const std::string& seriesNumber,
+                      const std::string& fileName,
+                      std::string& sopInstanceUID);
+
+  protected:
+    static void addSharedFunctionalGroups(DcmDataset* dataset, const Geometry& geometry,
+                                          const DSRCodedEntryValue& units);
+    static void addPerFrameFunctionalGroups(DcmDataset* dataset, const Geometry& geometry);
+    static void addDimensions(DcmDataset* dataset, const Geometry& geometry);
+    static void insertCode(DcmItem* item, const DcmTagKey& sequence, const DSRCodedEntryValue& code);
+};
+
+#endif
@@ -0,0 +1,332 @@
+#include "dcmSeriesDiscoveryHelper.h"
+
+#include "dcmtk/config/osconfig.h"
+#include "dcmtk/dcmdata/dcfilefo.h"
+#include "dcmtk/dcmdata/dcdeftag.h"
+
+#include <itksys/Directory.hxx>
+#include <itksys/SystemTools.hxx>
+
+#include <algorithm>
+#include <fstream>
+#include <iostream>
+#include <set>
+#include <sstream>
+
+const char* dcmSeriesDiscoveryHelper::indexFileName = ".SUVFactorCalculatorSeriesIndex";
+
+namespace
+{
+// parse the whole text as one number, false if it is not one
+template <typename T>
+bool parseNumber(const std::string& text, T& value)
+{
+  std::istringstream stream(text);
+  stream >> value;
+  return !stream.fail() && (stream >> std::ws).eof();
+}
+
+// position, frame reference time and instance number separated by spaces
+bool parseSortKey(const std::string& text, dcmSeriesDiscoveryHelper::SortKey& key)
+{
+  std::istringstream stream(text);
+  stream >> key.position >> key.frameReferenceTime >> key.instanceNumber;
+  return !stream.fail() && (stream >> std::ws).eof();
+}
+
+dcmSeriesDiscoveryHelper::FileEntry makeEntry(const std::string& fileName, const std::string& fullPath)
+{
+  dcmSeriesDiscoveryHelper::FileEntry entry;
+  entry.fileName = fileName;
+  entry.fileSize = itksys::SystemTools::FileLength(fullPath);
+  entry.modifiedTime = itksys::SystemTools::ModifiedTime(fullPath);
+  entry.hasSortKey = false;
+  entry.sortKey = {0.0, 0.0, 0};
+  return entry;
+}
+}
+
+bool dcmSeriesDiscoveryHelper::findSeriesFiles(const std::string& directory,
+                                               const std::string& seriesInstanceUID,
+                                               bool useIndex,
+                                               std::string& selectedSeriesUID,
+                                               std::vector<std::string>& fileNames)
+{
+  fileNames.clear();
+  std::vector<FileEntry> entries;
+  const bool indexValid = useIndex && readIndex(directory, entries);
+  if (!indexValid && !scanDirectory(directory, entries))
+    {
+    return false;
+    }
+
+  selectedSeriesUID = seriesInstanceUID;
+  for (const FileEntry& entry : entries)
+    {
+    if (selectedSeriesUID.empty() && !entry.seriesInstanceUID.empty())
+      {
+      selectedSeriesUID = entry.seriesInstanceUID;
+      }
+    }
+  if (selectedSeriesUID.empty())
+    {
+    if (useIndex && !indexValid)
+      {
+      writeIndex(directory, entries);
+      }
+    std::cerr << "No DICOM series found in " << directory << std::endl;
+    return false;
+    }
+
+  std::vector<FileEntry*> seriesEntries;
+  for (FileEntry& entry : entries)
+    {
+    if (entry.seriesInstanceUID == selectedSeriesUID)
+      {
+      seriesEntries.push_back(&entry);
+      }
+    }
+  const bool sortKeysRead = sortSeriesEntries(directory, seriesEntries);
+  if (useIndex && (!indexValid || sortKeysRead))
+    {
+    writeIndex(directory, entries);
+    }
+  for (const FileEntry* entry : seriesEntries)
+    {
+    fileNames.push_back(itksys::SystemTools::CollapseFullPath(entry->fileName, directory));
+    }
+  return true;
+}
+
+bool dcmSeriesDiscoveryHelper::scanDirectory(const std::string& directory, std::vector<FileEntry>& entries)
+{
+  entries.clear();
+  for (const std::string& fileName : listFiles(directory))
+    {
+    if (isNonDICOMImageFile(fileName))
+      {
+      std::cerr << "PET Dicom parameter doesn't point to a dicom directory!" << std::endl;
+      return false;
+      }
+    std::string fullPath = itksys::SystemTools::CollapseFullPath(fileName, directory);
+    // files without series (not DICOM, DICOMDIR, unreadable) are indexed too,
+    // otherwise they would invalidate the index on every run
+    FileEntry entry = makeEntry(fileName, fullPath);
+
+    // Series Number directly follows the Series Instance UID, nothing after it is parsed
+    DcmFileFormat fileFormat;
+    OFString seriesInstanceUID, modality;
+    if (fileFormat.loadFileUntilTag(fullPath.c_str(), EXS_Unknown, EGL_noChange, DCM_MaxReadLength,
+                                    ERM_autoDetect, DCM_SeriesNumber).good() &&
+        fileFormat.getDataset()->findAndGetOFString(DCM_SeriesInstanceUID, seriesInstanceUID).good())
+      {
+      fileFormat.getDataset()->findAndGetOFString(DCM_Modality, modality);
+      entry.seriesInstanceUID = seriesInstanceUID.c_str();
+      entry.modality = modality.c_str();
+      }
+    entries.push_back(entry);
+    }
+  return true;
+}
+
+bool dcmSeriesDiscoveryHelper::readIndex(const std::string& directory, std::vector<FileEntry>& entries)
+{
+  entries.clear();
+  std::ifstream index(itksys::SystemTools::CollapseFullPath(indexFileName, directory).c_str());
+  if (!index)
+    {
+    return false;
+    }
+  std::string line;
+  while (std::getline(index, line))
+    {
+    if (line.empty() || line[0] == '#')
+      {
+      continue;
+      }
+    // series UID (empty for skipped files), modality, size, modification time,
+    // sort key (empty if not read yet), file name (may contain spaces)
+    std::istringstream fields(line);
+    FileEntry entry;
+    std::string fileSize, modifiedTime, sortKey;
+    if (!std::getline(fields, entry.seriesInstanceUID, '\t') ||
+        !std::getline(fields, entry.modality, '\t') ||
+        !std::getline(fields, fileSize, '\t') ||
+        !std::getline(fields, modifiedTime, '\t') ||
+        !std::getline(fields, sortKey, '\t') ||
+        !std::getline(fields, entry.fileName) ||
+        !parseNumber(fileSize, entry.fileSize) ||
+        !parseNumber(modifiedTime, entry.modifiedTime))
+      {
+      // an index of an older version or a damaged index is out of date
+      entries.clear();
+      return false;
+      }
+    entry.hasSortKey = !sortKey.empty();
+    entry.sortKey = {0.0, 0.0, 0};
+    if (entry.hasSortKey && !parseSortKey(sortKey, entry.sortKey))
+      {
+      entries.clear();
+      return false;
+      }
+    entries.push_back(entry);
+    }
+
+  // the index is only valid for exactly the same, unmodified files
+  std::vector<std::string> fileNames = listFiles(directory);
+  std::set<std::string> indexedFiles;
+  for (const FileEntry& entry : entries)
+    {
+    std::string fullPath = itksys::SystemTools::CollapseFullPath(entry.fileName, directory);
+    if (!itksys::SystemTools::FileExists(fullPath) ||
+        itksys::SystemTools::FileLength(fullPath) != entry.fileSize ||
+        itksys::SystemTools::ModifiedTime(fullPath) != entry.modifiedTime)
+      {
+      entries.clear();
+      return false;
+      }
+    indexedFiles.insert(entry.fileName);
+    }
+  for (const std::string& fileName : fileNames)
+    {
+    // every file of the directory is in the index, a missing one was added since
+    if (indexedFiles.find(fileName) == indexedFiles.end())
+      {
+      entries.clear();
+      return false;
+      }
+    }
+  return true;
+}
+
+bool dcmSeriesDiscoveryHelper::writeIndex(const std::string& directory, const std::vector<FileEntry>& entries)
+{
+  std::ofstream index(itksys::SystemTools::CollapseFullPath(indexFileName, directory).c_str());
+  if (!index)
+    {
+    std::cerr << "Cannot write series index in " << directory << std::endl;
+    return false;
+    }
+  index.precision(17);
+  index << "# SUVFactorCalculator series index 2" << std::endl;
+  for (const FileEntry& entry : entries)
+    {
+    index << entry.seriesInstanceUID << '\t' << entry.modality << '\t' << entry.fileSize << '\t'
+          << entry.modifiedTime << '\t';
+    if (entry.hasSortKey)
+      {
+      index << entry.sortKey.position << ' ' << entry.sortKey.frameReferenceTime << ' '
+            << entry.sortKey.instanceNumber;
+      }
+    index << '\t' << entry.fileName << std::endl;
+    }
+  return true;
+}
+
+bool dcmSeriesDiscoveryHelper::sortSeriesEntries(const std::string& directory,
+                                                 std::vector<FileEntry*>& seriesEntries)
+{
+  bool sortKeysRead = false;
+  for (FileEntry* entry : seriesEntries)
+    {
+    if (!entry->hasSortKey)
+      {
+      entry->sortKey = readSortKey(itksys::SystemTools::CollapseFullPath(entry->fileName, directory));
+      entry->hasSortKey = true;
+      sortKeysRead = true;
+      }
+    }
+
+  std::stable_sort(seriesEntries.begin(), seriesEntries.end(),
+    [](const FileEntry* a, const FileEntry* b)
+      {
+      const SortKey& ka = a->sortKey;
+      const SortKey& kb = b->sortKey;
+      if (ka.position != kb.position)
+        {
+        return ka.position < kb.position;
+        }
+      if (ka.frameReferenceTime != kb.frameReferenceTime)
+        {
+        return ka.frameReferenceTime < kb.frameReferenceTime;
+        }
+      return ka.instanceNumber < kb.instanceNumber;
+      });
+  return sortKeysRead;
+}
+
+dcmSeriesDiscoveryHelper::SortKey dcmSeriesDiscoveryHelper::readSortKey(const std::string& fullPath)
+{
+  // the position is projected on the slice normal of the file itself,
+  // all files of a series share the orientation
+  SortKey key = {0.0, 0.0, 0};
+  DcmFileFormat fileFormat;
+  if (fileFormat.loadFileUntilTag(fullPath.c_str(), EXS_Unknown, EGL_noChange, DCM_MaxReadLength,
+                                  ERM_autoDetect, DCM_PixelData).bad())
+    {
+    return key;
+    }
+  DcmDataset* dataset = fileFormat.getDataset();
+  double normal[3] = {0.0, 0.0, 1.0};
+  Float64 orientation[6];
+  bool orientationFound = true;
+  for (unsigned long i=0; i<6; i++)
+    {
+    orientationFound &= dataset->findAndGetFloat64(DCM_ImageOrientationPatient, orientation[i], i).good();
+    }
+  if (orientationFound)
+    {
+    normal[0] = orientation[1]*orientation[5] - orientation[2]*orientation[4];
+    normal[1] = orientation[2]*orientation[3] - orientation[0]*orientation[5];
+    normal[2] = orientation[0]*orientation[4] - orientation[1]*orientation[3];
+    }
+  for (unsigned long i=0; i<3; i++)
+    {
+    Float64 position = 0.0;
+    dataset->findAndGetFloat64(DCM_ImagePositionPatient, position, i);
+    key.position += normal[i]*position;
+    }
+  Float64 frameReferenceTime = 0.0;
+  dataset->findAndGetFloat64(DCM_FrameReferenceTime, frameReferenceTime);
+  key.frameReferenceTime = frameReferenceTime;
+  Sint32 instanceNumber = 0;
+  dataset->findAndGetSint32(DCM_InstanceNumber, instanceNumber);
+  key.instanceNumber = instanceNumber;
+  return key;
+}
+
+bool dcmSeriesDiscoveryHelper::isNonDICOMImageFile(const std::string& fileName)
+{
+  static const char* extensions[] = {".nhdr", ".nrrd", ".hdr", ".mha", ".img", ".nii", ".nia"};
+  std::string extension = itksys::SystemTools::LowerCase(itksys::SystemTools::GetFilenameLastExtension(fileName));
+  for (const char* nonDICOMExtension : extensions)
+    {
+    if (extension == nonDICOMExtension)
+      {
+      return true;
+      }
+    }
+  return false;
+}
+
+std::vector<std::string> dcmSeriesDiscoveryHelper::listFiles(const std::string& directory)
+{
+  std::vector<std::string> fileNames;
+  itksys::Directory dir;
+  if (!dir.Load(directory))
+    {
+    return fileNames;
+    }
+  for (unsigned long i=0; i<dir.GetNumberOfFiles(); i++)
+    {
+    std::string fileName = dir.GetFile(i);
+    std::string fullPath = itksys::SystemTools::CollapseFullPath(fileName, directory);
+    if (fileName == indexFileName || itksys::SystemTools::FileIsDirectory(fullPath))
+      {
+      continue;
+      }
+    fileNames.push_back(fileName);
+    }
+  std::sort(fileNames.begin(), fileNames.end());
+  return fileNames;
+}
@@ -0,0 +1,67 @@
+#ifndef __dcmSeriesDiscoveryHelper_h
+#define __dcmSeriesDiscoveryHelper_h
+
+#include <string>
+#include <vector>
+
+// Finds the files of a DICOM series in a directory without parsing every file
+// completely: each file is only read up to the Series Instance UID, and only
+// the files of the requested series are read further (up to the pixel data)
+// to sort them geometrically. The result of the first pass can be kept in a
+// small index file in the directory, so that repeated runs skip the scan as
+// long as no file was added, removed or modified. The index also keeps the
+// files that are not part of any series and the sort keys of the series that
+// were sorted, so that repeated runs read no header at all.
+class dcmSeriesDiscoveryHelper {
+  public:
+
+    struct SortKey {
+      double position;
+      double frameReferenceTime;
+      long instanceNumber;
+    };
+
+    struct FileEntry {
+      std::string fileName;
+      // empty for files that were skipped (not DICOM, DICOMDIR, unreadable)
+      std::string seriesInstanceUID;
+      std::string modality;
+      unsigned long long fileSize;
+      long long modifiedTime;
+      // only read for the files of a selected series
+      bool hasSortKey;
+      SortKey sortKey;
+    };
+
+    static const char* indexFileName;
+
+    // Returns false if the directory contains non-DICOM image files (nrrd, nifti, ...)
+    // or no DICOM series. If seriesInstanceUID is empty, the first series found is
+    // selected. selectedSeriesUID is set to the selected series and fileNames to its
+    // geometrically sorted files (empty if the series is not found).
+    static bool findSeriesFiles(const std::string& directory,
+                                const std::string& seriesInstanceUID,
+                                bool useIndex,
+                                std::string& selectedSeriesUID,
+                                std::vector<std::string>& fileNames);
+
+    // Header prefix scan of all files of the directory
+    static bool scanDirectory(const std::string& directory, std::vector<FileEntry>& entries);
+
+    // Read the index of a directory, false if there is none, it cannot be parsed
+    // or it is out of date
+    static bool readIndex(const std::string& directory, std::vector<FileEntry>& entries);
+    static bool writeIndex(const std::string& directory, const std::vector<FileEntry>& entries);
+
+    // Sort the entries of one series along the slice normal, then by frame reference time
+    // and instance number (time frames of dynamic series). Sort keys that are not known
+    // yet are read from the files; returns true if any was read.
+    static bool sortSeriesEntries(const std::string& directory, std::vector<FileEntry*>& seriesEntries);
+
+  protected:
+    static SortKey readSortKey(const std::string& fullPath);
+    static bool isNonDICOMImageFile(const std::string& fileName);
+    static std::vector<std::string> listFiles(const std::string& directory);
+};
+
+#endif
@@ -0,0 +1,174 @@
+#ifndef __dcmSeriesReaderHelper_h
+#define __dcmSeriesReaderHelper_h
+
+#include <itkImage.h>
+#include <itkImageFileReader.h>
+#include "itkGDCMImageIO.h"
+
+#include <algorithm>
+#include <atomic>
+#include <cmath>
+#include <cstring>
+#include <functional>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <vector>
+
+// Reads a classic (one slice per file) DICOM series on several threads.
+// The files must already be sorted (see dcmSeriesDiscoveryHelper): every
+// worker takes the next file, decodes it with its own GDCMImageIO and copies
+// the slice into its z-slot of the preallocated output volume. The geometry
+// is the one itk::ImageSeriesReader would produce, the origin of the first
+// file and the spacing and direction between the first and the last file.
+// Progress is reported from the calling thread only, as the fraction of the
+// slices read so far; the reading stops when the callback returns false.
+class dcmSeriesReaderHelper {
+  public:
+
+    // 0 means one thread per hardware core
+    static unsigned int resolveNumberOfThreads(unsigned int numberOfThreads, size_t numberOfFiles)
+      {
+      if (numberOfThreads == 0)
+        {
+        numberOfThreads = std::max(1u, std::thread::hardware_concurrency());
+        }
+      return static_cast<unsigned int>(std::max<size_t>(1, std::min<size_t>(numberOfThreads, numberOfFiles)));
+      }
+
+    typedef std::function<bool(double)> ProgressCallback;
+
+    // Throws an itk::ExceptionObject if a file cannot be read or does not match the
+    // first slice, or if the progress callback cancelled the reading
+    template <typename TPixel>
+    static typename itk::Image<TPixel, 3>::Pointer readSlices(const std::vector<std::string>& fileNames,
+                                                              unsigned int numberOfThreads,
+                                                              const ProgressCallback& progress = ProgressCallback())
+      {
+      typedef itk::Image<TPixel, 3> VolumeType;
+      typedef itk::ImageFileReader<VolumeType> SliceReaderType;
+
+      if (fileNames.empty())
+        {
+        itkGenericExceptionMacro("No files to read");
+        }
+
+      // geometry from the first and the last slice
+      typename SliceReaderType::Pointer firstReader = SliceReaderType::New();
+      firstReader->SetImageIO(itk::GDCMImageIO::New());
+      firstReader->SetFileName(fileNames.front());
+      firstReader->Update();
+      typename VolumeType::Pointer firstSlice = firstReader->GetOutput();
+
+      typename VolumeType::SizeType size = firstSlice->GetLargestPossibleRegion().GetSize();
+      typename VolumeType::SpacingType spacing = firstSlice->GetSpacing();
+      typename VolumeType::DirectionType direction = firstSlice->GetDirection();
+      typename VolumeType::PointType origin = firstSlice->GetOrigin();
+      if (size[2] != 1)
+        {
+        itkGenericExceptionMacro(<< fileNames.front() << " is not a single slice");
+        }
+      size[2] = fileNames.size();
+
+      if (fileNames.size() > 1)
+        {
+        itk::GDCMImageIO::Pointer lastIO = itk::GDCMImageIO::New();
+        lastIO->SetFileName(fileNames.back());
+        lastIO->ReadImageInformation();
+        double distance = 0.0;
+        double step[3];
+        for (unsigned int i=0; i<3; i++)
+          {
+          step[i] = lastIO->GetOrigin(i) - origin[i];
+          distance += step[i]*step[i];
+          }
+        distance = std::sqrt(distance);
+        if (distance > 0.0)
+          {
+          spacing[2] = distance / (fileNames.size()-1);
+          for (unsigned int i=0; i<3; i++)
+            {
+            direction[i][2] = step[i] / distance;
+            }
+          }
+        }
+
+      typename VolumeType::Pointer volume = VolumeType::New();
+      typename VolumeType::RegionType region;
+      region.SetSize(size);
+      volume->SetRegions(region);
+      volume->SetSpacing(spacing);
+      volume->SetOrigin(origin);
+      volume->SetDirection(direction);
+      volume->Allocate();
+
+      const size_t sliceSize = size[0]*size[1];
+      std::memcpy(volume->GetBufferPointer(), firstSlice->GetBufferPointer(), sliceSize*sizeof(TPixel));
+      firstReader = nullptr;
+      firstSlice = nullptr;
+
+      std::atomic<size_t> nextSlice(1);
+      std::atomic<size_t> slicesRead(1);
+      std::atomic<bool> failed(false);
+      std::string errorMessage;
+      std::mutex errorMutex;
+      auto fail = [&](const std::string& message)
+        {
+        std::lock_guard<std::mutex> lock(errorMutex);
+        if (!failed)
+          {
+          errorMessage = message;
+          failed = true;
+          }
+        };
+
+      auto readWorker = [&](bool reportProgress)
+        {
+        typename SliceReaderType::Pointer reader = SliceReaderType::New();
+        reader->SetImageIO(itk::GDCMImageIO::New());
+        for (size_t z = nextSlice++; z < fileNames.size() && !failed; z = nextSlice++)
+          {
+          try
+            {
+            reader->SetFileName(fileNames[z]);
+            reader->Update();
+            const typename VolumeType::SizeType & sliceSizeRead = reader->GetOutput()->GetLargestPossibleRegion().GetSize();
+            if (sliceSizeRead[0] != size[0] || sliceSizeRead[1] != size[1] || sliceSizeRead[2] != 1)
+              {
+              itkGenericExceptionMacro(<< fileNames[z] << " does not match the size of the first slice");
+              }
+            std::memcpy(volume->GetBufferPointer() + z*sliceSize, reader->GetOutput()->GetBufferPointer(),
+                        sliceSize*sizeof(TPixel));
+            }
+          catch (itk::ExceptionObject &ex)
+            {
+            fail(ex.GetDescription());
+            }
+          const size_t done = ++slicesRead;
+          if (reportProgress && progress && !progress(static_cast<double>(done) / fileNames.size()))
+            {
+            fail("Reading of the series was cancelled");
+            }
+          }
+        };
+
+      numberOfThreads = resolveNumberOfThreads(numberOfThreads, fileNames.size()-1);
+      std::vector<std::thread> workers;
+      for (unsigned int i=1; i<numberOfThreads; i++)
+        {
+        workers.push_back(std::thread(readWorker, false));
+        }
+      readWorker(true);
+      for (std::thread & worker : workers)
+        {
+        worker.join();
+        }
+      if (failed)
+        {
+        itkGenericExceptionMacro(<< errorMessage);
+        }
+      return volume;
+      }
+};
+
+#endif
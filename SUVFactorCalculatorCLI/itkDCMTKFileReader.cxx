@@ -299,6 +299,40 @@ DCMTKFileReader
   this->m_FileNumber = fnum;
 }
 
+void
+DCMTKFileReader
+::LoadFileHeader()
+{
+  if(this->m_FileName == "")
+    {
+    itkGenericExceptionMacro(<< "No filename given" );
+    }
+  if(this->m_DFile != 0)
+    {
+    delete this->m_DFile;
+    }
+  this->m_DFile = new DcmFileFormat();
+  OFCondition cond = this->m_DFile->loadFileUntilTag(this->m_FileName.c_str(),
+                                                     EXS_Unknown,
+                                                     EGL_noChange,
+                                                     DCM_MaxReadLength,
+                                                     ERM_autoDetect,
+                                                     DCM_PixelData);
+  if(cond != EC_Normal)
+    {
+    itkGenericExceptionMacro(<< cond.text() << ": reading file " << this->m_FileName);
+    }
+  this->m_Dataset = this->m_DFile->getDataset();
+  this->m_Xfer = this->m_Dataset->getOriginalXfer();
+  if(this->m_Dataset->findAndGetSint32(DCM_NumberOfFrames,this->m_FrameCount).bad())
+    {
+    this->m_FrameCount = 1;
+    }
+  int fnum;
+  this->GetElementIS(0x0020,0x0013,fnum);
+  this->m_FileNumber = fnum;
+}
+
 int
 DCMTKFileReader
 ::GetElementLO(unsigned short group,
@@ -153,6 +153,9 @@ public:
 
   void LoadFile();
 
+  /** Load all elements up to, but excluding, the pixel data */
+  void LoadFileHeader();
+
   int GetElementLO(unsigned short group,
                    unsigned short element,
                    std::string &target,
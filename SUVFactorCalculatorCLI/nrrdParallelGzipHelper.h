@@ -0,0 +1,232 @@
+#ifndef __nrrdParallelGzipHelper_h
+#define __nrrdParallelGzipHelper_h
+
+#include <itkImage.h>
+#include <itkByteSwapper.h>
+#include <itk_zlib.h>
+
+#include <algorithm>
+#include <atomic>
+#include <cstring>
+#include <cstdint>
+#include <fstream>
+#include <functional>
+#include <mutex>
+#include <sstream>
+#include <string>
+#include <thread>
+#include <type_traits>
+#include <vector>
+
+// Writes an image as a gzip compressed NRRD file, compressing blocks of the
+// voxel buffer on several threads. Every block is an independent gzip member
+// and the members are concatenated in order, which zlib and the NRRD reader
+// of ITK and Slicer decompress as one stream (as they do for the output of
+// pigz or of cat a.gz b.gz). The header holds the same fields the NRRD writer
+// of ITK writes for an image without metadata dictionary entries.
+// Progress is reported from the calling thread only, as the fraction of the
+// blocks compressed so far; the writing stops when the callback returns false.
+class nrrdParallelGzipHelper {
+  public:
+
+    typedef std::function<bool(double)> ProgressCallback;
+
+    // uncompressed bytes per gzip member, small enough to keep all threads busy
+    // on a single volume, large enough for the ratio of a single stream
+    static const size_t defaultBlockSize = 4 << 20;
+
+    // 0 means one thread per hardware core
+    static unsigned int resolveNumberOfThreads(unsigned int numberOfThreads, size_t numberOfBlocks)
+      {
+      if (numberOfThreads == 0)
+        {
+        numberOfThreads = std::max(1u, std::thread::hardware_concurrency());
+        }
+      return static_cast<unsigned int>(std::max<size_t>(1, std::min<size_t>(numberOfThreads, numberOfBlocks)));
+      }
+
+    // Compresses data into one gzip member per block of blockSize bytes.
+    // Returns false and the zlib or cancellation message in errorMessage on failure.
+    static bool compress(const char* data, size_t size, int level, unsigned int numberOfThreads, size_t blockSize,
+                         std::vector<std::string>& members, std::string& errorMessage,
+                         const ProgressCallback& progress = ProgressCallback())
+      {
+      const size_t numberOfBlocks = std::max<size_t>(1, (size + blockSize - 1) / blockSize);
+      members.assign(numberOfBlocks, std::string());
+
+      std::atomic<size_t> nextBlock(0);
+      std::atomic<size_t> blocksCompressed(0);
+      std::atomic<bool> failed(false);
+      std::mutex errorMutex;
+      auto fail = [&](const std::string& message)
+        {
+        std::lock_guard<std::mutex> lock(errorMutex);
+        if (!failed)
+          {
+          errorMessage = message;
+          failed = true;
+          }
+        };
+
+      auto compressWorker = [&](bool reportProgress)
+        {
+        for (size_t block = nextBlock++; block < numberOfBlocks && !failed; block = nextBlock++)
+          {
+          const size_t offset = block * blockSize;
+          const size_t length = std::min(blockSize, size - std::min(size, offset));
+          if (!compressBlock(data + offset, length, level, members[block]))
+            {
+            fail("Failed to compress block " + std::to_string(block));
+            }
+          const size_t done = ++blocksCompressed;
+          if (reportProgress && progress && !progress(static_cast<double>(done) / numberOfBlocks))
+            {
+            fail("Compression was cancelled");
+            }
+          }
+        };
+
+      numberOfThreads = resolveNumberOfThreads(numberOfThreads, numberOfBlocks);
+      std::vector<std::thread> workers;
+      for (unsigned int i=1; i<numberOfThreads; i++)
+        {
+        workers.push_back(std::thread(compressWorker, false));
+        }
+      compressWorker(true);
+      for (std::thread & worker : workers)
+        {
+        worker.join();
+        }
+      return !failed;
+      }
+
+    // Throws an itk::ExceptionObject if the file cannot be written or the
+    // progress callback cancelled the compression
+    template <typename TImage>
+    static void write(const TImage* image, const std::string& fileName, int level, unsigned int numberOfThreads,
+                      const ProgressCallback& progress = ProgressCallback(), size_t blockSize = defaultBlockSize)
+      {
+      typedef typename TImage::PixelType PixelType;
+      const size_t size = image->GetLargestPossibleRegion().GetNumberOfPixels() * sizeof(PixelType);
+
+      std::vector<std::string> members;
+      std::string errorMessage;
+      if (!compress(reinterpret_cast<const char*>(image->GetBufferPointer()), size, level, numberOfThreads,
+                    blockSize, members, errorMessage, progress))
+        {
+        itkGenericExceptionMacro(<< fileName << ": " << errorMessage);
+        }
+
+      std::ofstream file(fileName.c_str(), std::ios::out | std::ios::binary);
+      if (!file)
+        {
+        itkGenericExceptionMacro(<< "Cannot open " << fileName << " for writing");
+        }
+      file << header(image, nrrdType<PixelType>());
+      for (const std::string & member : members)
+        {
+        file.write(member.data(), member.size());
+        }
+      file.close();
+      if (!file)
+        {
+        itkGenericExceptionMacro(<< "Failed to write " << fileName);
+        }
+      }
+
+  protected:
+
+    static bool compressBlock(const char* data, size_t length, int level, std::string& member)
+      {
+      z_stream stream;
+      std::memset(&stream, 0, sizeof(stream));
+      // 16 + 15: gzip wrapper around a deflate stream with a 32k window
+      if (deflateInit2(&stream, level, Z_DEFLATED, 16 + 15, 8, Z_DEFAULT_STRATEGY) != Z_OK)
+        {
+        return false;
+        }
+      member.resize(deflateBound(&stream, static_cast<uLong>(length)));
+      stream.next_in = reinterpret_cast<Bytef*>(const_cast<char*>(data));
+      stream.avail_in = static_cast<uInt>(length);
+      stream.next_out = reinterpret_cast<Bytef*>(&member[0]);
+      stream.avail_out = static_cast<uInt>(member.size());
+      const int status = deflate(&stream, Z_FINISH);
+      member.resize(stream.total_out);
+      deflateEnd(&stream);
+      return status == Z_STREAM_END;
+      }
+
+    template <typename TPixel>
+    static std::string nrrdType()
+      {
+      if (std::is_same<TPixel, float>::value) return "float";
+      if (std::is_same<TPixel, double>::value) return "double";
+      if (std::is_same<TPixel, int16_t>::value) return "short";
+      if (std::is_same<TPixel, uint16_t>::value) return "unsigned short";
+      if (std::is_same<TPixel, int32_t>::value) return "int";
+      if (std::is_same<TPixel, uint32_t>::value) return "unsigned int";
+      if (std::is_same<TPixel, int8_t>::value) return "signed char";
+      if (std::is_same<TPixel, uint8_t>::value) return "unsigned char";
+      itkGenericExceptionMacro(<< "Unsupported pixel type for NRRD");
+      }
+
+    template <typename TImage>
+    static std::string header(const TImage* image, const std::string& type)
+      {
+      const unsigned int dimension = TImage::ImageDimension;
+      const typename TImage::SizeType & size = image->GetLargestPossibleRegion().GetSize();
+      const typename TImage::SpacingType & spacing = image->GetSpacing();
+      const typename TImage::DirectionType & direction = image->GetDirection();
+      const typename TImage::PointType & origin = image->GetOrigin();
+
+      auto vector = [dimension](std::ostringstream & stream, std::function<double(unsigned int)> component)
+        {
+        stream << "(";
+        for (unsigned int i=0; i<dimension; i++)
+          {
+          stream << (i ? "," : "") << component(i);
+          }
+        stream << ")";
+        };
+
+      std::ostringstream stream;
+      stream.precision(17);
+      stream << "NRRD0004\n"
+             << "# Complete NRRD file format specification at:\n"
+             << "# http://teem.sourceforge.net/nrrd/format.html\n"
+             << "type: " << type << "\n"
+             << "dimension: " << dimension << "\n";
+      if (dimension == 3)
+        {
+        stream << "space: left-posterior-superior\n";
+        }
+      else
+        {
+        stream << "space dimension: " << dimension << "\n";
+        }
+      stream << "sizes:";
+      for (unsigned int axis=0; axis<dimension; axis++)
+        {
+        stream << " " << size[axis];
+        }
+      stream << "\nspace directions:";
+      for (unsigned int axis=0; axis<dimension; axis++)
+        {
+        stream << " ";
+        vector(stream, [&](unsigned int i) { return direction[i][axis] * spacing[axis]; });
+        }
+      stream << "\nkinds:";
+      for (unsigned int axis=0; axis<dimension; axis++)
+        {
+        stream << " domain";
+        }
+      stream << "\nendian: " << (itk::ByteSwapper<int>::SystemIsLittleEndian() ? "little" : "big") << "\n"
+             << "encoding: gzip\n"
+             << "space origin: ";
+      vector(stream, [&](unsigned int i) { return origin[i]; });
+      stream << "\n\n";
+      return stream.str();
+      }
+};
+
+#endif
@@ -94,10 +94,755 @@ class PETDicomExtensionSelfTestTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
+    self.test_RealWorldValueMapping()
+    self.test_SUVQuantification()
+    self.test_TimeActivityCurves()
+    self.test_ParametricImaging()
+    self.test_ProgressiveFrameLoader()
+    self.test_RWVMRegistry()
+    self.test_CohortSUVFactors()
+    self.test_MixedDimensionExamine()
+    self.test_ExamineInProcesses()
+    self.test_ParametricMapExport()
+    self.test_SUVResampling()
+    self.test_SUVDisplayRange()
+    self.test_StoredVoxels()
+    self.test_SeriesPreview()
+    self.test_SUVMemoryBudget()
+    self.test_BedPositions()
+    self.test_LoadBedPositions()
+    self.test_PairedCT()
     self.test_SUVFactorCalculatorCLI()
+    self.test_DynamicSeriesWithoutDecayCorrection()
     self.test_PETDicomExtensionSelfTest_Main()
     self.tearDown()
 
+  def test_RealWorldValueMapping(self):
+    """ test slope, piecewise linear and LUT based Real World Value Mapping
+    """
+    self.delayDisplay('Testing Real World Value Mapping')
+    import numpy as np
+    import DICOMRWVMPlugin
+    rwvPlugin = slicer.modules.dicomPlugins['DICOMRWVMPlugin']()
+    MappingItem = DICOMRWVMPlugin.RealWorldValueMappingItem
+    voxels = np.array([[-5, 0, 1], [2, 10, 20]], dtype=np.int16)
+
+    mapped = rwvPlugin.applyRealWorldValueMapping(voxels, [MappingItem(0, 20, slope=0.5)])
+    self.assertEqual(mapped.dtype, np.float32)
+    np.testing.assert_allclose(mapped, voxels*0.5)
+
+    mapped = rwvPlugin.applyRealWorldValueMapping(voxels,
+      [MappingItem(0, 9, slope=1.0), MappingItem(10, 20, slope=2.0, intercept=1.0)])
+    np.testing.assert_allclose(mapped, [[0, 0, 1], [2, 21, 41]])
+
+    mapped = rwvPlugin.applyRealWorldValueMapping(voxels,
+      [MappingItem(0, 2, lutData=np.array([7.0, 8.0, 9.0])), MappingItem(10, 20, slope=2.0)])
+    np.testing.assert_allclose(mapped, [[0, 7, 8], [9, 20, 40]])
+
+    # a LUT maps the stored pixels, a linear mapping the rescaled values plus its intercept
+    from DICOMLib import DICOMLoadable
+    ds = pydicom.dataset.Dataset()
+    ds.RescaleSlope = '4'
+    ds.RescaleIntercept = '0'
+    loadable = DICOMLoadable()
+    loadable.mappings = [MappingItem(0, 2, lutData=np.array([7.0, 8.0, 9.0]))]
+    mapped = np.empty((1, 3), dtype=np.float32)
+    rwvPlugin.mapSlice(np.array([[0, 1, 2]], dtype=np.uint16), ds, loadable, None, mapped)
+    np.testing.assert_allclose(mapped, [[7, 8, 9]])
+    loadable.mappings = [MappingItem(0, 2, slope=0.5, intercept=1.0)]
+    loadable.intercept = 1.0
+    rwvPlugin.mapSlice(np.array([[0, 1, 2]], dtype=np.uint16), ds, loadable, 0.5, mapped)
+    np.testing.assert_allclose(mapped, [[1, 3, 5]])
+
+    self.delayDisplay('Test passed!')
+
+  def test_SUVQuantification(self):
+    """ test SUVmax, SUVpeak, SUVmean and TLG on synthetic anisotropic volumes
+    """
+    self.delayDisplay('Testing SUV quantification')
+    import numpy as np
+    import DICOMRWVMPlugin
+    quantification = DICOMRWVMPlugin.SUVQuantification()
+    spacing = (3.0, 2.0, 2.0)
+
+    # volume of the sphere kernel is 1 ml
+    kernel = quantification.sphereKernel(spacing)
+    self.assertAlmostEqual(kernel.sum()*np.prod(spacing), 1000.0, delta=5.0)
+
+    # uniform volume: peak equals the value, also at the border
+    uniform = np.full((20, 30, 30), 2.5, dtype=np.float32)
+    metrics = quantification.quantifyArray(uniform, spacing)
+    self.assertAlmostEqual(metrics['SUVpeak'], 2.5, places=5)
+    self.assertAlmostEqual(metrics['volume'], uniform.size*12.0/1000.0)
+
+    # hot spot inside a thresholded region
+    suv = np.ones((20, 30, 30), dtype=np.float32)
+    suv[5:15, 10:20, 10:20] = 5.0
+    suv[10, 15, 15] = 9.0
+    metrics = quantification.quantifyArray(suv, spacing, threshold=2.0)
+    self.assertEqual(metrics['voxelCount'], 1000)
+    self.assertEqual(metrics['SUVmax'], 9.0)
+    self.assertAlmostEqual(metrics['SUVmean'], (999*5.0+9.0)/1000, places=5)
+    self.assertAlmostEqual(metrics['TLG'], metrics['SUVmean']*metrics['volume'])
+    self.assertTrue(5.0 < metrics['SUVpeak'] < 9.0)
+
+    self.delayDisplay('Test passed!')
+
+  def test_TimeActivityCurves(self):
+    """ test the time-activity curves of the labels of a label map over a volume sequence
+    """
+    self.delayDisplay('Testing time-activity curves')
+    import numpy as np
+    import DICOMRWVMPlugin
+    midTimes = [30.0, 90.0, 210.0]
+    sequenceNode = self._dynamicSequence([1.0, 2.0, 3.0], midTimes, scales=[1.0, 2.0])
+    labels = np.zeros((2, 2, 2), dtype=np.int16)
+    labels[0] = 1
+    labels[1, 0] = 7
+    labelmapNode = slicer.util.addVolumeFromArray(labels, nodeClassName='vtkMRMLLabelMapVolumeNode')
+
+    curves = DICOMRWVMPlugin.TimeActivityCurves().compute(sequenceNode, labelmapNode)
+    np.testing.assert_array_equal(curves['labels'], [1, 7])
+    np.testing.assert_array_equal(curves['count'], [4, 2])
+    np.testing.assert_allclose(curves['times'], midTimes)
+    np.testing.assert_allclose(curves['mean'], [[1, 2], [2, 4], [3, 6]])
+    np.testing.assert_allclose(curves['max'], [[1, 2], [2, 4], [3, 6]])
+
+    # the stored value mapping of compact mode is applied to the curves
+    DICOMRWVMPlugin.DICOMRWVMPluginClass().setStoredValueMapping(sequenceNode, 2.0, 1.0)
+    curves = DICOMRWVMPlugin.TimeActivityCurves().compute(sequenceNode, labelmapNode)
+    np.testing.assert_allclose(curves['mean'], [[3, 5], [5, 9], [7, 13]])
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+    slicer.mrmlScene.RemoveNode(sequenceNode)
+
+    self.delayDisplay('Test passed!')
+
+  def test_ParametricImaging(self):
+    """ test Patlak Ki and Logan distribution volume on synthetic compartment model curves
+    """
+    self.delayDisplay('Testing Patlak and Logan parametric images')
+    import numpy as np
+    import DICOMRWVMPlugin
+    # plasma input function sampled every second, rate constants per second
+    t = np.arange(0.0, 5401.0)
+    cp = 100*np.exp(-t/60.0) + 10*np.exp(-t/3000.0)
+    convolve = lambda k: np.convolve(cp, np.exp(-k*t))[:len(t)]
+    # irreversible two-tissue compartment model: Ki = K1 k3/(k2+k3)
+    (K1, k2, k3) = (0.1/60, 0.15/60, 0.05/60)
+    free = K1*convolve(k2+k3)
+    irreversible = free + k3*np.cumsum(free)
+    # reversible one-tissue compartment model: distribution volume K1/k2
+    (K1r, k2r) = (0.1/60, 0.05/60)
+    reversible = K1r*convolve(k2r)
+
+    frameStarts = np.concatenate((np.arange(0, 600, 60), np.arange(600, 5400, 300)))
+    frameEnds = np.append(frameStarts[1:], 5400)
+    midTimes = (frameStarts + frameEnds)/2.0
+    frameMean = lambda curve: [curve[(t >= start) & (t < end)].mean() for start, end in zip(frameStarts, frameEnds)]
+    scales = [1.0, 2.0]
+    parametricImaging = DICOMRWVMPlugin.ParametricImaging(numberOfThreads=2)
+
+    sequenceNode = self._dynamicSequence(frameMean(irreversible), midTimes, scales)
+    (kiNode, interceptNode) = parametricImaging.patlak(sequenceNode, t, cp, startTime=1200)
+    ki = slicer.util.arrayFromVolume(kiNode)
+    for k, scale in enumerate(scales):
+      np.testing.assert_allclose(ki[k], scale*K1*k3/(k2+k3), rtol=0.02)
+    for node in [sequenceNode, kiNode, interceptNode]:
+      slicer.mrmlScene.RemoveNode(node)
+
+    sequenceNode = self._dynamicSequence(frameMean(reversible), midTimes, scales)
+    (dvNode, interceptNode) = parametricImaging.logan(sequenceNode, t, cp, startTime=1200)
+    dv = slicer.util.arrayFromVolume(dvNode)
+    for k, scale in enumerate(scales):
+      np.testing.assert_allclose(dv[k], scale*K1r/k2r, rtol=0.02)
+    for node in [sequenceNode, dvNode, interceptNode]:
+      slicer.mrmlScene.RemoveNode(node)
+
+    # too few frames after the start time
+    sequenceNode = self._dynamicSequence(frameMean(reversible), midTimes, scales)
+    with self.assertRaises(ValueError):
+      parametricImaging.patlak(sequenceNode, t, cp, startTime=midTimes[-1])
+    slicer.mrmlScene.RemoveNode(sequenceNode)
+
+    self.delayDisplay('Test passed!')
+
+  def test_ProgressiveFrameLoader(self):
+    """ test that the background loader sorts the slices of the remaining
+    frames like the first frame, maps them and appends them to the sequence
+    """
+    self.delayDisplay('Testing progressive frame loading')
+    import time
+    import numpy as np
+    import DICOMRWVMPlugin
+    from DICOMLib import DICOMLoadable
+    frameFiles = []
+    for frame in range(3):
+      directory = os.path.join(self.tempDicomDatabase, 'progressive', str(frame))
+      self._writeSyntheticPETSeries(directory, numberOfFiles=4, numberOfFrames=1,
+        pixelValues=lambda index, frame=frame: np.full((1, 8, 8), 10*(frame+1)+index, dtype=np.uint16))
+      indexer = ctk.ctkDICOMIndexer()
+      indexer.addDirectory(slicer.dicomDatabase, directory, None)
+      indexer.waitForImportFinished()
+      frameFiles.append([os.path.join(directory, f'{index}.dcm') for index in range(4)])
+
+    loadable = DICOMLoadable()
+    loadable.mappings = [DICOMRWVMPlugin.RealWorldValueMappingItem(slope=0.5)]
+    loadable.intercept = 0.0
+    loadable.quantity = loadable.units = None
+    sequenceNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSequenceNode')
+    # the files of the remaining frames are not sorted
+    loader = DICOMRWVMPlugin.ProgressiveFrameLoader(DICOMRWVMPlugin.DICOMRWVMPluginClass(), loadable, sequenceNode,
+      vtk.vtkMatrix4x4(), frameFiles[0], [list(reversed(files)) for files in frameFiles[1:]], np.array([0.5, 0.25]))
+    (voxels, instanceUIDs) = loader.readFrame(list(reversed(frameFiles[1])), 0.5)
+    np.testing.assert_allclose(voxels[:, 0, 0], [0.5*(20+index) for index in range(4)])
+    self.assertEqual(instanceUIDs.split(), [str(pydicom.dcmread(f).SOPInstanceUID) for f in frameFiles[1]])
+
+    loader.start()
+    deadline = time.time() + 60
+    while loader in DICOMRWVMPlugin.ProgressiveFrameLoader.activeLoaders and time.time() < deadline:
+      slicer.app.processEvents()
+      time.sleep(0.01)
+    self.assertNotIn(loader, DICOMRWVMPlugin.ProgressiveFrameLoader.activeLoaders)
+    self.assertEqual(sequenceNode.GetNumberOfDataNodes(), 2)
+    for frame, factor in [(1, 0.5), (2, 0.25)]:
+      frameVoxels = slicer.util.arrayFromVolume(sequenceNode.GetDataNodeAtValue(str(frame)))
+      np.testing.assert_allclose(frameVoxels[:, 0, 0], [factor*(10*(frame+1)+index) for index in range(4)])
+    slicer.mrmlScene.RemoveNode(sequenceNode)
+
+    self.delayDisplay('Test passed!')
+
+  def test_RWVMRegistry(self):
+    """ test that registered RWVM files are found again for the same inputs only
+    """
+    self.delayDisplay('Testing RWVM registry')
+    import tempfile, shutil
+    import DICOMPETSUVPlugin
+    registryDir = tempfile.mkdtemp()
+    rwvmFile = os.path.join(registryDir, 'rwvm.dcm')
+    open(rwvmFile, 'w').close()
+
+    registry = DICOMPETSUVPlugin.RWVMRegistry(os.path.join(registryDir, 'registry.json'))
+    self.assertIsNone(registry.lookup('1.2.3', 'abc'))
+    registry.register('1.2.3', 'abc', rwvmFile)
+    registry = DICOMPETSUVPlugin.RWVMRegistry(os.path.join(registryDir, 'registry.json'))
+    self.assertEqual(registry.lookup('1.2.3', 'abc'), rwvmFile)
+    self.assertIsNone(registry.lookup('1.2.3', 'def'))
+    self.assertIsNone(registry.lookup('1.2.4', 'abc'))
+
+    # a registered file that was deleted is generated again
+    os.remove(rwvmFile)
+    self.assertIsNone(registry.lookup('1.2.3', 'abc'))
+    shutil.rmtree(registryDir)
+
+    self.delayDisplay('Test passed!')
+
+  def test_CohortSUVFactors(self):
+    """ test the vectorised SUV factors against the formulas of the CLI
+    """
+    self.delayDisplay('Testing cohort SUV factors')
+    import numpy as np
+    import DICOMPETSUVPlugin
+    columns = {
+      'SeriesInstanceUID': ['1', '2', '3'],
+      'RadionuclideTotalDose': ['370000000', '370000000', ''],
+      'PatientWeight': ['75', '60', '70'],
+      'PatientSize': ['1.8', '1.65', ''],
+      'PatientSex': ['M', 'F', 'M'],
+      'Units': ['BQML', 'BQML', 'BQML'],
+      'CorrectedImage': ['DECY\\ATTN', 'ATTN\\DECY', 'DECY\\ATTN'],
+      'DecayCorrection': ['START', 'ADMIN', 'START'],
+      'FrameReferenceTime': ['0', '', ''],
+      'SeriesTime': ['090000', '093000', '090000'],
+      'RadiopharmaceuticalStartTime': ['080000', '083000', '080000'],
+      'RadionuclideHalfLife': ['6586.2', '6586.2', '6586.2'],
+      }
+    factors, failures = DICOMPETSUVPlugin.CohortSUVFactors.computeFactors(columns)
+
+    decayedDose = 370000.0*2**(-3600/6586.2) # kBq, one hour after injection
+    self.assertAlmostEqual(factors['SUVbwConversionFactor'][0], 75/decayedDose)
+    self.assertAlmostEqual(factors['SUVlbmConversionFactor'][0], (1.10*75-128*(75/180.0)**2)/decayedDose)
+    self.assertAlmostEqual(factors['SUVibwConversionFactor'][0], min(48.0+1.06*(180-152), 75)/decayedDose)
+    self.assertAlmostEqual(factors['SUVbsaConversionFactor'][0], 75**0.425*180**0.725*0.007184/decayedDose)
+    # ADMIN: the dose is not decayed
+    self.assertAlmostEqual(factors['SUVbwConversionFactor'][1], 60/370000.0)
+    self.assertAlmostEqual(factors['SUVlbmConversionFactor'][1], (1.07*60-148*(60/165.0)**2)/370000.0)
+    self.assertTrue(np.isnan(factors['SUVbwConversionFactor'][2]))
+    self.assertEqual(failures, {2: 'Missing injected dose'})
+
+    self.delayDisplay('Test passed!')
+
+  def test_MixedDimensionExamine(self):
+    """ test that mixed single slice and multiframe PET series examined
+    in any order by one plugin keep their own dimension
+    """
+    self.delayDisplay('Testing examine of mixed 3D and 4D PET series')
+    import random
+    import DICOMPETSUVPlugin
+    syntheticDirectory = os.path.join(self.tempDicomDatabase, 'synthetic')
+    expectedDimension = {}
+    for seriesIndex in range(8):
+      multiframe = seriesIndex % 2 == 1
+      seriesUID = self._writeSyntheticPETSeries(os.path.join(syntheticDirectory, str(seriesIndex)),
+        numberOfFiles=1 if multiframe else 3, numberOfFrames=4 if multiframe else 1)
+      expectedDimension[seriesUID] = 3 if multiframe else 2
+    indexer = ctk.ctkDICOMIndexer()
+    indexer.addDirectory(slicer.dicomDatabase, syntheticDirectory, None)
+    indexer.waitForImportFinished()
+
+    fileLists = [slicer.dicomDatabase.filesForSeries(seriesUID) for seriesUID in expectedDimension]
+    tasks = fileLists*4
+    random.shuffle(tasks)
+    plugin = DICOMPETSUVPlugin.DICOMPETSUVPluginClass()
+    plugin.deferredGenerationEnabled = lambda: True
+    plugin.combineBedPositionsEnabled = lambda: False
+    # one series per call, cached and uncached, and all series in one call
+    results = [(fileList, plugin.examine([fileList])) for fileList in tasks]
+    random.shuffle(fileLists)
+    batchLoadables = plugin.examine(fileLists)
+    for fileList in fileLists:
+      seriesUID = slicer.dicomDatabase.fileValue(fileList[0], '0020,000e')
+      results.append((fileList, [loadable for loadable in batchLoadables if loadable.referencedSeriesInstanceUID == seriesUID]))
+
+    for fileList, loadables in results:
+      self.assertTrue(len(loadables) > 0)
+      seriesUID = slicer.dicomDatabase.fileValue(fileList[0], '0020,000e')
+      for loadable in loadables:
+        self.assertEqual(loadable.multiframe, expectedDimension[seriesUID])
+        self.assertEqual(loadable.referencedSeriesInstanceUID, seriesUID)
+      self.assertTrue(any('(SUVbw)' in loadable.name for loadable in loadables))
+
+    self.delayDisplay('Test passed!')
+
+  def test_ExamineInProcesses(self):
+    """ test that PET series examined concurrently by separate Slicer
+    processes, each with its own DICOM database, get the loadables of a
+    sequential examine in this process
+    """
+    self.delayDisplay('Testing examine in concurrent processes')
+    import json, subprocess, tempfile, shutil
+    import DICOMPETSUVPlugin, DICOMRWVMPlugin
+    workDirectory = tempfile.mkdtemp()
+    examineScript = os.path.join(workDirectory, 'examine.py')
+    with open(examineScript, 'w') as scriptFile:
+      scriptFile.write(self.examineProcessScript)
+
+    expected = {}
+    processes = []
+    for seriesIndex in range(4):
+      multiframe = seriesIndex % 2 == 1
+      seriesDirectory = os.path.join(workDirectory, 'series', str(seriesIndex))
+      (seriesUID, plugin, loadables) = self._importSyntheticPETSeries(seriesDirectory, deferred=True,
+        numberOfFiles=1 if multiframe else 3, numberOfFrames=4 if multiframe else 1)
+      expected[seriesUID] = sorted([loadable.name, loadable.multiframe] for loadable in loadables)
+      outputFileName = os.path.join(workDirectory, f'{seriesIndex}.json')
+      command = [slicer.app.launcherExecutableFilePath, '--no-splash', '--no-main-window', '--testing',
+        '--additional-module-paths', os.path.dirname(DICOMPETSUVPlugin.__file__), os.path.dirname(DICOMRWVMPlugin.__file__),
+        '--python-script', examineScript, os.path.join(workDirectory, 'database', str(seriesIndex)), seriesDirectory,
+        outputFileName]
+      processes.append((subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT), outputFileName))
+
+    for process, outputFileName in processes:
+      (output, _) = process.communicate(timeout=600)
+      self.assertEqual(process.returncode, 0, output.decode(errors='replace'))
+      with open(outputFileName) as outputFile:
+        result = json.load(outputFile)
+      # each database holds only the series of its process
+      self.assertEqual(len(result), 1)
+      for seriesUID, loadables in result.items():
+        self.assertEqual(sorted(loadables), expected[seriesUID])
+    shutil.rmtree(workDirectory)
+
+    self.delayDisplay('Test passed!')
+
+  # run by test_ExamineInProcesses: examine.py databaseDirectory seriesDirectory outputFileName
+  examineProcessScript = """
+import json, sys, traceback
+import ctk, slicer
+from DICOMLib import DICOMUtils
+exitCode = 1
+try:
+  (databaseDirectory, seriesDirectory, outputFileName) = sys.argv[-3:]
+  DICOMUtils.openTemporaryDatabase(databaseDirectory)
+  indexer = ctk.ctkDICOMIndexer()
+  indexer.addDirectory(slicer.dicomDatabase, seriesDirectory, None)
+  indexer.waitForImportFinished()
+  plugin = slicer.modules.dicomPlugins['DICOMPETSUVPlugin']()
+  plugin.deferredGenerationEnabled = lambda: True
+  result = {}
+  for patient in slicer.dicomDatabase.patients():
+    for study in slicer.dicomDatabase.studiesForPatient(patient):
+      for series in slicer.dicomDatabase.seriesForStudy(study):
+        loadables = plugin.examine([slicer.dicomDatabase.filesForSeries(series)])
+        result[series] = [[loadable.name, loadable.multiframe] for loadable in loadables]
+  with open(outputFileName, 'w') as outputFile:
+    json.dump(result, outputFile)
+  exitCode = 0
+except Exception:
+  traceback.print_exc()
+slicer.util.exit(exitCode)
+"""
+
+  def test_ParametricMapExport(self):
+    """ test that a loaded SUV volume is exported with the voxels it has in
+    the scene, that a dynamic map reads back with its frame positions and
+    that volumes in other units are rejected
+    """
+    self.delayDisplay('Testing parametric map export')
+    import tempfile, shutil
+    import numpy as np
+    import DICOMRWVMPlugin
+    (seriesUID, plugin, loadables) = self._importSyntheticPETSeries(os.path.join(self.tempDicomDatabase, 'parametricMap'),
+      numberOfFiles=3, numberOfFrames=1)
+    suvlbm = [loadable for loadable in loadables if '(SUVlbm)' in loadable.name][0]
+    volumeNode = plugin.load(suvlbm)
+    voxels = plugin.rwvPlugin.arrayFromSUVVolume(volumeNode)
+
+    outputDirectory = tempfile.mkdtemp()
+    fileName = plugin.rwvPlugin.exportParametricMap(volumeNode, outputDirectory, addToDatabase=False)
+    written = pydicom.dcmread(fileName)
+    self.assertEqual(written.SOPClassUID, DICOMRWVMPlugin.ParametricMapExporter.sopClassUID)
+    self.assertEqual(written.ReferencedSeriesSequence[0].SeriesInstanceUID, seriesUID)
+    self.assertEqual(int(written.NumberOfFrames), 3)
+    mapping = written.SharedFunctionalGroupsSequence[0].RealWorldValueMappingSequence[0]
+    self.assertEqual(mapping.MeasurementUnitsCodeSequence[0].CodeValue, '{SUVlbm}g/ml')
+    np.testing.assert_array_equal(np.frombuffer(written.FloatPixelData, dtype=np.float32).reshape(voxels.shape), voxels)
+
+    # a volume that is not SUV is not exported
+    bqmlNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+    slicer.util.updateVolumeFromArray(bqmlNode, np.zeros((2, 2, 2), dtype=np.float32))
+    bqmlNode.SetVoxelValueUnits(slicer.vtkCodedEntry())
+    bqmlNode.GetVoxelValueUnits().SetValueSchemeMeaning('Bq/ml', 'UCUM', 'Becquerels/milliliter')
+    with self.assertRaises(ValueError):
+      plugin.rwvPlugin.exportParametricMap(bqmlNode, outputDirectory, addToDatabase=False)
+    slicer.mrmlScene.RemoveNode(bqmlNode)
+    slicer.mrmlScene.RemoveNode(volumeNode)
+
+    # 2 time frames of 3 slices
+    exporter = DICOMRWVMPlugin.ParametricMapExporter()
+    source = pydicom.dataset.Dataset()
+    source.PatientName = 'PETSUV^Synthetic'
+    source.PatientID = 'PETSUVSYNTHETIC'
+    source.StudyInstanceUID = source.SeriesInstanceUID = source.FrameOfReferenceUID = pydicom.uid.generate_uid()
+    source.SOPClassUID = '1.2.840.10008.5.1.4.1.1.128'
+    source.Modality = 'PT'
+    voxels = np.arange(2*3*4*5, dtype=np.float32).reshape(6, 4, 5) / 7
+    geometry = (np.array([10., 20., 30.]), [np.array([1., 0., 0.]), np.array([0., 1., 0.]), np.array([0., 0., 1.])],
+                (2., 2.5, 3.))
+    units = ('{SUVbw}g/ml', 'UCUM', 'Standardized Uptake Value body weight')
+    dataset = exporter.createDataset(source, voxels, 2, geometry, units, ['1.2.3'], 'SUVbw', 1001)
+    fileName = os.path.join(outputDirectory, 'pm.dcm')
+    dataset.save_as(fileName)
+
+    written = pydicom.dcmread(fileName)
+    self.assertEqual(written.PatientID, 'PETSUVSYNTHETIC')
+    self.assertEqual(int(written.NumberOfFrames), 6)
+    np.testing.assert_array_equal(np.frombuffer(written.FloatPixelData, dtype=np.float32).reshape(6, 4, 5), voxels)
+    frames = written.PerFrameFunctionalGroupsSequence
+    self.assertEqual(list(frames[4].FrameContentSequence[0].DimensionIndexValues), [2, 2])
+    np.testing.assert_allclose(frames[4].PlanePositionSequence[0].ImagePositionPatient, [10, 20, 33])
+    self.assertEqual(list(written.SharedFunctionalGroupsSequence[0].PixelMeasuresSequence[0].PixelSpacing), [2.5, 2])
+    shutil.rmtree(outputDirectory)
+
+    self.delayDisplay('Test passed!')
+
+  def test_SUVResampling(self):
+    """ test the resampling of SUV voxels onto a CT grid
+    """
+    self.delayDisplay('Testing SUV resampling')
+    import numpy as np
+    import DICOMRWVMPlugin
+    resampler = DICOMRWVMPlugin.SUVResampler(numberOfThreads=3)
+    suv = np.random.RandomState(0).rand(5, 6, 7).astype(np.float32)
+
+    for interpolation in ('linear', 'nearest'):
+      np.testing.assert_allclose(resampler.resampleArray(suv, suv.shape, np.eye(4), interpolation), suv)
+    # half a voxel along I: the average of neighbouring voxels
+    shift = np.eye(4)
+    shift[0, 3] = 0.5
+    np.testing.assert_allclose(resampler.resampleArray(suv, (5, 6, 6), shift),
+                               (suv[:, :, :-1] + suv[:, :, 1:])/2, rtol=1e-5)
+    # a CT grid of twice the resolution contains the PET voxels
+    upsampled = resampler.resampleArray(suv, (9, 11, 13), np.diag([0.5, 0.5, 0.5, 1.0]))
+    np.testing.assert_allclose(upsampled[::2, ::2, ::2], suv, rtol=1e-5)
+    # outside of the PET field of view
+    shift[0, 3] = 10
+    self.assertFalse(resampler.resampleArray(suv, suv.shape, shift).any())
+
+    self.delayDisplay('Test passed!')
+
+  def test_SUVDisplayRange(self):
+    """ test the display range estimated from sampled voxels
+    """
+    self.delayDisplay('Testing SUV display range')
+    import numpy as np
+    import DICOMRWVMPlugin
+    displayRange = DICOMRWVMPlugin.SUVDisplayRange()
+    stored = np.random.RandomState(0).randint(0, 2000, (20, 64, 64)).astype(np.int16)
+    (lower, upper) = displayRange.samplePercentiles(stored, [0.5, 99.5])
+    (expectedLower, expectedUpper) = np.percentile(stored, [0.5, 99.5])
+    self.assertLessEqual(abs(lower-expectedLower), 20)
+    self.assertLessEqual(abs(upper-expectedUpper), 20)
+
+    # stored voxels with a mapping to SUVbw: the range is in SUV, the window in stored values
+    volumeNode = slicer.util.addVolumeFromArray(stored)
+    units = slicer.vtkCodedEntry()
+    units.SetValueSchemeMeaning('{SUVbw}g/ml', 'UCUM', 'Standardized Uptake Value body weight')
+    volumeNode.SetVoxelValueUnits(units)
+    displayRange.rwvmPlugin.setStoredValueMapping(volumeNode, 0.005)
+    (lower, upper) = displayRange.displayRange(volumeNode)
+    self.assertEqual(lower, 0.0)
+    self.assertAlmostEqual(upper, expectedUpper*0.005, delta=0.1)
+    self.assertIsNotNone(volumeNode.GetAttribute(displayRange.cacheAttribute))
+    (window, level) = displayRange.windowLevel(volumeNode)
+    self.assertAlmostEqual(window, upper/0.005)
+    self.assertAlmostEqual(level, upper/0.005/2)
+    slicer.mrmlScene.RemoveNode(volumeNode)
+
+    self.delayDisplay('Test passed!')
+
+  def test_StoredVoxels(self):
+    """ test that compact mode keeps the stored pixels and maps them to SUV
+    through the modality rescale and the RWVM slope
+    """
+    self.delayDisplay('Testing stored voxels')
+    import numpy as np
+    import DICOMRWVMPlugin
+    from DICOMLib import DICOMLoadable
+    syntheticDirectory = os.path.join(self.tempDicomDatabase, 'stored')
+    self._writeSyntheticPETSeries(syntheticDirectory, numberOfFiles=4, numberOfFrames=1, rescaleSlope='0.5',
+      pixelValues=lambda index: np.full((1, 8, 8), 10*(index+1), dtype=np.uint16))
+    files = [os.path.join(syntheticDirectory, f'{index}.dcm') for index in range(4)]
+
+    rwvPlugin = DICOMRWVMPlugin.DICOMRWVMPluginClass()
+    rwvPlugin.keepStoredVoxels = lambda: True
+    volumeNode = rwvPlugin.loadStoredVolume(files, 'stored')
+    self.assertEqual(volumeNode.GetImageData().GetScalarType(), vtk.VTK_UNSIGNED_SHORT)
+    self.assertEqual(rwvPlugin.getStoredValueMapping(volumeNode), (0.5, 0.0))
+    self.assertAlmostEqual(volumeNode.GetSpacing()[2], 3.0)
+
+    loadable = DICOMLoadable()
+    loadable.mappings = [DICOMRWVMPlugin.RealWorldValueMappingItem(slope=0.002, intercept=0.1)]
+    loadable.intercept = 0.1
+    rwvPlugin.applyRealWorldValueMappingToNode(volumeNode, loadable, 0.002)
+    self.assertEqual(volumeNode.GetImageData().GetScalarType(), vtk.VTK_UNSIGNED_SHORT)
+    suv = rwvPlugin.arrayFromSUVVolume(volumeNode)
+    np.testing.assert_allclose(suv[:, 0, 0], [10*(index+1)*0.5*0.002 + 0.1 for index in range(4)], rtol=1e-5)
+
+    # slices with different rescale parameters are not kept as stored pixels
+    ds = pydicom.dcmread(files[-1])
+    ds.RescaleSlope = '0.25'
+    ds.save_as(files[-1])
+    self.assertIsNone(rwvPlugin.loadStoredVolume(files, 'mixed'))
+    slicer.mrmlScene.RemoveNode(volumeNode)
+
+    self.delayDisplay('Test passed!')
+
+  def test_SeriesPreview(self):
+    """ test that the preview takes every n-th slice along the slice normal
+    whatever the order of the files, and that the full resolution volume
+    replaces it in the same node
+    """
+    self.delayDisplay('Testing PET series preview')
+    import copy
+    import numpy as np
+    (seriesUID, plugin, loadables) = self._importSyntheticPETSeries(os.path.join(self.tempDicomDatabase, 'preview'),
+      deferred=False, numberOfFiles=7, numberOfFrames=1,
+      pixelValues=lambda index: np.full((1, 8, 8), 10*(index+1), dtype=np.uint16))
+    suvbw = [loadable for loadable in loadables if '(SUVbw)' in loadable.name and not getattr(loadable, 'preview', False)][0]
+    previewLoadable = copy.copy(suvbw)
+    previewLoadable.files = list(reversed(suvbw.files))
+
+    previewNode = plugin.rwvPlugin.loadPetSeriesPreview(previewLoadable, sliceStep=3, inPlaneStep=2)
+    self.assertTrue(plugin.rwvPlugin.isPreview(previewNode))
+    previewVoxels = slicer.util.arrayFromVolume(previewNode).copy()
+    self.assertEqual(previewVoxels.shape, (3, 4, 4))
+    np.testing.assert_allclose(previewNode.GetSpacing(), (8, 8, 9))
+    previewOrigin = previewNode.GetOrigin()
+
+    fullNode = plugin.rwvPlugin.replacePreviewWithFullResolution(previewNode)
+    self.assertIs(fullNode, previewNode)
+    self.assertFalse(plugin.rwvPlugin.isPreview(previewNode))
+    fullVoxels = slicer.util.arrayFromVolume(previewNode)
+    self.assertEqual(fullVoxels.shape, (7, 8, 8))
+    np.testing.assert_allclose(previewNode.GetSpacing(), (4, 4, 3))
+    np.testing.assert_allclose(previewNode.GetOrigin(), previewOrigin)
+    np.testing.assert_allclose(previewVoxels, fullVoxels[::3, ::2, ::2], rtol=1e-6)
+    # slices of increasing position have increasing values
+    self.assertTrue(np.all(np.diff(previewVoxels[:, 0, 0]) > 0))
+    slicer.mrmlScene.RemoveNode(previewNode)
+
+    self.delayDisplay('Test passed!')
+
+  def test_SUVMemoryBudget(self):
+    """ test that a hidden SUV variant is released under the memory budget
+    and rematerialized when its voxels are needed
+    """
+    self.delayDisplay('Testing PET memory budget')
+    import numpy as np
+    import DICOMRWVMPlugin
+    # the variants are placeholders, the RWVM is generated by the first load
+    (seriesUID, plugin, loadables) = self._importSyntheticPETSeries(os.path.join(self.tempDicomDatabase, 'budget'),
+      deferred=True, numberOfFiles=3, numberOfFrames=1)
+    suvbw = [loadable for loadable in loadables if '(SUVbw)' in loadable.name][0]
+    suvlbm = [loadable for loadable in loadables if '(SUVlbm)' in loadable.name][0]
+
+    budget = DICOMRWVMPlugin.SUVMemoryBudget
+    maxSizeBytes = budget.maxSizeBytes
+    budget.maxSizeBytes = classmethod(lambda cls: 1)
+    try:
+      hiddenNode = plugin.load(suvbw)
+      expected = slicer.util.arrayFromVolume(hiddenNode).copy()
+      # loading the second variant shows it instead of the first one
+      shownNode = plugin.load(suvlbm)
+      self.assertIsNone(hiddenNode.GetImageData())
+      self.assertIsNotNone(hiddenNode.GetAttribute(budget.releasedAttribute))
+      self.assertIsNotNone(shownNode.GetImageData())
+
+      voxels = DICOMRWVMPlugin.DICOMRWVMPluginClass().arrayFromSUVVolume(hiddenNode)
+      np.testing.assert_array_equal(voxels, expected)
+      self.assertIsNone(hiddenNode.GetAttribute(budget.releasedAttribute))
+
+      # a volume referenced by another node is in use
+      referencingNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScriptedModuleNode')
+      referencingNode.SetNodeReferenceID('petVolume', hiddenNode.GetID())
+      self.assertIn(hiddenNode.GetID(), budget.shownKeys())
+      budget.enforce()
+      self.assertIsNotNone(hiddenNode.GetImageData())
+      slicer.mrmlScene.RemoveNode(referencingNode)
+      budget.enforce()
+      self.assertIsNone(hiddenNode.GetImageData())
+      # showing a released volume rematerializes it once the events are processed
+      slicer.util.setSliceViewerLayers(background=hiddenNode)
+      slicer.app.processEvents()
+      np.testing.assert_array_equal(slicer.util.arrayFromVolume(hiddenNode), expected)
+      slicer.util.setSliceViewerLayers(background=shownNode)
+
+      # a record whose node ID belongs to another node is dropped, not released
+      key = hiddenNode.GetID()
+      hiddenNode.SetAttribute(budget.keyAttribute, 'vtkMRMLScalarVolumeNodeOfAnotherScene')
+      budget.enforce()
+      self.assertNotIn(key, budget.records)
+      self.assertIsNotNone(hiddenNode.GetImageData())
+      budget.reset()
+      self.assertEqual(budget.records, {})
+      self.assertEqual(budget.observations, {})
+    finally:
+      budget.maxSizeBytes = maxSizeBytes
+
+    self.delayDisplay('Test passed!')
+
+  def test_BedPositions(self):
+    """ test the placement of overlapping bed positions on one slice grid
+    """
+    self.delayDisplay('Testing whole body bed position planning')
+    import numpy as np
+    import DICOMPETSUVPlugin
+    plan = DICOMPETSUVPlugin.DICOMPETSUVPluginClass.planBedPositions
+    firstBed = list(np.arange(0.0, 30.0, 3.0))
+    secondBed = list(np.arange(21.0, 51.0, 3.0))
+    result = plan([firstBed, secondBed])
+    self.assertEqual(result['numberOfSlices'], 17)
+    self.assertAlmostEqual(result['sliceSpacing'], 3.0)
+    self.assertEqual(result['sliceIndices'][0], list(range(10)))
+    self.assertEqual(result['sliceIndices'][1], list(range(7, 17)))
+    # a gap, slices off the grid and a different spacing are not combined
+    self.assertIsNone(plan([firstBed, list(np.arange(33.0, 60.0, 3.0))]))
+    self.assertIsNone(plan([firstBed, list(np.arange(22.5, 50.0, 3.0))]))
+    self.assertIsNone(plan([firstBed, list(np.arange(27.0, 50.0, 2.0))]))
+    # fully overlapping, contained and mostly overlapping beds are not combined
+    self.assertIsNone(plan([firstBed, list(firstBed)]))
+    self.assertIsNone(plan([firstBed, list(np.arange(3.0, 21.0, 3.0))]))
+    self.assertIsNone(plan([firstBed, list(np.arange(6.0, 36.0, 3.0))]))
+
+    self.delayDisplay('Test passed!')
+
+  def test_LoadBedPositions(self):
+    """ test that two overlapping bed positions load as one volume whose
+    overlapping slices blend the SUV of both beds
+    """
+    self.delayDisplay('Testing loading of whole body bed positions')
+    import numpy as np
+    import DICOMPETSUVPlugin
+    from pydicom.uid import generate_uid
+    bedsDirectory = os.path.join(self.tempDicomDatabase, 'beds')
+    studyUID, frameOfReferenceUID = generate_uid(), generate_uid()
+    # slices at 0-9 mm and 6-15 mm, the beds overlap by two slices
+    seriesUIDs = [self._writeSyntheticPETSeries(os.path.join(bedsDirectory, str(bed)), numberOfFiles=4, numberOfFrames=1,
+      pixelValues=lambda index, bed=bed: np.full((1, 8, 8), 100*(bed+1), dtype=np.uint16), studyUID=studyUID,
+      frameOfReferenceUID=frameOfReferenceUID, firstSlicePosition=6*bed, acquisitionTime=['090000', '091500'][bed])
+      for bed in range(2)]
+    indexer = ctk.ctkDICOMIndexer()
+    indexer.addDirectory(slicer.dicomDatabase, bedsDirectory, None)
+    indexer.waitForImportFinished()
+
+    plugin = DICOMPETSUVPlugin.DICOMPETSUVPluginClass()
+    plugin.combineBedPositionsEnabled = lambda: True
+    loadables = plugin.examine([slicer.dicomDatabase.filesForSeries(seriesUID) for seriesUID in seriesUIDs])
+    wholeBody = [loadable for loadable in loadables if '(SUVbw)' in loadable.name and getattr(loadable, 'bedLoadables', None)]
+    self.assertEqual(len(wholeBody), 1)
+    self.assertEqual(wholeBody[0].bedSliceIndices, [[0, 1, 2, 3], [2, 3, 4, 5]])
+
+    bedVoxels = []
+    for bedLoadable in wholeBody[0].bedLoadables:
+      bedNode = plugin.load(bedLoadable)
+      bedVoxels.append(slicer.util.arrayFromVolume(bedNode).copy())
+      slicer.mrmlScene.RemoveNode(bedNode)
+    wholeBodyNode = plugin.load(wholeBody[0])
+    voxels = slicer.util.arrayFromVolume(wholeBodyNode)
+    self.assertEqual(voxels.shape, (6, 8, 8))
+    np.testing.assert_allclose(voxels[:2], bedVoxels[0][:2], rtol=1e-6)
+    np.testing.assert_allclose(voxels[4:], bedVoxels[1][2:], rtol=1e-6)
+    # blending weights: distance to the end of the bed plus one
+    np.testing.assert_allclose(voxels[2], (2*bedVoxels[0][2] + bedVoxels[1][0])/3, rtol=1e-6)
+    np.testing.assert_allclose(voxels[3], (bedVoxels[0][3] + 2*bedVoxels[1][1])/3, rtol=1e-6)
+    # both beds have the same SUV factor
+    np.testing.assert_allclose(voxels[5], 2*voxels[0], rtol=1e-6)
+    slicer.mrmlScene.RemoveNode(wholeBodyNode)
+
+    # beds of different units are not combined
+    wholeBody[0].bedLoadables[1].unitsCodeValue = '{SUVlbm}g/ml'
+    with self.assertRaises(ValueError):
+      plugin.load(wholeBody[0])
+
+    self.delayDisplay('Test passed!')
+
+  def test_PairedCT(self):
+    """ test that without a CT of the same frame of reference the CT closest
+    in series time is paired, and that closing the scene forgets the
+    prefetched series
+    """
+    self.delayDisplay('Testing paired CT series')
+    import DICOMPETSUVPlugin
+    from pydicom.uid import generate_uid
+    pairedDirectory = os.path.join(self.tempDicomDatabase, 'paired')
+    studyUID = generate_uid()
+    petSeriesUID = self._writeSyntheticPETSeries(os.path.join(pairedDirectory, 'pet'), numberOfFiles=2, numberOfFrames=1,
+      studyUID=studyUID)
+    ctSeriesUIDs = []
+    for index, seriesTime in enumerate(['083000', '091000', '100000']):
+      ctDirectory = os.path.join(pairedDirectory, f'ct{index}')
+      ctSeriesUIDs.append(self._writeSyntheticPETSeries(ctDirectory, numberOfFiles=2, numberOfFrames=1, studyUID=studyUID))
+      for fileName in os.listdir(ctDirectory):
+        ds = pydicom.dcmread(os.path.join(ctDirectory, fileName))
+        ds.Modality = 'CT'
+        ds.SeriesTime = seriesTime
+        ds.save_as(os.path.join(ctDirectory, fileName))
+    indexer = ctk.ctkDICOMIndexer()
+    indexer.addDirectory(slicer.dicomDatabase, pairedDirectory, None)
+    indexer.waitForImportFinished()
+
+    plugin = DICOMPETSUVPlugin.DICOMPETSUVPluginClass()
+    # the PET series time is 090000
+    self.assertEqual(plugin.findPairedCTSeries(slicer.dicomDatabase.filesForSeries(petSeriesUID)), [ctSeriesUIDs[1]])
+
+    prefetcher = DICOMPETSUVPlugin.SeriesPrefetcher
+    prefetcher.prefetch(ctSeriesUIDs[1], slicer.dicomDatabase.filesForSeries(ctSeriesUIDs[1]))
+    self.assertIn(ctSeriesUIDs[1], prefetcher.prefetchedSeries)
+    slicer.mrmlScene.Clear(0)
+    self.assertNotIn(ctSeriesUIDs[1], prefetcher.prefetchedSeries)
+
+    self.delayDisplay('Test passed!')
+
   def test_SUVFactorCalculatorCLI(self):
     """ test PET SUV Factor Calculator CLI
     """
@@ -151,6 +896,92 @@ class PETDicomExtensionSelfTestTest(ScriptedLoadableModuleTest):
     f.Execute(img)
     self.assertEqual(round(f.GetMaximum()),90.0)
 
+    self.delayDisplay('Testing generation of a compressed SUV normalized volume')
+    compressedSUVBWName = os.path.join(cliOutDir,'SUVbw-compressed.nrrd')
+    parameters = {}
+    parameters['PETDICOMPath'] = cliTempDir
+    parameters['SUVBWName'] = compressedSUVBWName
+    parameters['compressionLevel'] = 6
+    parameters['compressionThreads'] = 4
+    SUVFactorCalculator = None
+    SUVFactorCalculator = slicer.cli.run(slicer.modules.suvfactorcalculator, SUVFactorCalculator, parameters, wait_for_completion=True)
+
+    self.assertEqual(SUVFactorCalculator.GetStatusString(), 'Completed')
+    self.assertLess(os.path.getsize(compressedSUVBWName), os.path.getsize(SUVBWName))
+    compressedImg = sitk.ReadImage(compressedSUVBWName)
+    self.assertEqual(compressedImg.GetSize(), img.GetSize())
+    self.assertEqual(compressedImg.GetOrigin(), img.GetOrigin())
+    self.assertEqual(sitk.GetArrayViewFromImage(compressedImg).tobytes(), sitk.GetArrayViewFromImage(img).tobytes())
+
+    self.delayDisplay('Testing generation of SUV parametric maps')
+    parametricMapDir = os.path.join(cliTempDir,'pm')
+    os.makedirs(parametricMapDir,exist_ok=True)
+    parameters = {}
+    parameters['PETDICOMPath'] = cliTempDir
+    parameters['parametricMapDICOMPath'] = parametricMapDir
+    SUVFactorCalculator = None
+    SUVFactorCalculator = slicer.cli.run(slicer.modules.suvfactorcalculator, SUVFactorCalculator, parameters, wait_for_completion=True)
+
+    self.assertEqual(SUVFactorCalculator.GetStatusString(), 'Completed')
+    parametricMaps = [f for f in os.listdir(parametricMapDir) if f.endswith('_SUVbw.dcm')]
+    self.assertEqual(len(parametricMaps), 1)
+    import numpy as np
+    parametricMap = pydicom.dcmread(os.path.join(parametricMapDir, parametricMaps[0]))
+    self.assertEqual(parametricMap.SOPClassUID, '1.2.840.10008.5.1.4.1.1.30')
+    self.assertEqual(int(parametricMap.NumberOfFrames), img.GetDepth())
+    self.assertEqual(round(float(np.frombuffer(parametricMap.FloatPixelData, dtype=np.float32).max())), 90.0)
+
+    self.delayDisplay('Test passed!')
+
+  def test_DynamicSeriesWithoutDecayCorrection(self):
+    """ test the frame dependent SUV factors of a dynamic series that is not
+    decay corrected (DecayCorrection NONE, CorrectedImage ATTN only)
+    """
+    self.delayDisplay('Testing SUV of a dynamic series without decay correction')
+    import numpy as np
+    import tempfile, shutil
+    import SimpleITK as sitk
+    frameReferenceTimes = [0, 600000, 1800000] # ms after the series time
+    cliTempDir = tempfile.mkdtemp()
+    petDir = os.path.join(cliTempDir, 'pet')
+    self._writeSyntheticPETSeries(petDir, numberOfFiles=3, numberOfFrames=4, decayCorrection='NONE',
+      correctedImage=['ATTN'], frameReferenceTimes=frameReferenceTimes,
+      pixelValues=lambda index: np.full((4, 8, 8), 100, dtype=np.uint16))
+    cliOutDir = os.path.join(cliTempDir, 'out')
+    os.makedirs(cliOutDir)
+    SUVBWName = os.path.join(cliOutDir, 'SUVbw.nrrd')
+    parameters = {}
+    parameters['PETDICOMPath'] = petDir
+    parameters['RWVDICOMPath'] = cliOutDir
+    parameters['SUVBWName'] = SUVBWName
+    SUVFactorCalculator = slicer.cli.run(slicer.modules.suvfactorcalculator, None, parameters, wait_for_completion=True)
+    self.assertEqual(SUVFactorCalculator.GetStatusString(), 'Completed')
+
+    # series one hour after injection, each frame decays to its own reference time
+    decayedDose = [370000.0*2**(-(3600+t/1000.0)/6586.2) for t in frameReferenceTimes] # kBq
+    expectedFactors = [60/dose for dose in decayedDose]
+    rwvm = pydicom.dcmread(SUVFactorCalculator.GetParameterValue(2,1))
+    suvbwItems = [item for item in rwvm.ReferencedImageRealWorldValueMappingSequence
+                  if item.RealWorldValueMappingSequence[0].MeasurementUnitsCodeSequence[0].CodeValue == '{SUVbw}g/ml']
+    self.assertEqual(len(suvbwItems), len(frameReferenceTimes))
+    slopes = [float(item.RealWorldValueMappingSequence[0].RealWorldValueSlope) for item in suvbwItems]
+    np.testing.assert_allclose(slopes, expectedFactors, rtol=1e-5)
+
+    voxels = sitk.GetArrayFromImage(sitk.ReadImage(SUVBWName))
+    self.assertEqual(voxels.shape[0], len(frameReferenceTimes))
+    np.testing.assert_allclose([voxels[frame].mean() for frame in range(voxels.shape[0])],
+                               [100*factor for factor in expectedFactors], rtol=1e-4)
+
+    # decay corrected pixel values cannot be DecayCorrection NONE
+    shutil.rmtree(petDir)
+    self._writeSyntheticPETSeries(petDir, numberOfFiles=3, numberOfFrames=4, decayCorrection='NONE',
+      frameReferenceTimes=frameReferenceTimes)
+    parameters = {}
+    parameters['PETDICOMPath'] = petDir
+    SUVFactorCalculator = slicer.cli.run(slicer.modules.suvfactorcalculator, None, parameters, wait_for_completion=True)
+    self.assertNotEqual(SUVFactorCalculator.GetStatusString(), 'Completed')
+    shutil.rmtree(cliTempDir)
+
     self.delayDisplay('Test passed!')
 
   # ------------------------------------------------------------------------------
@@ -251,6 +1082,106 @@ class PETDicomExtensionSelfTestTest(ScriptedLoadableModuleTest):
       indexer.addDirectory(slicer.dicomDatabase, destinationDirectory, None)
       indexer.waitForImportFinished()
 
+  # ------------------------------------------------------------------------------
+  def _writeSyntheticPETSeries(self, directory, numberOfFiles, numberOfFrames, rescaleSlope='1', pixelValues=None,
+                               decayCorrection='START', correctedImage=('DECY', 'ATTN'), frameReferenceTimes=None,
+                               studyUID=None, frameOfReferenceUID=None, firstSlicePosition=0, acquisitionTime=None):
+    """ write a small attenuation and decay corrected PET series, return its SeriesInstanceUID.
+    pixelValues(index) returns the (numberOfFrames, 8, 8) uint16 pixels of file index, zero by default.
+    frameReferenceTimes are the FrameReferenceTime (ms) of each file, e.g. of the time frames of a
+    dynamic series of multiframe files. The slices are 3 mm apart starting at firstSlicePosition,
+    series of one acquisition (bed positions) share studyUID and frameOfReferenceUID.
+    """
+    import numpy as np
+    from pydicom.dataset import FileDataset, FileMetaDataset, Dataset
+    from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+    os.makedirs(directory, exist_ok=True)
+    studyUID, seriesUID, frameOfReferenceUID = studyUID or generate_uid(), generate_uid(), frameOfReferenceUID or generate_uid()
+    for index in range(numberOfFiles):
+      meta = FileMetaDataset()
+      meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.128'
+      meta.MediaStorageSOPInstanceUID = generate_uid()
+      meta.TransferSyntaxUID = ExplicitVRLittleEndian
+      fileName = os.path.join(directory, f'{index}.dcm')
+      ds = FileDataset(fileName, {}, file_meta=meta, preamble=b'\0'*128)
+      ds.is_little_endian = True
+      ds.is_implicit_VR = False
+      ds.SOPClassUID = meta.MediaStorageSOPClassUID
+      ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+      ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.FrameOfReferenceUID = studyUID, seriesUID, frameOfReferenceUID
+      ds.Modality = 'PT'
+      ds.PatientName = 'PETSUV^Synthetic'
+      ds.PatientID = 'PETSUVSYNTHETIC'
+      ds.PatientSex = 'F'
+      ds.PatientWeight = '60'
+      ds.PatientSize = '1.65'
+      ds.StudyDate = ds.SeriesDate = '20200101'
+      ds.SeriesTime = '090000'
+      if acquisitionTime is not None:
+        ds.AcquisitionTime = acquisitionTime
+      ds.Units = 'BQML'
+      ds.CorrectedImage = list(correctedImage)
+      ds.DecayCorrection = decayCorrection
+      if frameReferenceTimes is not None:
+        ds.FrameReferenceTime = str(frameReferenceTimes[index])
+      radiopharmaceutical = Dataset()
+      radiopharmaceutical.RadiopharmaceuticalStartTime = '080000'
+      radiopharmaceutical.RadionuclideTotalDose = '370000000'
+      radiopharmaceutical.RadionuclideHalfLife = '6586.2'
+      ds.RadiopharmaceuticalInformationSequence = [radiopharmaceutical]
+      ds.InstanceNumber = index+1
+      ds.ImagePositionPatient = [0, 0, firstSlicePosition+3*index]
+      ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+      ds.PixelSpacing = [4, 4]
+      ds.Rows = ds.Columns = 8
+      ds.SamplesPerPixel = 1
+      ds.PhotometricInterpretation = 'MONOCHROME2'
+      ds.BitsAllocated = ds.BitsStored = 16
+      ds.HighBit = 15
+      ds.PixelRepresentation = 0
+      ds.RescaleSlope = rescaleSlope
+      ds.RescaleIntercept = '0'
+      if numberOfFrames > 1:
+        ds.NumberOfFrames = numberOfFrames
+      pixels = pixelValues(index) if pixelValues else np.zeros((numberOfFrames, 8, 8), dtype=np.uint16)
+      ds.PixelData = pixels.astype(np.uint16).tobytes()
+      ds.save_as(fileName)
+    return seriesUID
+
+  # ------------------------------------------------------------------------------
+  def _importSyntheticPETSeries(self, directory, deferred=None, **seriesOptions):
+    """ write a synthetic PET series (see _writeSyntheticPETSeries), add it to the DICOM database and
+    examine it with a new DICOMPETSUVPlugin. Return the SeriesInstanceUID, the plugin and the loadables.
+    deferred overrides the deferred RWVM generation setting of the plugin.
+    """
+    import DICOMPETSUVPlugin
+    seriesUID = self._writeSyntheticPETSeries(directory, **seriesOptions)
+    indexer = ctk.ctkDICOMIndexer()
+    indexer.addDirectory(slicer.dicomDatabase, directory, None)
+    indexer.waitForImportFinished()
+    plugin = DICOMPETSUVPlugin.DICOMPETSUVPluginClass()
+    if deferred is not None:
+      plugin.deferredGenerationEnabled = lambda: deferred
+    loadables = plugin.examine([slicer.dicomDatabase.filesForSeries(seriesUID)])
+    return (seriesUID, plugin, loadables)
+
+  # ------------------------------------------------------------------------------
+  def _dynamicSequence(self, frameValues, midTimes, scales):
+    """ return a volume sequence of (2, 2, 2) frames, slice k of frame f holds scales[k]*frameValues[f],
+    with the frame mid times (s) stored like the PET plugins do at load time
+    """
+    import numpy as np
+    import DICOMRWVMPlugin
+    sequenceNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSequenceNode')
+    for frame, value in enumerate(frameValues):
+      voxels = np.empty((2, 2, 2), dtype=np.float32)
+      voxels[:] = (np.array(scales)*value)[:, np.newaxis, np.newaxis]
+      frameNode = slicer.util.addVolumeFromArray(voxels)
+      sequenceNode.SetDataNodeAtValue(frameNode, str(frame))
+      slicer.mrmlScene.RemoveNode(frameNode)
+    DICOMRWVMPlugin.DICOMRWVMPluginClass().setFrameMidTimes(sequenceNode, midTimes)
+    return sequenceNode
+
   # ------------------------------------------------------------------------------
   def _loadWithPlugin(self, UID, pluginName):
     dicomWidget = slicer.modules.dicom.widgetRepresentation().self()